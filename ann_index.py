@@ -0,0 +1,270 @@
+import os
+import sys
+import math
+import time
+import logging
+import threading
+import numpy as np
+import faiss
+from quantized_index import QuantizedIndex, _pq_subquantizers
+from reduced_index import ReducedIndex
+
+# "auto" picks flat, HNSW or IVF from the corpus size and the latency target below
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "auto")
+FAISS_LATENCY_TARGET_MS = float(os.getenv("FAISS_LATENCY_TARGET_MS", 20))
+# Search-time knobs: higher values raise recall and p99 latency together
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", 64))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", 16))
+# HNSW graph links cost ~2 * M * 4 bytes per vector, so very large corpora go to IVF
+HNSW_M = 32
+HNSW_MAX_VECTORS = 2_000_000
+# A single-query flat scan reads the whole index; a few GB/s is typical on one core
+FLAT_SCAN_BYTES_PER_MS = 5_000_000
+# Wait for this many quiet seconds after a change before rebuilding
+REBUILD_DELAY = 5.0
+BUILD_BATCH = 65536
+
+
+def choose_index_type(count, bytes_per_vector, latency_target_ms=FAISS_LATENCY_TARGET_MS):
+    if count * bytes_per_vector / FLAT_SCAN_BYTES_PER_MS <= latency_target_ms:
+        return "flat"
+    if count <= HNSW_MAX_VECTORS:
+        return "hnsw"
+    return "ivf"
+
+
+def index_factory_string(index_type, count, d, mode=""):
+    # Compress the ANN index the same way as the index it accelerates
+    storage = {"sq8": "SQ8", "pq": f"PQ{_pq_subquantizers(d)}"}.get(mode, "Flat")
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}" if storage == "Flat" else f"HNSW{HNSW_M},{storage}"
+    # Roughly 4 * sqrt(n) lists, each trained with at least 39 points
+    nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+    return f"IVF{nlist},{storage}"
+
+
+def search_subset(index, x, k, positions):
+    # k nearest among the given positions only, e.g. one document's chunks; None when
+    # the index cannot restrict its search
+    if isinstance(index, faiss.Index):
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(np.asarray(positions, dtype=np.int64)))
+        return index.search(np.ascontiguousarray(x, dtype=np.float32), k, params=params)
+    if hasattr(index, "search_subset"):
+        return index.search_subset(x, k, positions)
+    return None
+
+
+def set_search_params(index, ef_search=None, nprobe=None):
+    params = faiss.ParameterSpace()
+    if ef_search is not None and "HNSW" in type(index).__name__:
+        params.set_index_parameter(index, "efSearch", ef_search)
+    if nprobe is not None and "IVF" in type(index).__name__:
+        params.set_index_parameter(index, "nprobe", nprobe)
+
+
+class AnnIndex:
+    # Wraps the exact index of a LangChain FAISS store. Writes go to the exact index and
+    # a matching HNSW/IVF index is (re)built on a background thread; searches use it
+    # once it covers the current vectors and fall back to the exact index otherwise.
+    # Nothing is built until the first search, so a process that only writes (e.g. one
+    # publishing artifacts for readers) never pays for it.
+    def __init__(self, base, index_type=FAISS_INDEX_TYPE, ef_search=FAISS_EF_SEARCH, nprobe=FAISS_NPROBE):
+        self.base = base
+        self.index_type = index_type
+        self.ef_search = ef_search
+        self.nprobe = nprobe
+        self.ann = None
+        self.ann_type = "flat"
+        self._version = 0
+        self._ann_version = -1
+        self._changed_at = 0.0
+        self._building = False
+        self._searched = False
+        self._lock = threading.Lock()
+
+    @property
+    def d(self):
+        return self.base.d
+
+    @property
+    def ntotal(self):
+        return self.base.ntotal
+
+    def _bytes_per_vector(self):
+        if isinstance(self.base, (QuantizedIndex, ReducedIndex)):
+            return self.base.bytes_per_vector()
+        return self.base.d * 4
+
+    def _target_type(self):
+        if self.index_type != "auto":
+            return self.index_type
+        return choose_index_type(self.base.ntotal, self._bytes_per_vector())
+
+    def _changed(self):
+        self._version += 1
+        self._changed_at = time.monotonic()
+        self._schedule()
+
+    def _schedule(self):
+        if self._building or not self._searched or self._target_type() == "flat":
+            return
+        self._building = True
+        threading.Thread(target=self._rebuild, name="ann-index-build", daemon=True).start()
+
+    def _rebuild(self):
+        try:
+            while True:
+                quiet = REBUILD_DELAY - (time.monotonic() - self._changed_at)
+                if quiet > 0:
+                    time.sleep(quiet)
+                    continue
+                version = self._version
+                index_type, ann = self._build(version)
+                with self._lock:
+                    if ann is not None and version == self._version:
+                        self.ann, self.ann_type, self._ann_version = ann, index_type, version
+                    if self._ann_version == self._version or self._target_type() == "flat":
+                        self._building = False
+                        return
+        except Exception as e:
+            logging.error(f"ANN index build failed: {str(e)}")
+            with self._lock:
+                self._building = False
+
+    def _build(self, version):
+        start = time.perf_counter()
+        count = self.base.ntotal
+        index_type = self._target_type()
+        mode = self.base.mode if isinstance(self.base, QuantizedIndex) else ""
+        # A reduced index is accelerated in its reduced space
+        source = self.base.inner if isinstance(self.base, ReducedIndex) else self.base
+        ann = faiss.index_factory(source.d, index_factory_string(index_type, count, source.d, mode))
+        if index_type == "hnsw":
+            ann.hnsw.efConstruction = 80
+
+        # Copy vectors in slices so a change mid-build aborts early and memory stays bounded
+        def slices(step=1):
+            for i in range(0, count, BUILD_BATCH):
+                with self._lock:
+                    if version != self._version:
+                        return
+                    vectors = source.reconstruct_n(i, min(BUILD_BATCH, count - i))
+                yield np.ascontiguousarray(vectors[::step])
+
+        if not ann.is_trained:
+            # Train on an evenly strided sample of about 100k vectors
+            sample = list(slices(max(1, count // 100_000)))
+            if version != self._version:
+                return index_type, None
+            ann.train(np.concatenate(sample))
+        for vectors in slices():
+            ann.add(vectors)
+        if version != self._version:
+            return index_type, None
+
+        set_search_params(ann, self.ef_search, self.nprobe)
+        logging.info(f"Built {index_type} index for {count} vectors in {time.perf_counter() - start:.1f}s")
+        return index_type, ann
+
+    def set_search_params(self, ef_search=None, nprobe=None):
+        self.ef_search = ef_search if ef_search is not None else self.ef_search
+        self.nprobe = nprobe if nprobe is not None else self.nprobe
+        if self.ann is not None:
+            set_search_params(self.ann, self.ef_search, self.nprobe)
+
+    def add(self, x):
+        with self._lock:
+            self.base.add(x)
+            self._changed()
+
+    def remove_ids(self, ids):
+        with self._lock:
+            removed = self.base.remove_ids(ids)
+            self._changed()
+        return removed
+
+    def reconstruct(self, i):
+        return self.base.reconstruct(i)
+
+    def reconstruct_n(self, i0, n):
+        return self.base.reconstruct_n(i0, n)
+
+    def _current_ann(self):
+        ann = self.ann
+        if ann is not None and self._ann_version == self._version:
+            return ann
+        if not self._searched:
+            with self._lock:
+                self._searched = True
+                self._schedule()
+        return None
+
+    def _search_ann(self, ann, x, k, params=None):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if isinstance(self.base, QuantizedIndex) and self.base.rerank > 1:
+            _, candidates = ann.search(x, self.base._candidates(k, self.base.ntotal), params=params)
+            return self.base.rerank_candidates(x, candidates, k)
+        if isinstance(self.base, ReducedIndex):
+            return ann.search(self.base.apply(x), k, params=params)
+        return ann.search(x, k, params=params)
+
+    def search_subset(self, x, k, positions):
+        ann = self._current_ann()
+        # A subset small enough to scan within the latency target (one document, say) is
+        # searched exactly; a larger one goes through the ANN index with a selector
+        if ann is None or choose_index_type(len(positions), self._bytes_per_vector()) == "flat":
+            return search_subset(self.base, x, k, positions)
+        sel = faiss.IDSelectorBatch(np.asarray(positions, dtype=np.int64))
+        if "HNSW" in type(ann).__name__:
+            params = faiss.SearchParametersHNSW(sel=sel, efSearch=max(self.ef_search, k))
+        else:
+            params = faiss.SearchParametersIVF(sel=sel, nprobe=self.nprobe)
+        return self._search_ann(ann, x, k, params)
+
+    def search(self, x, k):
+        ann = self._current_ann()
+        # Requests for a large share of the index scan it exactly
+        if ann is None or k * 4 >= self.base.ntotal:
+            return self.base.search(x, k)
+        return self._search_ann(ann, x, k)
+
+
+def _measure(index, queries, k, flat_labels):
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, flat_labels):
+        start = time.perf_counter()
+        _, labels = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(labels[0]) & set(expected))
+    return hits / flat_labels.size, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+if __name__ == "__main__":
+    # Recall and latency trade-off: python ann_index.py [count] [dim]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    d = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+    k = 4
+    rng = np.random.RandomState(0)
+    centers = rng.randn(1000, d).astype(np.float32)
+    vectors = centers[rng.randint(0, 1000, count)] + 0.5 * rng.randn(count, d).astype(np.float32)
+    queries = vectors[rng.choice(count, 500, replace=False)] + 0.1 * rng.randn(500, d).astype(np.float32)
+
+    flat = faiss.IndexFlatL2(d)
+    flat.add(vectors)
+    _, flat_labels = flat.search(queries, k)
+    recall, p50, p99 = _measure(flat, queries, k, flat_labels)
+    print(f"auto choice for {count} x {d}: {choose_index_type(count, d * 4)}")
+    print(f"flat: recall@{k} {recall:.3f}, p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+    for index_type, param, values in [("hnsw", "ef_search", [16, 32, 64, 128]), ("ivf", "nprobe", [1, 4, 16, 64])]:
+        start = time.perf_counter()
+        index = AnnIndex(flat, index_type)
+        index.search(queries[:1], k)
+        while index.ann is None:
+            time.sleep(0.1)
+        print(f"{index_type}: built in the background in {time.perf_counter() - start:.1f}s")
+        for value in values:
+            index.set_search_params(**{param: value})
+            recall, p50, p99 = _measure(index, queries, k, flat_labels)
+            print(f"  {param}={value}: recall@{k} {recall:.3f}, p50 {p50:.2f} ms, p99 {p99:.2f} ms")
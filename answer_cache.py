@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+import threading
+from itertools import count
+from collections import OrderedDict
+import numpy as np
+
+# Cosine similarity above which two questions are treated as the same question
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 24 * 3600))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+
+
+class AnswerCache:
+    # Answers are stored per scope (usually a document id) together with the version of
+    # the indexed content they were generated from. A new version, e.g. after the document
+    # is re-ingested, drops every answer cached for that scope.
+    def __init__(self, embeddings, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, max_size=ANSWER_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._exact = {}
+        self._versions = {}
+        self._ids = count()
+        self._lock = threading.Lock()
+
+    def _vector(self, question):
+        # Goes through the query embedding cache, so retrieval reuses this vector
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    @staticmethod
+    def _key(question):
+        # Repeats differing only in case, spacing or a trailing "?" match without embedding
+        return " ".join(question.lower().split()).rstrip("?!. ")
+
+    def _drop(self, entry_id):
+        entry_scope, key = self._entries.pop(entry_id)[:2]
+        if self._exact.get((entry_scope, key)) == entry_id:
+            del self._exact[(entry_scope, key)]
+
+    def _check_version(self, scope, version):
+        if self._versions.get(scope) == version:
+            return
+        stale = [entry_id for entry_id, entry in self._entries.items() if entry[0] == scope]
+        for entry_id in stale:
+            self._drop(entry_id)
+        if stale:
+            self.invalidations += 1
+            logging.info(f"Dropped {len(stale)} cached answers for {scope}: content changed")
+        self._versions[scope] = version
+
+    def _hit(self, entry_id):
+        self._entries.move_to_end(entry_id)
+        self.hits += 1
+        return self._entries[entry_id][3]
+
+    def get(self, scope, version, question):
+        now = time.monotonic()
+        key = self._key(question)
+        with self._lock:
+            self._check_version(scope, version)
+            for entry_id, entry in list(self._entries.items()):
+                if now - entry[4] > self.ttl:
+                    self._drop(entry_id)
+            entry_id = self._exact.get((scope, key))
+            if entry_id is not None:
+                return self._hit(entry_id)
+            # With nothing cached for this scope a miss is certain; don't embed for it
+            if not any(entry[0] == scope for entry in self._entries.values()):
+                self.misses += 1
+                return None
+        try:
+            vector = self._vector(question)
+        except Exception as e:
+            # A failed lookup just means the question is answered the normal way
+            logging.warning(f"Answer cache lookup failed: {str(e)}")
+            return None
+        with self._lock:
+            best_id, best_similarity = None, self.threshold
+            for entry_id, (entry_scope, _, entry_vector, _, _) in self._entries.items():
+                if entry_scope != scope or entry_vector is None:
+                    continue
+                similarity = float(entry_vector @ vector)
+                if similarity >= best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+            if best_id is None:
+                self.misses += 1
+                return None
+            return self._hit(best_id)
+
+    def put(self, scope, version, question, answer):
+        key = self._key(question)
+        with self._lock:
+            self._check_version(scope, version)
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (scope, key, None, answer, time.monotonic())
+            self._exact[(scope, key)] = entry_id
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+        try:
+            vector = self._vector(question)
+        except Exception as e:
+            # The answer is still served for exact repeats, just not for paraphrases
+            logging.warning(f"Answer cache embedding failed: {str(e)}")
+            return
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is not None:
+                self._entries[entry_id] = entry[:2] + (vector,) + entry[3:]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,127 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_community.vectorstores import FAISS
+from chunk_dedup import NearDuplicateFilter
+from chroma_registry import registry
+
+# Per-provider defaults; batch sizes stay under each API's per-request input limit
+PROVIDER_LIMITS = {
+    "gemini": {"batch_size": 100, "max_workers": 4, "requests_per_minute": 1500},
+    "watsonx": {"batch_size": 50, "max_workers": 4, "requests_per_minute": 480},
+}
+
+# Chroma rejects single inserts above its client's max batch size
+CHROMA_INSERT_BATCH = 5000
+
+
+def provider_settings(provider):
+    settings = dict(PROVIDER_LIMITS[provider])
+    settings["batch_size"] = int(os.getenv("EMBED_BATCH_SIZE", settings["batch_size"]))
+    settings["max_workers"] = int(os.getenv("EMBED_MAX_WORKERS", settings["max_workers"]))
+    return settings
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def embed_batch(embeddings, texts, limiter, retries=3):
+    for attempt in range(retries):
+        limiter.wait()
+        try:
+            return embeddings.embed_documents(texts)
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            logging.warning(f"Embedding batch failed ({str(e)}), retrying")
+            time.sleep(2 ** attempt)
+
+
+def log_throughput(chunk_count, batch_count, elapsed):
+    logging.info(
+        f"Embedded {chunk_count} chunks in {batch_count} batches in {elapsed:.2f}s "
+        f"({chunk_count / elapsed if elapsed else 0:.1f} chunks/s)"
+    )
+
+
+def embed_in_batches(embeddings, texts, provider):
+    settings = provider_settings(provider)
+    batch_size = settings["batch_size"]
+    limiter = RateLimiter(settings["requests_per_minute"])
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    start = time.perf_counter()
+    vectors = []
+    # map() keeps results in input order while at most max_workers requests are in flight
+    with ThreadPoolExecutor(max_workers=settings["max_workers"]) as executor:
+        for batch_vectors in executor.map(lambda batch: embed_batch(embeddings, batch, limiter), batches):
+            vectors.extend(batch_vectors)
+    log_throughput(len(texts), len(batches), time.perf_counter() - start)
+    return vectors
+
+
+def add_to_chroma(store, texts, vectors, metadatas):
+    ids = [str(uuid.uuid4()) for _ in texts]
+    for i in range(0, len(texts), CHROMA_INSERT_BATCH):
+        end = i + CHROMA_INSERT_BATCH
+        batch_metadatas = metadatas[i:end]
+        store._collection.add(
+            ids=ids[i:end],
+            embeddings=vectors[i:end],
+            documents=texts[i:end],
+            # Chroma rejects empty metadata dicts, e.g. chunks built from raw Confluence text
+            metadatas=batch_metadatas if all(batch_metadatas) else None,
+        )
+    return ids
+
+
+def embed_documents(documents, embeddings, provider):
+    # Near-duplicate chunks (repeated headers, footers, legal text) are never embedded
+    dedup = NearDuplicateFilter()
+    documents = list(dedup.filter(documents))
+    texts = [doc.page_content for doc in documents]
+    vectors = embed_in_batches(embeddings, texts, provider)
+    dedup.report("document", len(vectors[0]) if vectors else 0, provider_settings(provider)["batch_size"])
+    return documents, texts, vectors
+
+
+def build_faiss(documents, embeddings, provider):
+    documents, texts, vectors = embed_documents(documents, embeddings, provider)
+    return FAISS.from_embeddings(
+        list(zip(texts, vectors)),
+        embeddings,
+        metadatas=[doc.metadata for doc in documents],
+    )
+
+
+def new_chroma(embeddings):
+    # The default in-process client shares one "langchain" collection between every
+    # Chroma() instance, so each build gets a collection of its own. The caller owns it
+    # and hands it on or releases it through the registry once it is no longer needed.
+    return registry.create(embeddings)
+
+
+def build_chroma(documents, embeddings, provider):
+    documents, texts, vectors = embed_documents(documents, embeddings, provider)
+    store = new_chroma(embeddings)
+    try:
+        add_to_chroma(store, texts, vectors, [doc.metadata for doc in documents])
+    except Exception:
+        registry.release(store)
+        raise
+    return store
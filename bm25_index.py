@@ -0,0 +1,194 @@
+import os
+import re
+import math
+import logging
+import threading
+from collections import Counter, defaultdict
+from contextlib import nullcontext
+from typing import Any, Callable, Optional
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Reciprocal rank fusion constant; 60 is the usual default
+RRF_K = 60
+# The top lexical hit must score this many times the runner-up to skip the embedding call
+LEXICAL_CONFIDENCE_RATIO = float(os.getenv("LEXICAL_CONFIDENCE_RATIO", 2.0))
+
+# Words plus identifiers such as ERR_1042, PROJ-123 or v2.4.1 kept whole
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+# Tokens with a digit that are not short bare numbers look like codes, keys or versions
+_IDENTIFIER = re.compile(r"^(?=.*\d)(?=.*[a-z]|.{3,})")
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def tokenize(text):
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        tokens.append(token)
+        # Compound identifiers also match on their parts
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[-_.]", token) if part)
+    return tokens
+
+
+class BM25Index:
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.doc_ids = {}
+        self.terms = {}
+        self.total_length = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add(self, key, text, doc_id=None):
+        counts = Counter(tokenize(text))
+        with self._lock:
+            for term, tf in counts.items():
+                self.postings[term][key] = tf
+            self.lengths[key] = sum(counts.values())
+            self.doc_ids[key] = doc_id
+            self.terms[key] = list(counts)
+            self.total_length += self.lengths[key]
+
+    def remove_document(self, doc_id):
+        with self._lock:
+            for key in [key for key, owner in self.doc_ids.items() if owner == doc_id]:
+                for term in self.terms.pop(key):
+                    self.postings[term].pop(key, None)
+                    if not self.postings[term]:
+                        del self.postings[term]
+                self.total_length -= self.lengths.pop(key)
+                del self.doc_ids[key]
+
+    def search(self, query, k, doc_id=None):
+        with self._lock:
+            count = len(self.lengths)
+            if not count:
+                return []
+            avg_length = self.total_length / count
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for key, tf in postings.items():
+                    if doc_id is not None and self.doc_ids[key] != doc_id:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[key] / avg_length)
+                    scores[key] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+def is_confident(query, results, documents):
+    # Only identifier-style queries (error codes, ticket keys, versions) skip the vectors,
+    # and only when one chunk contains all of them and clearly outscores the rest
+    identifiers = [token for token in _TOKEN.findall(query.lower()) if _IDENTIFIER.search(token)]
+    if not identifiers or not results:
+        return False
+    if not set(identifiers) <= set(tokenize(documents[0].page_content)):
+        return False
+    runner_up = results[1][1] if len(results) > 1 else 0.0
+    return results[0][1] >= LEXICAL_CONFIDENCE_RATIO * runner_up
+
+
+def _doc_key(doc):
+    return doc.page_content, doc.metadata.get("doc_id"), doc.metadata.get("page")
+
+
+def reciprocal_rank_fusion(result_lists, k):
+    scores = defaultdict(float)
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = _doc_key(doc)
+            scores[key] += 1.0 / (RRF_K + rank + 1)
+            docs.setdefault(key, doc)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:k]]
+
+
+def hybrid_stats():
+    with _stats_lock:
+        total = _stats["lexical_only"] + _stats["hybrid"]
+        return {**_stats, "lexical_only_rate": _stats["lexical_only"] / total if total else 0.0}
+
+
+class HybridRetriever(BaseRetriever):
+    vector_retriever: BaseRetriever
+    bm25: BM25Index
+    # Resolves a list of BM25 keys to their Documents
+    lookup: Callable
+    doc_id: Optional[str] = None
+    k: int = 4
+    # Read lock of a corpus that changes while serving. The query is embedded outside it,
+    # so a waiting writer doesn't hold new questions behind in-flight embedding calls;
+    # the vector retriever then has to search by vector (see mmr.vector_retriever).
+    lock: Any = None
+
+    def _lexical(self, query):
+        results = self.bm25.search(query, self.k * 2, self.doc_id)
+        return results, self.lookup([key for key, _ in results])
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        with self.lock.read() if self.lock is not None else nullcontext():
+            results, lexical = self._lexical(query)
+        if is_confident(query, results, lexical):
+            with _stats_lock:
+                _stats["lexical_only"] += 1
+            logging.info("Lexical match is confident, skipping the embedding call")
+            return lexical[:self.k]
+
+        with _stats_lock:
+            _stats["hybrid"] += 1
+        if self.lock is None:
+            return reciprocal_rank_fusion([self.vector_retriever.invoke(query), lexical], self.k)
+        vector = self.vector_retriever.embed(query)
+        with self.lock.read():
+            # BM25 again, so both halves see the same version of the corpus
+            _, lexical = self._lexical(query)
+            return reciprocal_rank_fusion([self.vector_retriever.search(vector), lexical], self.k)
+
+
+def bm25_from_faiss(store):
+    bm25 = BM25Index()
+    for key, doc in store.docstore._dict.items():
+        bm25.add(key, doc.page_content, doc.metadata.get("doc_id"))
+    return bm25
+
+
+def bm25_from_chroma(store):
+    bm25 = BM25Index()
+    data = store._collection.get(include=["documents", "metadatas"])
+    for key, text, metadata in zip(data["ids"], data["documents"], data["metadatas"]):
+        bm25.add(key, text, (metadata or {}).get("doc_id"))
+    return bm25
+
+
+def faiss_lookup(store):
+    return lambda keys: [store.docstore.search(key) for key in keys]
+
+
+def chroma_lookup(store):
+    def lookup(keys):
+        if not keys:
+            return []
+        data = store._collection.get(ids=keys, include=["documents", "metadatas"])
+        found = {
+            key: Document(page_content=text, metadata=metadata or {})
+            for key, text, metadata in zip(data["ids"], data["documents"], data["metadatas"])
+        }
+        return [found[key] for key in keys if key in found]
+    return lookup
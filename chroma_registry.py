@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import uuid
+import logging
+import threading
+from langchain_community.vectorstores import Chroma
+
+# The default in-process Chroma client keeps every collection it ever created in memory,
+# so collections built for one document or page have to be deleted when they go out of use.
+# Deleting is not enough on its own: the client also caches loaded HNSW indexes, one
+# entry per 5 allowed open files (tens of thousands), and a dropped collection's index
+# stays in that cache. The registry's client keeps only this many.
+CHROMA_HNSW_CACHE_SIZE = int(os.getenv("CHROMA_HNSW_CACHE_SIZE", 16))
+
+
+def bounded_client():
+    # chromadb has no setting for the cache size: the in-process API derives it from the
+    # open file limit when constructed and hands it to its engine in start(). Building
+    # the system here leaves room to set it in between; other APIs (e.g. before 1.0)
+    # have no such cache and are started unchanged.
+    from chromadb.api import ServerAPI
+    from chromadb.api.client import Client
+    from chromadb.config import Settings, System
+
+    system = System(Settings())
+    api = system.instance(ServerAPI)
+    if hasattr(api, "hnsw_cache_size"):
+        api.hnsw_cache_size = min(api.hnsw_cache_size, CHROMA_HNSW_CACHE_SIZE)
+    system.start()
+    return Client.from_system(system)
+
+
+def rss_mb():
+    # Resident set size of this process
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ChromaRegistry:
+    # Named, reference-counted collections. create() hands the caller the first
+    # reference; whoever the store is passed on to (a published pipeline, the document
+    # index) takes it over, acquire() adds holders, and the collection is deleted from
+    # the client when the last holder calls release().
+    def __init__(self, prefix="ingest"):
+        self.prefix = prefix
+        self.created = 0
+        self.dropped = 0
+        self._collections = {}
+        self._lock = threading.Lock()
+        # Built on first use, so FAISS-only bots never load chromadb. Same default
+        # settings as a plain Chroma(), which then shares this client.
+        self._client = None
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = bounded_client()
+            return self._client
+
+    def create(self, embeddings, name=None):
+        name = name or f"{self.prefix}-{uuid.uuid4().hex}"
+        store = Chroma(client=self.client(), collection_name=name, embedding_function=embeddings)
+        with self._lock:
+            self._collections[name] = {"store": store, "refs": 1, "created": time.time()}
+            self.created += 1
+        return store
+
+    def acquire(self, store):
+        with self._lock:
+            entry = self._collections.get(store._collection.name)
+            if entry is None:
+                raise KeyError(f"Chroma collection {store._collection.name} is not managed or already dropped")
+            entry["refs"] += 1
+        return store
+
+    def release(self, store):
+        name = store._collection.name
+        with self._lock:
+            entry = self._collections.get(name)
+            if entry is None:
+                logging.warning(f"Released unmanaged Chroma collection {name}")
+                return
+            entry["refs"] -= 1
+            if entry["refs"] > 0:
+                return
+            del self._collections[name]
+            self.dropped += 1
+        store.delete_collection()
+        logging.info(f"Dropped Chroma collection {name}")
+
+    def names(self):
+        with self._lock:
+            return list(self._collections)
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._collections.values())
+            created, dropped = self.created, self.dropped
+        return {
+            "live": len(entries),
+            "created": created,
+            "dropped": dropped,
+            "chunks": sum(entry["store"]._collection.count() for entry in entries),
+            "oldest_s": time.time() - min((entry["created"] for entry in entries), default=time.time()),
+            "rss_mb": round(rss_mb(), 1),
+        }
+
+
+# One registry per process, like the in-process client it manages
+registry = ChromaRegistry()
+
+
+if __name__ == "__main__":
+    # Soak test: python chroma_registry.py [switches] [chunks per document] [--leak]
+    # Every switch builds a new collection, publishes a pipeline that owns it and retires
+    # the previous one while a question may still be running against it, as the
+    # Confluence bots do. With --leak the old collections are never released.
+    import numpy as np
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from batch_embed import add_to_chroma
+    from retrieval_pipeline import PipelineSlot, RetrievalPipeline
+
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    switches = int(args[0]) if args else 1000
+    chunks = int(args[1]) if len(args) > 1 else 200
+    leak = "--leak" in sys.argv
+    embeddings = DeterministicFakeEmbedding(size=384)
+    rng = np.random.RandomState(0)
+    slot = PipelineSlot()
+    texts = [f"chunk {i} " + "lorem ipsum " * 60 for i in range(chunks)]
+
+    samples = []
+    previous = None
+    start = time.perf_counter()
+    for switch in range(1, switches + 1):
+        store = registry.create(embeddings)
+        add_to_chroma(store, texts, rng.randn(chunks, 384).astype(np.float32).tolist(), [{"page": i} for i in range(chunks)])
+        pipeline = RetrievalPipeline(chain=None, scope=f"doc{switch}")
+        if not leak:
+            pipeline.on_close = lambda store=store: registry.release(store)
+        # A question that started on the previous document finishes after the switch
+        in_flight = slot.acquire()
+        slot.publish(pipeline)
+        if in_flight is not None:
+            # Still readable by the running question, dropped as soon as it finishes
+            assert previous._collection.count() == chunks
+            slot.release(in_flight)
+            assert leak or previous._collection.name not in registry.names()
+        previous = store
+        if switch % max(1, switches // 10) == 0:
+            stats = registry.stats()
+            samples.append(stats["rss_mb"])
+            print(f"switch {switch}: {stats['live']} live collections, {stats['chunks']} chunks, RSS {stats['rss_mb']} MB")
+
+    elapsed = time.perf_counter() - start
+    growth = samples[-1] - samples[0]
+    print(f"{switches} switches in {elapsed:.1f}s, RSS {samples[0]} -> {samples[-1]} MB ({growth:+.1f} MB after the first sample)")
+    if not leak and registry.stats()["live"] > 1:
+        print("FAIL: retired collections were not dropped")
+        sys.exit(1)
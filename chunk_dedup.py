@@ -0,0 +1,75 @@
+import os
+import math
+import zlib
+import logging
+import numpy as np
+
+# Chunks whose estimated Jaccard similarity to an earlier chunk reaches this are dropped.
+# Neighbouring chunks only share their chunk_overlap, which stays well below it.
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.9))
+SHINGLE_SIZE = 5
+NUM_PERM = 64
+# 16 bands of 4 rows: pairs above ~0.5 similarity land in a shared bucket
+BANDS = 16
+
+_PRIME = np.uint64((1 << 32) - 5)
+_rng = np.random.RandomState(1)
+_A = _rng.randint(1, 1 << 31, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, NUM_PERM).astype(np.uint64)
+
+
+def minhash(text):
+    words = text.lower().split()
+    if len(words) < SHINGLE_SIZE:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+class NearDuplicateFilter:
+    # One filter per document; boilerplate repeated across its pages is embedded once
+    def __init__(self, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.kept = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self._signatures = []
+        self._buckets = [{} for _ in range(BANDS)]
+
+    def is_duplicate(self, text):
+        signature = minhash(text)
+        rows = NUM_PERM // BANDS
+        keys = [signature[band * rows:(band + 1) * rows].tobytes() for band in range(BANDS)]
+
+        candidates = set()
+        for bucket, key in zip(self._buckets, keys):
+            candidates.update(bucket.get(key, ()))
+        for candidate in candidates:
+            if np.mean(self._signatures[candidate] == signature) >= self.threshold:
+                self.dropped += 1
+                self.dropped_bytes += len(text.encode("utf-8"))
+                return True
+
+        for bucket, key in zip(self._buckets, keys):
+            bucket.setdefault(key, []).append(len(self._signatures))
+        self._signatures.append(signature)
+        self.kept += 1
+        return False
+
+    def filter(self, docs):
+        for doc in docs:
+            if not self.is_duplicate(doc.page_content):
+                yield doc
+
+    def report(self, name, dim, batch_size):
+        # Each dropped chunk saves its share of an embedding request plus its vector and text in the index
+        total = self.kept + self.dropped
+        calls_saved = math.ceil(total / batch_size) - math.ceil(self.kept / batch_size)
+        bytes_saved = self.dropped * dim * 4 + self.dropped_bytes
+        logging.info(
+            f"Dedup {name}: dropped {self.dropped} of {total} chunks, "
+            f"saved {calls_saved} embedding requests and {bytes_saved / 1024:.1f} KB of index"
+        )
+        return {"chunks": total, "dropped": self.dropped, "embedding_calls_saved": calls_saved, "index_bytes_saved": bytes_saved}
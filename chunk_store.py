@@ -0,0 +1,450 @@
+import os
+import sys
+import copy
+import glob
+import json
+import mmap
+import time
+import logging
+import threading
+from collections.abc import Mapping
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.base import AddableMixin, Docstore
+
+# Chunk text of the FAISS corpora lives in one append-only file per index, read through
+# mmap; CHUNK_STORE_COMPRESSION=zstd compresses each chunk (needs the zstandard package)
+CHUNK_STORE_COMPRESSION = os.getenv("CHUNK_STORE_COMPRESSION", "")
+ZSTD_LEVEL = 3
+# Deleted chunks leave their text behind until it outweighs the live text
+COMPACT_RATIO = 0.5
+
+
+class _Column:
+    # Append-only numpy array that grows by doubling. Readers take view() and keep a
+    # valid array while the column grows, since growing allocates a new buffer.
+    def __init__(self, dtype, data=None):
+        self.data = np.asarray(data, dtype=dtype) if data is not None else np.empty(1024, dtype=dtype)
+        self.n = len(data) if data is not None else 0
+
+    def append(self, value):
+        if self.n == len(self.data):
+            grown = np.empty(max(1024, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.n] = self.data[:self.n]
+            self.data = grown
+        self.data[self.n] = value
+        self.n += 1
+
+    def view(self):
+        return self.data[:self.n]
+
+    def __len__(self):
+        return self.n
+
+
+class _Arena:
+    # Chunk texts back to back in one file; row i is bytes offsets[i]:offsets[i] + lengths[i]
+    def __init__(self, path, compression, offsets=None, lengths=None):
+        self.path = path
+        self.compression = compression
+        self.offsets = _Column(np.int64, offsets)
+        self.lengths = _Column(np.int32, lengths)
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._file = open(path, "ab")
+        self._map = None
+        self._lock = threading.Lock()
+
+    def _encode(self, text):
+        data = text.encode("utf-8")
+        if self.compression == "zstd":
+            import zstandard
+            data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        return data
+
+    def _decode(self, data):
+        if self.compression == "zstd":
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return data.decode("utf-8")
+
+    def append(self, texts):
+        for text in texts:
+            data = self._encode(text)
+            self._file.write(data)
+            self.offsets.append(self.size)
+            self.lengths.append(len(data))
+            self.size += len(data)
+        # Readers map the file, so new text must be out of the write buffer
+        self._file.flush()
+
+    def skip(self):
+        # Placeholder for a row without text, e.g. a deleted chunk after compaction
+        self.offsets.append(self.size)
+        self.lengths.append(0)
+
+    def _mapped(self, end):
+        current = self._map
+        if current is not None and len(current) >= end:
+            return current
+        with self._lock:
+            if self._map is None or len(self._map) < end:
+                with open(self.path, "rb") as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map
+
+    def read(self, row):
+        offset = int(self.offsets.data[row])
+        length = int(self.lengths.data[row])
+        if length == 0:
+            return ""
+        return self._decode(self._mapped(offset + length)[offset:offset + length])
+
+    def close(self):
+        self._file.close()
+
+
+class _ChunkView(Mapping):
+    # Read-only stand-in for InMemoryDocstore._dict; every access builds a new Document
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, chunk_id):
+        row = self.store._row(chunk_id)
+        if row is None:
+            raise KeyError(chunk_id)
+        return self.store._document(row)
+
+    def __iter__(self):
+        return (str(row) for row in self.store.rows())
+
+    def __len__(self):
+        return len(self.store)
+
+
+class ChunkStore(Docstore, AddableMixin):
+    # Compact docstore for large FAISS corpora. Chunk ids are row numbers handed out by
+    # next_ids(); text is in a memory-mapped arena, and every metadata key is an int32
+    # column of codes into that key's distinct values. Document objects are only built
+    # for the chunks a search returns.
+    def __init__(self, folder_path, compression=CHUNK_STORE_COMPRESSION):
+        os.makedirs(folder_path, exist_ok=True)
+        self.folder_path = folder_path
+        self.compression = compression
+        self.alive = _Column(np.uint8)
+        self.columns = {}
+        self.values = {}
+        self._codes = {}
+        self.dead_bytes = 0
+        self._lock = threading.Lock()
+        self._arena = _Arena(self._arena_path(time.time_ns()), compression)
+        self._rank = None
+
+    def _arena_path(self, generation):
+        return os.path.join(self.folder_path, f"chunks-{generation}.arena")
+
+    # Writing
+
+    def next_ids(self, n):
+        with self._lock:
+            start = len(self.alive)
+        return [str(row) for row in range(start, start + n)]
+
+    def _code(self, key, value):
+        encoded = json.dumps(value, sort_keys=True, default=str)
+        codes = self._codes.setdefault(key, {})
+        code = codes.get(encoded)
+        if code is None:
+            values = self.values.setdefault(key, [])
+            code = codes[encoded] = len(values)
+            values.append(value)
+        if key not in self.columns:
+            # A key first seen now is missing (-1) on every earlier row
+            self.columns[key] = _Column(np.int32, np.full(len(self.alive), -1, dtype=np.int32))
+        return code
+
+    def add(self, texts):
+        # texts maps chunk id to Document, as FAISS passes it; ids must come from next_ids()
+        with self._lock:
+            expected = [str(row) for row in range(len(self.alive), len(self.alive) + len(texts))]
+            if list(texts) != expected:
+                raise ValueError("ChunkStore ids must be the row numbers returned by next_ids()")
+            self._arena.append(doc.page_content for doc in texts.values())
+            for doc in texts.values():
+                codes = {key: self._code(key, value) for key, value in doc.metadata.items()}
+                for key, column in self.columns.items():
+                    column.append(codes.get(key, -1))
+                self.alive.append(1)
+            self._rank = None
+
+    def delete(self, ids):
+        with self._lock:
+            alive = self.alive.view()
+            lengths = self._arena.lengths.view()
+            for chunk_id in ids:
+                row = int(chunk_id)
+                if alive[row]:
+                    alive[row] = 0
+                    self.dead_bytes += int(lengths[row])
+            self._rank = None
+
+    def set_metadata(self, ids, key, value):
+        with self._lock:
+            code = self._code(key, value)
+            column = self.columns[key].view()
+            for chunk_id in ids:
+                column[int(chunk_id)] = code
+
+    def compact(self, force=False):
+        # Rewrites the arena without the text of deleted chunks. Row numbers, and so chunk
+        # ids, stay the same. The previous file is kept until the next compaction because
+        # the last saved index may still point into it.
+        with self._lock:
+            old = self._arena
+            if not force and self.dead_bytes <= COMPACT_RATIO * max(old.size, 1):
+                return False
+            new = _Arena(self._arena_path(time.time_ns()), self.compression)
+            alive = self.alive.view()
+            for row in range(len(alive)):
+                if alive[row]:
+                    # Already encoded: copied as is
+                    offset, length = int(old.offsets.data[row]), int(old.lengths.data[row])
+                    data = old._mapped(offset + length)[offset:offset + length] if length else b""
+                    new._file.write(data)
+                    new.offsets.append(new.size)
+                    new.lengths.append(len(data))
+                    new.size += len(data)
+                else:
+                    new.skip()
+            new._file.flush()
+            self._arena = new
+            old.close()
+            freed = old.size - new.size
+            self.dead_bytes = 0
+        for path in glob.glob(os.path.join(self.folder_path, "chunks-*.arena")):
+            if path not in (old.path, new.path):
+                os.remove(path)
+        logging.info(f"Compacted chunk store {self.folder_path}: {freed} bytes of deleted text dropped")
+        return True
+
+    # Reading
+
+    def _row(self, chunk_id):
+        try:
+            row = int(chunk_id)
+        except (TypeError, ValueError):
+            return None
+        alive = self.alive.view()
+        return row if 0 <= row < len(alive) and alive[row] else None
+
+    def text(self, row):
+        return self._arena.read(row)
+
+    def metadata(self, row):
+        metadata = {}
+        for key, column in self.columns.items():
+            code = column.data[row]
+            if code >= 0:
+                value = self.values[key][code]
+                # Values are shared between rows; lists and dicts are handed out as copies
+                metadata[key] = copy.deepcopy(value) if isinstance(value, (list, dict)) else value
+        return metadata
+
+    def _document(self, row):
+        return Document(page_content=self.text(row), metadata=self.metadata(row))
+
+    def search(self, search):
+        row = self._row(search)
+        if row is None:
+            return f"ID {search} not found."
+        return self._document(row)
+
+    def matches(self, chunk_id, filter):
+        # Metadata filter on the columns, without building the Document
+        row = self._row(chunk_id)
+        if row is None:
+            return False
+        for key, value in filter.items():
+            code = self._codes.get(key, {}).get(json.dumps(value, sort_keys=True, default=str))
+            if code is None or self.columns[key].data[row] != code:
+                return False
+        return True
+
+    def rows(self, **conditions):
+        mask = self.alive.view() == 1
+        for key, value in conditions.items():
+            code = self._codes.get(key, {}).get(json.dumps(value, sort_keys=True, default=str))
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            mask &= self.columns[key].view()[:len(mask)] == code
+        return np.flatnonzero(mask)
+
+    def ids(self, **conditions):
+        return [str(row) for row in self.rows(**conditions)]
+
+    def positions(self, filter):
+        # FAISS index positions of the live chunks matching filter, so a search can be
+        # restricted to them. The index holds exactly the live rows in row order (adds
+        # append, deletes keep the order), so a row's position is the number of live
+        # rows before it.
+        with self._lock:
+            if self._rank is None:
+                self._rank = np.cumsum(self.alive.view(), dtype=np.int64) - 1
+            rank = self._rank
+        return rank[self.rows(**filter)]
+
+    def distinct(self, key):
+        # Values of one metadata key over the live chunks, e.g. every indexed doc_id
+        column = self.columns.get(key)
+        if column is None:
+            return set()
+        codes = np.unique(column.view()[self.alive.view()[:len(column)] == 1])
+        return {self.values[key][code] for code in codes if code >= 0}
+
+    def first(self, key, **conditions):
+        rows = self.rows(**conditions)
+        if not len(rows) or key not in self.columns:
+            return None
+        code = self.columns[key].data[rows[0]]
+        return self.values[key][code] if code >= 0 else None
+
+    def __len__(self):
+        return int(self.alive.view().sum())
+
+    @property
+    def _dict(self):
+        return _ChunkView(self)
+
+    def stats(self):
+        n = len(self.alive)
+        column_bytes = sum(column.n * column.data.itemsize for column in self.columns.values())
+        return {
+            "chunks": len(self),
+            "arena_bytes": self._arena.size,
+            "dead_bytes": self.dead_bytes,
+            "row_bytes": n * (8 + 4 + 1) + column_bytes,
+            "distinct_values": {key: len(values) for key, values in self.values.items()},
+        }
+
+    # Persistence: FAISS.save_local pickles the docstore, the arena stays where it is
+
+    def __getstate__(self):
+        with self._lock:
+            return {
+                "folder_path": self.folder_path,
+                "compression": self.compression,
+                "arena": os.path.basename(self._arena.path),
+                "offsets": self._arena.offsets.view().copy(),
+                "lengths": self._arena.lengths.view().copy(),
+                "alive": self.alive.view().copy(),
+                "columns": {key: column.view().copy() for key, column in self.columns.items()},
+                "values": self.values,
+                "dead_bytes": self.dead_bytes,
+            }
+
+    def __setstate__(self, state):
+        self.folder_path = state["folder_path"]
+        self.compression = state["compression"]
+        self.alive = _Column(np.uint8, state["alive"])
+        self.columns = {key: _Column(np.int32, column) for key, column in state["columns"].items()}
+        self.values = state["values"]
+        self._codes = {
+            key: {json.dumps(value, sort_keys=True, default=str): code for code, value in enumerate(values)}
+            for key, values in self.values.items()
+        }
+        self.dead_bytes = state["dead_bytes"]
+        self._lock = threading.Lock()
+        self._rank = None
+        arena_path = os.path.join(self.folder_path, state["arena"])
+        # Text appended after the last save belongs to no saved row; cut it off
+        size = int(state["offsets"][-1] + state["lengths"][-1]) if len(state["offsets"]) else 0
+        if os.path.exists(arena_path) and os.path.getsize(arena_path) > size:
+            os.truncate(arena_path, size)
+        self._arena = _Arena(arena_path, self.compression, state["offsets"], state["lengths"])
+        # Files from earlier compactions that this save no longer points into
+        for path in glob.glob(os.path.join(self.folder_path, "chunks-*.arena")):
+            if path != arena_path:
+                os.remove(path)
+
+    @classmethod
+    def from_faiss(cls, store, folder_path, compression=CHUNK_STORE_COMPRESSION):
+        # Moves a store's chunks out of an InMemoryDocstore, in index order, and points
+        # the store at the new ids
+        chunks = cls(folder_path, compression)
+        positions = sorted(store.index_to_docstore_id)
+        ids = chunks.next_ids(len(positions))
+        for i in range(0, len(positions), 10000):
+            batch = positions[i:i + 10000]
+            chunks.add({ids[i + j]: store.docstore.search(store.index_to_docstore_id[p]) for j, p in enumerate(batch)})
+        store.docstore = chunks
+        store.index_to_docstore_id = {p: ids[i] for i, p in enumerate(positions)}
+        return store
+
+
+if __name__ == "__main__":
+    # Memory and lookup cost against InMemoryDocstore: python chunk_store.py [chunks] [zstd]
+    import tempfile
+    import tracemalloc
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    compression = sys.argv[2] if len(sys.argv) > 2 else ""
+    words = [f"word{i}" for i in range(5000)]
+
+    def chunks_of(seed):
+        # The same chunks for every store: ~1 KB of text, metadata as the bots tag it
+        rng = np.random.RandomState(seed)
+        for i in range(n):
+            text = " ".join(words[j] for j in rng.randint(0, len(words), 120))
+            yield str(i), Document(page_content=text, metadata={
+                "source": f"/tmp/doc{i // 400}.pdf", "page": (i // 4) % 100,
+                "doc_id": f"doc{i // 400}.pdf", "doc_hash": f"{i // 400:064x}",
+            })
+
+    def heap_growth(build):
+        # Bytes still allocated once build() returns, its temporaries freed
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        result = build()
+        growth = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+        tracemalloc.stop()
+        return result, growth
+
+    def fill(chunks):
+        batch = {}
+        for chunk_id, doc in chunks_of(0):
+            batch[chunk_id] = doc
+            if len(batch) == 10000:
+                chunks.add(batch)
+                batch = {}
+        if batch:
+            chunks.add(batch)
+        return chunks
+
+    memory, dict_bytes = heap_growth(lambda: InMemoryDocstore(dict(chunks_of(0))))
+    text_bytes = sum(len(doc.page_content) for doc in memory._dict.values())
+    rng = np.random.RandomState(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chunks, store_bytes = heap_growth(lambda: fill(ChunkStore(tmp, compression)))
+
+        keys = [str(k) for k in rng.randint(0, n, 20000)]
+        timings = {}
+        for name, docstore in [("InMemoryDocstore", memory), ("ChunkStore", chunks)]:
+            start = time.perf_counter()
+            for key in keys:
+                docstore.search(key)
+            timings[name] = (time.perf_counter() - start) / len(keys) * 1e6
+        same = all(memory.search(key) == chunks.search(key) for key in keys[:2000])
+
+        start = time.perf_counter()
+        rows = chunks.rows(doc_id="doc7.pdf")
+        filter_ms = (time.perf_counter() - start) * 1000
+        stats = chunks.stats()
+
+    print(f"{n} chunks, {text_bytes / 1e6:.1f} MB of text, compression={compression or 'none'}")
+    print(f"  InMemoryDocstore: {dict_bytes / 1e6:.1f} MB on the heap, {timings['InMemoryDocstore']:.1f} us/lookup")
+    print(
+        f"  ChunkStore: {store_bytes / 1e6:.1f} MB on the heap + {stats['arena_bytes'] / 1e6:.1f} MB mapped arena, "
+        f"{timings['ChunkStore']:.1f} us/lookup"
+    )
+    print(f"  identical documents: {same}; doc_id filter over all rows: {filter_ms:.2f} ms ({len(rows)} rows)")
@@ -0,0 +1,145 @@
+import sys
+import time
+import random
+from collections import deque
+from langchain.text_splitter import RecursiveCharacterTextSplitter, TextSplitter
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", " ", ""]
+
+
+class LinearTextSplitter(TextSplitter):
+    # Produces the same chunks as RecursiveCharacterTextSplitter (keep_separator=True),
+    # but works on offsets into the original text: no substring copies or re-joins
+    # until a chunk is emitted, O(1) window slides, and character-level spans are
+    # windowed arithmetically instead of one character at a time.
+    # For token-based chunking use LinearTextSplitter.from_tiktoken_encoder(...)
+    def __init__(self, separators=None, **kwargs):
+        super().__init__(**kwargs)
+        self._separators = separators or DEFAULT_SEPARATORS
+        self._char_lengths = self._length_function is len
+
+    def split_text(self, text):
+        chunks = []
+        self._split(text, 0, len(text), 0, chunks)
+        return chunks
+
+    def _length(self, text, start, end):
+        if self._char_lengths:
+            return end - start
+        return self._length_function(text[start:end])
+
+    def _split(self, text, start, end, level, chunks):
+        separators = self._separators
+        # The first separator present in this span, falling back to the last one
+        while level < len(separators) - 1 and separators[level] and text.find(separators[level], start, end) == -1:
+            level += 1
+        separator = separators[level]
+        has_next = separator != "" and level < len(separators) - 1
+
+        if separator == "" and self._char_lengths and self._chunk_size > 1:
+            self._char_windows(text, start, end, chunks)
+            return
+
+        good = []
+        for piece_start, piece_end in self._pieces(text, start, end, separator):
+            length = self._length(text, piece_start, piece_end)
+            if length < self._chunk_size:
+                good.append((piece_start, piece_end, length))
+                continue
+            if good:
+                self._merge(text, good, chunks)
+                good = []
+            if has_next:
+                self._split(text, piece_start, piece_end, level + 1, chunks)
+            else:
+                chunks.append(text[piece_start:piece_end])
+        if good:
+            self._merge(text, good, chunks)
+
+    def _pieces(self, text, start, end, separator):
+        # Each separator stays attached to the start of the piece that follows it
+        if separator == "":
+            for i in range(start, end):
+                yield i, i + 1
+            return
+        piece_start = start
+        found = text.find(separator, start, end)
+        while found != -1:
+            if found > piece_start:
+                yield piece_start, found
+            piece_start = found
+            found = text.find(separator, found + len(separator), end)
+        if end > piece_start:
+            yield piece_start, end
+
+    def _emit(self, text, start, end, chunks):
+        chunk = text[start:end]
+        if self._strip_whitespace:
+            chunk = chunk.strip()
+        if chunk:
+            chunks.append(chunk)
+
+    def _merge(self, text, pieces, chunks):
+        # Pieces are adjacent, so a chunk is just the span from the first to the last one
+        window = deque()
+        total = 0
+        for start, end, length in pieces:
+            if total + length > self._chunk_size and window:
+                self._emit(text, window[0][0], window[-1][1], chunks)
+                while total > self._chunk_overlap or (total + length > self._chunk_size and total > 0):
+                    total -= window.popleft()[2]
+            window.append((start, end, length))
+            total += length
+        if window:
+            self._emit(text, window[0][0], window[-1][1], chunks)
+
+    def _char_windows(self, text, start, end, chunks):
+        # Merging single characters slides a chunk_size window by chunk_size - chunk_overlap
+        step = self._chunk_size - self._chunk_overlap
+        while True:
+            self._emit(text, start, min(start + self._chunk_size, end), chunks)
+            if start + self._chunk_size >= end:
+                return
+            start += step
+
+
+def _random_text(rng, size):
+    words = ["alpha", "beta", "gamma", "delta", "x" * 1500, "epsilon", "zeta" * 40]
+    separators = [" ", " ", " ", "\n", "\n\n", "  ", "\n \n"]
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        parts.append(rng.choice(words))
+        parts.append(rng.choice(separators))
+    return "".join(parts)
+
+
+if __name__ == "__main__":
+    # Equivalence check and benchmark: python chunker.py [file.pdf|file.txt ...]
+    rng = random.Random(0)
+    corpus = [_random_text(rng, rng.randint(0, 20000)) for _ in range(200)]
+    for path in sys.argv[1:]:
+        if path.endswith(".pdf"):
+            from pdf_extract import extract_pdf_text
+            with open(path, "rb") as f:
+                corpus.append(extract_pdf_text(f.read()))
+        else:
+            with open(path, encoding="utf-8", errors="ignore") as f:
+                corpus.append(f.read())
+
+    mismatches = 0
+    for chunk_size, chunk_overlap in [(1000, 200), (500, 0), (100, 99), (2000, 400), (50, 10)]:
+        reference = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        linear = LinearTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        for text in corpus:
+            if reference.split_text(text) != linear.split_text(text):
+                mismatches += 1
+    print(f"Equivalence: {mismatches} mismatching texts")
+
+    reference = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    linear = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    total_chars = sum(len(text) for text in corpus)
+    for name, splitter in [("recursive", reference), ("linear", linear)]:
+        start = time.perf_counter()
+        chunk_count = sum(len(splitter.split_text(text)) for text in corpus)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {chunk_count} chunks in {elapsed:.2f}s ({total_chars / elapsed / 1e6:.1f} MB/s)")
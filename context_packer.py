@@ -0,0 +1,158 @@
+import os
+import logging
+import threading
+from collections import Counter
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+# Tokens of retrieved context allowed into the prompt, per model. CONTEXT_TOKEN_BUDGET
+# overrides the table for every model.
+CONTEXT_BUDGETS = {
+    "llama3-8b-8192": 1500,
+    "ibm/granite-13b-chat-v2": 1000,
+    "gemini-pro": 2000,
+}
+DEFAULT_CONTEXT_BUDGET = 1500
+# Chunks that share at least this many characters at their edges are stitched together
+MIN_OVERLAP = 20
+# Rough English average; close enough for budgeting without a tokenizer dependency
+CHARS_PER_TOKEN = 4
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def model_name(llm):
+    name = getattr(llm, "model_name", None) or getattr(llm, "model_id", None) or getattr(llm, "model", None)
+    return str(name).lower().removeprefix("models/") if name else None
+
+
+def context_budget(llm):
+    if os.getenv("CONTEXT_TOKEN_BUDGET"):
+        return int(os.getenv("CONTEXT_TOKEN_BUDGET"))
+    return CONTEXT_BUDGETS.get(model_name(llm), DEFAULT_CONTEXT_BUDGET)
+
+
+def _overlap(a, b):
+    # Length of the longest suffix of a that is also a prefix of b
+    probe = b[:MIN_OVERLAP]
+    if len(probe) < MIN_OVERLAP:
+        return 0
+    i = a.find(probe, max(0, len(a) - len(b)))
+    while i != -1:
+        if b.startswith(a[i:]):
+            return len(a) - i
+        i = a.find(probe, i + 1)
+    return 0
+
+
+def _group(doc):
+    # Only chunks cut from the same page of the same document can be neighbours
+    metadata = doc.metadata
+    return metadata.get("doc_id"), metadata.get("source"), metadata.get("page")
+
+
+def _join(a, b):
+    # The text of a and b merged into one passage, or None when they are not neighbours
+    overlap = _overlap(a, b)
+    if overlap:
+        return a + b[overlap:]
+    overlap = _overlap(b, a)
+    if overlap:
+        return b + a[overlap:]
+    return None
+
+
+def pack_documents(documents, budget):
+    # documents arrive best first. Each chunk costs only the tokens it adds: text already
+    # in the prompt through an overlapping neighbour or a duplicate is free, and chunks
+    # that would overflow the budget are dropped while lower-ranked smaller ones may still fit.
+    passages = []
+    used = 0
+    duplicates = dropped = 0
+    for doc in documents:
+        text = doc.page_content.strip()
+        group = _group(doc)
+        neighbours = [p for p in passages if p["group"] == group]
+        if not text or any(text in p["text"] for p in neighbours):
+            duplicates += 1
+            continue
+
+        target, merged = None, None
+        for passage in neighbours:
+            merged = _join(passage["text"], text)
+            if merged is not None:
+                target = passage
+                break
+        cost = estimate_tokens(merged) - estimate_tokens(target["text"]) if target else estimate_tokens(text)
+        if used + cost > budget:
+            if passages:
+                dropped += 1
+                continue
+            # Even the best chunk is too long: keep as much of it as fits
+            text = text[:budget * CHARS_PER_TOKEN]
+            cost = estimate_tokens(text)
+
+        used += cost
+        if target is None:
+            passages.append({"group": group, "text": text, "metadata": doc.metadata, "chunks": 1})
+            continue
+        target["text"] = merged
+        target["chunks"] += 1
+        # The new chunk may bridge two passages that were apart until now
+        for other in [p for p in neighbours if p is not target]:
+            bridged = _join(target["text"], other["text"])
+            if bridged is not None:
+                used += estimate_tokens(bridged) - estimate_tokens(target["text"]) - estimate_tokens(other["text"])
+                target["text"] = bridged
+                target["chunks"] += other["chunks"]
+                passages.remove(other)
+
+    packed = [
+        Document(page_content=p["text"], metadata={**p["metadata"], "merged_chunks": p["chunks"]})
+        for p in passages
+    ]
+    retrieved = sum(estimate_tokens(doc.page_content) for doc in documents)
+    report = {
+        "chunks": len(documents),
+        "passages": len(packed),
+        "duplicates": duplicates,
+        "dropped": dropped,
+        "retrieved_tokens": retrieved,
+        "prompt_tokens": used,
+        "saved_tokens": retrieved - used,
+    }
+    return packed, report
+
+
+def context_stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+class PackedRetriever(BaseRetriever):
+    # Sits between a retriever and a "stuff" chain so only the packed context is prompted
+    retriever: BaseRetriever
+    budget: int = DEFAULT_CONTEXT_BUDGET
+
+    def _pack(self, documents):
+        packed, report = pack_documents(documents, self.budget)
+        with _stats_lock:
+            _stats["requests"] += 1
+            for key in ["retrieved_tokens", "prompt_tokens", "saved_tokens"]:
+                _stats[key] += report[key]
+        logging.info(
+            f"Packed {report['chunks']} chunks into {report['passages']} passages: "
+            f"{report['prompt_tokens']}/{self.budget} tokens, {report['saved_tokens']} saved"
+        )
+        return packed
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self._pack(self.retriever.invoke(query))
+
+    async def _aget_relevant_documents(self, query, *, run_manager=None):
+        return self._pack(await self.retriever.ainvoke(query))
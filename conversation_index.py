@@ -0,0 +1,90 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from langchain_community.vectorstores import FAISS
+
+# Evicted conversation indexes are written here and loaded again on the next question
+CONVERSATION_INDEX_DIR = os.getenv("CONVERSATION_INDEX_DIR", "conversation_index")
+CONVERSATION_INDEX_MAX_BYTES = int(os.getenv("CONVERSATION_INDEX_MAX_BYTES", 512 * 1024 * 1024))
+
+
+def index_bytes(store):
+    # float32 vectors plus chunk text dominate a flat FAISS index's footprint
+    vector_bytes = store.index.ntotal * store.index.d * 4
+    text_bytes = sum(len(doc.page_content) for doc in store.docstore._dict.values())
+    return vector_bytes + text_bytes
+
+
+class ConversationIndexes:
+    def __init__(self, embeddings, name, max_bytes=CONVERSATION_INDEX_MAX_BYTES):
+        self.embeddings = embeddings
+        self.path = os.path.join(CONVERSATION_INDEX_DIR, name)
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self.spills = 0
+        self.reloads = 0
+        self._resident = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _spill_path(self, conversation_id):
+        # Conversation ids contain characters that are not safe in file names
+        return os.path.join(self.path, hashlib.sha256(conversation_id.encode("utf-8")).hexdigest()[:32])
+
+    def select(self, conversation_id, doc_id, store):
+        with self._lock:
+            self._drop(conversation_id)
+            shutil.rmtree(self._spill_path(conversation_id), ignore_errors=True)
+            self._admit(conversation_id, doc_id, store)
+
+    def get(self, conversation_id):
+        with self._lock:
+            if conversation_id in self._resident:
+                self._resident.move_to_end(conversation_id)
+                doc_id, store, _ = self._resident[conversation_id]
+                return doc_id, store
+
+            path = self._spill_path(conversation_id)
+            if not os.path.isdir(path):
+                return None, None
+            with open(os.path.join(path, "doc_id.txt"), encoding="utf-8") as f:
+                doc_id = f.read()
+            store = FAISS.load_local(path, self.embeddings, allow_dangerous_deserialization=True)
+            self.reloads += 1
+            logging.info(f"Reloaded spilled index for conversation {conversation_id} ({doc_id})")
+            self._admit(conversation_id, doc_id, store)
+            return doc_id, store
+
+    def _admit(self, conversation_id, doc_id, store):
+        nbytes = index_bytes(store)
+        self._resident[conversation_id] = (doc_id, store, nbytes)
+        self.resident_bytes += nbytes
+        # Spill least recently used conversations, but never the one just admitted
+        while self.resident_bytes > self.max_bytes and len(self._resident) > 1:
+            evicted_id, (evicted_doc, evicted_store, _) = next(iter(self._resident.items()))
+            path = self._spill_path(evicted_id)
+            if not os.path.isdir(path):
+                evicted_store.save_local(path)
+                with open(os.path.join(path, "doc_id.txt"), "w", encoding="utf-8") as f:
+                    f.write(evicted_doc)
+            self._drop(evicted_id)
+            self.spills += 1
+            logging.info(f"Spilled index for conversation {evicted_id} ({evicted_doc}) to disk")
+
+    def _drop(self, conversation_id):
+        entry = self._resident.pop(conversation_id, None)
+        if entry:
+            self.resident_bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "resident": len(self._resident),
+                "resident_bytes": self.resident_bytes,
+                "max_bytes": self.max_bytes,
+                "spills": self.spills,
+                "reloads": self.reloads,
+            }
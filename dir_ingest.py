@@ -0,0 +1,84 @@
+import os
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from index_cache import file_hash
+
+DIR_INGEST_WORKERS = int(os.getenv("DIR_INGEST_WORKERS", 4))
+
+
+def _scan(directory):
+    found = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(".pdf") and not name.startswith("."):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found[os.path.relpath(path, directory)] = {"size": stat.st_size, "mtime": stat.st_mtime}
+    return found
+
+
+def sync_directory(directory, doc_index, build, workers=DIR_INGEST_WORKERS):
+    # build(file_path) returns a per-document store for doc_index.add()
+    os.makedirs(doc_index.path, exist_ok=True)
+    manifest_path = os.path.join(doc_index.path, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    lock = threading.Lock()
+
+    def save_manifest():
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    found = _scan(directory) if os.path.isdir(directory) else {}
+    summary = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0}
+
+    indexed = doc_index.documents()
+    for doc_id in (set(manifest) | indexed) - set(found):
+        doc_index.delete(doc_id)
+        manifest.pop(doc_id, None)
+        summary["removed"] += 1
+        logging.info(f"Removed {doc_id} from the index")
+
+    changed = []
+    for doc_id, stat in found.items():
+        entry = manifest.get(doc_id)
+        # Size and mtime match: trust the manifest without reading the file
+        if entry and entry["size"] == stat["size"] and entry["mtime"] == stat["mtime"] and doc_id in indexed:
+            summary["unchanged"] += 1
+            continue
+        content_hash = file_hash(os.path.join(directory, doc_id))
+        if entry and entry["hash"] == content_hash and doc_id in indexed:
+            manifest[doc_id] = {**stat, "hash": content_hash}
+            summary["unchanged"] += 1
+            continue
+        changed.append((doc_id, stat, content_hash, "updated" if entry else "added"))
+
+    def ingest(item):
+        doc_id, stat, content_hash, kind = item
+        try:
+            # The index is written once at the end; files missing from it are re-ingested next time
+            doc_index.add(doc_id, content_hash, build(os.path.join(directory, doc_id)), save=False)
+        except Exception as e:
+            logging.error(f"Failed to ingest {doc_id}: {str(e)}")
+            with lock:
+                summary["failed"] += 1
+            return
+        with lock:
+            manifest[doc_id] = {**stat, "hash": content_hash}
+            summary[kind] += 1
+            # Saved after every file so an interrupted sync keeps what it finished
+            save_manifest()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(ingest, changed))
+
+    doc_index.save()
+    save_manifest()
+    logging.info(f"Directory sync of {directory}: {summary}")
+    return summary
@@ -0,0 +1,311 @@
+import os
+import copy
+import logging
+import threading
+from contextlib import contextmanager
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS, Chroma
+from batch_embed import add_to_chroma
+from quantized_index import FAISS_QUANTIZATION, QuantizedFAISS, QuantizedIndex
+from reduced_index import FAISS_REDUCED_DIM, FAISS_REDUCTION, ReducedFAISS, ReducedIndex
+from ann_index import AnnIndex
+from index_artifact import write_artifact
+from bm25_index import BM25Index, HybridRetriever, bm25_from_chroma, bm25_from_faiss, chroma_lookup, faiss_lookup
+from mmr import vector_retriever
+from chunk_store import ChunkStore
+from chroma_registry import registry
+
+# Each bot keeps its corpus in a sub-directory named after it
+DOC_INDEX_DIR = os.getenv("DOC_INDEX_DIR", "doc_index")
+
+
+class ReadWriteLock:
+    # Any number of readers or one writer. A waiting writer holds off new readers so a
+    # steady stream of questions cannot starve ingestion. Not re-entrant.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class DocumentIndex:
+    def __init__(self, embeddings, store_type, name, quantization=FAISS_QUANTIZATION, publish=False,
+                 reduction=FAISS_REDUCTION, reduced_dim=FAISS_REDUCED_DIM):
+        # publish: also write a read-only mmap artifact that other processes open with SharedIndex
+        # reduction: store and search vectors at reduced_dim wide, fitted on this corpus
+        self.embeddings = embeddings
+        self.store_type = store_type
+        self.name = name
+        self.publish = publish and store_type == "faiss"
+        self.path = os.path.join(DOC_INDEX_DIR, name)
+        self.quantization = quantization if store_type == "faiss" else ""
+        # Quantization already compresses the vectors; the two are not combined
+        self.reduction = reduction if store_type == "faiss" and not self.quantization else ""
+        self.reduced_dim = reduced_dim
+        # _lock serializes writers (and saves); _rw keeps searches out while the store
+        # is changed in place
+        self._lock = threading.Lock()
+        self._rw = ReadWriteLock()
+        self.store = None
+        if store_type == "chroma":
+            self.store = Chroma(collection_name="documents", embedding_function=embeddings, persist_directory=self.path)
+        elif QuantizedFAISS.exists(self.path):
+            self.store = QuantizedFAISS.load_local(self.path, embeddings, mode=self.quantization or None)
+            logging.info(f"Loaded {self.store.index.mode} document index from {self.path}")
+        elif ReducedFAISS.exists(self.path):
+            self.store = ReducedFAISS.load_local(self.path, embeddings, method=self.reduction, dim=self.reduced_dim)
+            logging.info(f"Loaded {self.store.index.method} {self.store.index.inner.d}-dim document index from {self.path}")
+        elif os.path.exists(os.path.join(self.path, "index.faiss")):
+            self.store = FAISS.load_local(self.path, embeddings, allow_dangerous_deserialization=True)
+            logging.info(f"Loaded document index from {self.path}")
+            if self.quantization:
+                self.store = QuantizedFAISS.from_faiss(self.store, self.quantization, self.path)
+                self.store.save_local(self.path)
+            elif self.reduction:
+                # Fitted on every vector already in the corpus
+                self.store = ReducedFAISS.from_faiss(self.store, self.reduction, self.reduced_dim)
+                self.store.save_local(self.path)
+        if self.store is not None and store_type == "faiss":
+            if not isinstance(self.store.docstore, ChunkStore):
+                # Chunk text moves out of Python objects into the mapped arena
+                ChunkStore.from_faiss(self.store, self.path)
+                self.store.save_local(self.path)
+                logging.info(f"Moved {self.path} to a compact chunk store")
+            self.store.index = AnnIndex(self.store.index)
+        self.bm25 = self._build_bm25()
+
+    def _build_bm25(self):
+        # Keyword postings are cheap to rebuild from the stored chunk texts
+        if self.store is None:
+            return BM25Index()
+        if self.store_type == "chroma":
+            return bm25_from_chroma(self.store)
+        return bm25_from_faiss(self.store)
+
+    def _lookup(self, keys):
+        if self.store_type == "chroma":
+            return chroma_lookup(self.store)(keys)
+        return faiss_lookup(self.store)(keys)
+
+    def _faiss_ids(self, doc_id, content_hash=None):
+        if self.store is None:
+            return []
+        if content_hash is None:
+            return self.store.docstore.ids(doc_id=doc_id)
+        return self.store.docstore.ids(doc_id=doc_id, doc_hash=content_hash)
+
+    def _chroma_where(self, doc_id, content_hash=None):
+        if content_hash is None:
+            return {"doc_id": doc_id}
+        return {"$and": [{"doc_id": doc_id}, {"doc_hash": content_hash}]}
+
+    def has(self, doc_id, content_hash=None):
+        with self._rw.read():
+            if self.store_type == "faiss":
+                return bool(self._faiss_ids(doc_id, content_hash))
+            return bool(self.store._collection.get(where=self._chroma_where(doc_id, content_hash), limit=1)["ids"])
+
+    def version(self, doc_id):
+        # Content hash of the indexed copy of a document, None when it is not indexed
+        with self._rw.read():
+            if self.store is None:
+                return None
+            if self.store_type == "faiss":
+                return self.store.docstore.first("doc_hash", doc_id=doc_id)
+            metadatas = self.store._collection.get(where={"doc_id": doc_id}, limit=1, include=["metadatas"])["metadatas"]
+            return (metadatas[0] or {}).get("doc_hash") if metadatas else None
+
+    def chunks(self, doc_id):
+        with self._rw.read():
+            if self.store is None:
+                return 0
+            if self.store_type == "faiss":
+                return len(self._faiss_ids(doc_id))
+            return len(self.store._collection.get(where={"doc_id": doc_id}, include=[])["ids"])
+
+    def documents(self):
+        with self._rw.read():
+            if self.store is None:
+                return set()
+            if self.store_type == "faiss":
+                return self.store.docstore.distinct("doc_id")
+            metadatas = self.store._collection.get(include=["metadatas"])["metadatas"]
+            return {metadata["doc_id"] for metadata in metadatas if metadata and "doc_id" in metadata}
+
+    def add(self, doc_id, content_hash, store, save=True, replace=True):
+        # Copy the chunks of a freshly built per-document store into the corpus,
+        # tagged so they can be filtered on and later deleted or replaced.
+        # replace=False appends to the chunks already indexed for the document.
+        tag = {"doc_id": doc_id, "doc_hash": content_hash}
+        if self.store_type == "faiss":
+            ntotal = store.index.ntotal
+            vectors = store.index.reconstruct_n(0, ntotal).tolist()
+            docs = [store.docstore.search(store.index_to_docstore_id[i]) for i in range(ntotal)]
+            texts = [doc.page_content for doc in docs]
+            metadatas = [{**doc.metadata, **tag} for doc in docs]
+        else:
+            data = store._collection.get(include=["embeddings", "documents", "metadatas"])
+            vectors = [list(vector) for vector in data["embeddings"]]
+            texts = data["documents"]
+            metadatas = [{**(metadata or {}), **tag} for metadata in data["metadatas"]]
+            # The chunks are copied out; the per-document collection is not needed any more
+            registry.release(store)
+
+        with self._lock:
+            with self._rw.write():
+                if replace:
+                    self._delete(doc_id)
+                if self.store_type == "chroma":
+                    keys = add_to_chroma(self.store, texts, vectors, metadatas)
+                else:
+                    if self.store is None:
+                        self.store = self._new_faiss(len(vectors[0]))
+                    keys = self.store.add_embeddings(
+                        list(zip(texts, vectors)), metadatas=metadatas, ids=self.store.docstore.next_ids(len(texts))
+                    )
+                for key, text in zip(keys, texts):
+                    self.bm25.add(key, text, doc_id)
+            if save:
+                self._save()
+        logging.info(f"Indexed document '{doc_id}' ({len(texts)} chunks)")
+
+    def _new_faiss(self, d):
+        if self.quantization:
+            store = QuantizedFAISS.empty(self.embeddings, d, self.quantization, self.path)
+        elif self.reduction:
+            store = ReducedFAISS.empty(self.embeddings, d, self.reduction, self.reduced_dim)
+        else:
+            store = FAISS(self.embeddings, faiss.IndexFlatL2(d), InMemoryDocstore(), {})
+        store.docstore = ChunkStore(self.path)
+        # Searches move to an HNSW or IVF index built in the background once the corpus is large
+        store.index = AnnIndex(store.index)
+        return store
+
+    def _delete(self, doc_id):
+        if self.store is None:
+            return
+        self.bm25.remove_document(doc_id)
+        if self.store_type == "faiss":
+            ids = self._faiss_ids(doc_id)
+            if ids:
+                self.store.delete(ids)
+        else:
+            self.store._collection.delete(where={"doc_id": doc_id})
+
+    def set_version(self, doc_id, content_hash):
+        # Re-tag every chunk of a document, e.g. once a progressive ingestion completes
+        with self._lock:
+            if self.store is None:
+                return
+            with self._rw.write():
+                if self.store_type == "faiss":
+                    self.store.docstore.set_metadata(self._faiss_ids(doc_id), "doc_hash", content_hash)
+                else:
+                    data = self.store._collection.get(where={"doc_id": doc_id}, include=["metadatas"])
+                    if data["ids"]:
+                        metadatas = [{**(metadata or {}), "doc_hash": content_hash} for metadata in data["metadatas"]]
+                        self.store._collection.update(ids=data["ids"], metadatas=metadatas)
+            self._save()
+
+    def delete(self, doc_id):
+        with self._lock:
+            with self._rw.write():
+                self._delete(doc_id)
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        # Chroma persists on write; FAISS is written out as a whole. Only the exact
+        # index is saved, the ANN index is rebuilt from it after loading. Called with
+        # _lock held: writing the files only reads the store, so questions keep running
+        if self.store_type == "faiss" and self.store is not None:
+            # Removed quantized vectors are dropped into a new file first, then it and the
+            # compacted arena are swapped in while no question is reading either
+            base = self.store.index.base
+            with self._rw.read():
+                vectors_path = base.compacted() if isinstance(base, QuantizedIndex) else None
+            with self._rw.write():
+                self.store.docstore.compact()
+                if vectors_path is not None:
+                    base.switch(vectors_path)
+            with self._rw.read():
+                exact = copy.copy(self.store)
+                exact.index = self.store.index.base
+                exact.save_local(self.path)
+                if self.publish:
+                    write_artifact(self.store, self.name)
+
+    @property
+    def reduced(self):
+        # Only projected vectors are kept, so load_document returns lossy reconstructions
+        return self.store is not None and isinstance(getattr(self.store.index, "base", None), ReducedIndex)
+
+    def load_document(self, doc_id):
+        # Build a small in-memory index of one document's chunks from the stored vectors
+        with self._rw.read():
+            if self.store is None:
+                return None
+            if self.store_type == "faiss":
+                chunk_ids = set(self._faiss_ids(doc_id))
+                positions = [i for i, chunk_id in self.store.index_to_docstore_id.items() if chunk_id in chunk_ids]
+                vectors = [self.store.index.reconstruct(i).tolist() for i in positions]
+                docs = [self.store.docstore.search(self.store.index_to_docstore_id[i]) for i in positions]
+                texts = [doc.page_content for doc in docs]
+                metadatas = [doc.metadata for doc in docs]
+            else:
+                data = self.store._collection.get(where={"doc_id": doc_id}, include=["embeddings", "documents", "metadatas"])
+                vectors = [list(vector) for vector in data["embeddings"]]
+                texts = data["documents"]
+                metadatas = data["metadatas"]
+        if not texts:
+            return None
+        return FAISS.from_embeddings(list(zip(texts, vectors)), self.embeddings, metadatas=metadatas)
+
+    def as_retriever(self, doc_id=None, k=4):
+        # Vector and BM25 results are fused; identifier lookups may skip the vectors entirely
+        # Searches run under the read lock (faiss does not support searching an index while
+        # another thread changes it), and a document is replaced (or a progressive step
+        # added) in one write: a retrieval sees the old or the new copy of a document,
+        # never neither or a mix, and BM25 keys resolve to the chunks the vector search sees
+        return HybridRetriever(
+            vector_retriever=vector_retriever(self.store, k, {"doc_id": doc_id} if doc_id is not None else None, by_vector=True),
+            bm25=self.bm25,
+            lookup=self._lookup,
+            doc_id=doc_id,
+            k=k,
+            lock=self._rw,
+        )
@@ -4,11 +4,15 @@ import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain, RetrievalQA
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.document_loaders import PyPDFLoader
+from langchain.chains import LLMChain
+from chunker import LinearTextSplitter
+from ingest_pipeline import stream_pdf_to_chroma
+from doc_index import DocumentIndex
+from index_cache import file_hash
 from langchain_ibm import WatsonxLLM, WatsonxEmbeddings
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, qa_pipeline
 from ibm_watsonx_ai.foundation_models.utils.enums import EmbeddingTypes, ModelTypes
 from ibm_watsonx_ai.metanames import GenTextParamsMetaNames as GenParams
 from ibm_watsonx_ai.foundation_models.utils.enums import DecodingMethods
@@ -45,50 +49,65 @@ llm = WatsonxLLM(
     }
 )
 
-embeddings = WatsonxEmbeddings(
-    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
-    url=watsonx_url,
-    apikey=watsonx_api_key,
-    project_id=project_id
+# Chunk vectors are cached on disk so re-selected documents only embed changed chunks
+embeddings = CachedEmbeddings(
+    WatsonxEmbeddings(
+        model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
+        url=watsonx_url,
+        apikey=watsonx_api_key,
+        project_id=project_id
+    ),
+    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value
 )
 
-# Global variable to store vector store
-docsearch = None
-
-def setup_vector_store(file_path):
-    global docsearch
-
-    # Load and process the uploaded PDF
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    # Create Chroma vector store
-    docsearch = Chroma.from_documents(final_documents, embeddings)
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "chroma", "dscrd_watsonx_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
+current_pdf = None
+
+def publish_pipeline(doc_id):
+    # Built only after ingestion completes, so questions never see a partially indexed document
+    pipeline.publish(qa_pipeline(llm, doc_index.as_retriever(doc_id), doc_id, doc_index.version(doc_id)))
+
+def setup_vector_store(file_path, doc_id):
+    global current_pdf
+
+    # A document already in the corpus with the same contents is not embedded again
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        publish_pipeline(doc_id)
+        current_pdf = doc_id
+        return
+
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    doc_index.add(doc_id, content_hash, stream_pdf_to_chroma(file_path, text_splitter, embeddings, provider="watsonx"))
+    publish_pipeline(doc_id)
+    current_pdf = doc_id
 
 def get_answer(question):
-    if docsearch is None:
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please upload a PDF file first."
 
-    # Set up a RetrievalQA chain
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=docsearch.as_retriever(),
-        chain_type="stuff",  # Use "map_reduce" or "refine" for larger documents
-    )
+    # Repeated questions about an unchanged document skip retrieval and generation
+    cached = answer_cache.get(current.scope, current.version, question)
+    if cached is not None:
+        return cached
 
     start = time.process_time()
     try:
         # Run the chain with the question
-        response = qa_chain({"query": question})
+        answer = current.invoke(question)
         print("Response time:", time.process_time() - start)
-        return response.get('result', 'No output found')
+        answer_cache.put(current.scope, current.version, question, answer)
+        return answer
     except Exception as e:
         print(f"Error during retrieval: {e}")
         return "An error occurred while retrieving the answer."
@@ -120,7 +139,7 @@ async def on_message(message):
                 with open(file_path, "wb") as f:
                     f.write(response.content)
                 # Process the PDF to create a vector store
-                setup_vector_store(file_path)
+                setup_vector_store(file_path, file_name)
                 await message.channel.send(f"PDF {file_name} has been processed and is ready for queries.")
             else:
                 await message.channel.send("Failed to download the file.")
@@ -128,7 +147,7 @@ async def on_message(message):
             await message.channel.send(f"An error occurred: {e}")
 
     elif isinstance(message.channel, discord.DMChannel):
-        if docsearch is None:
+        if current_pdf is None:
             await message.channel.send("No document has been processed yet. Please upload a PDF file first.")
         else:
             user_question = message.content
@@ -147,7 +166,7 @@ async def process_pdf(ctx, file_url: str):
             file_path = os.path.join("pdfs", file_name)
             with open(file_path, "wb") as f:
                 f.write(response.content)
-            setup_vector_store(file_path)
+            setup_vector_store(file_path, file_name)
             await ctx.send(f"PDF {file_name} has been processed and is ready for queries.")
         else:
             await ctx.send("Failed to download the file.")
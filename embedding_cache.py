@@ -0,0 +1,149 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+
+# Chunk vectors are shared by every bot on the host through one SQLite file
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+# Question vectors are kept in memory only: popular questions repeat within hours, not weeks
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 2048))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 3600))
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_query(text):
+    # Case and spacing differences should not cost another embedding call
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryCache:
+    def __init__(self, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, vector, seconds):
+        with self._lock:
+            self.miss_seconds += seconds
+            self._entries[key] = (vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            avg_miss = self.miss_seconds / self.misses if self.misses else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+                # Each hit saved roughly one average embedding round-trip
+                "saved_latency_s": self.hits * avg_miss,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings, model_id, db_path=EMBEDDING_CACHE_PATH):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.hits = 0
+        self.misses = 0
+        self.queries = QueryCache()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model_id TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model_id, text_hash))"
+        )
+        self._conn.commit()
+
+    def _lookup(self, hashes):
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model_id = ? AND text_hash IN ({placeholders})",
+                    [self.model_id, *batch],
+                )
+                for h, blob in rows:
+                    found[h] = array("f", blob).tolist()
+        return found
+
+    def _store(self, items):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model_id, text_hash, vector) VALUES (?, ?, ?)",
+                [(self.model_id, h, array("f", vector).tobytes()) for h, vector in items],
+            )
+            self._conn.commit()
+
+    def embed_documents(self, texts):
+        hashes = [text_hash(text) for text in texts]
+        cached = self._lookup(list(set(hashes)))
+
+        # Only texts we have never embedded with this model go to the provider
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = text
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self._store(new_items)
+            cached.update(new_items)
+
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        logging.info(f"Embedding cache: {len(texts) - len(missing)} of {len(texts)} chunks reused")
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text):
+        key = (self.model_id, normalize_query(text))
+        vector = self.queries.get(key)
+        if vector is None:
+            start = time.perf_counter()
+            vector = self.embeddings.embed_query(text)
+            self.queries.put(key, vector, time.perf_counter() - start)
+        return vector
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "queries": self.queries.stats(),
+            }
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import logging
+import threading
+from collections.abc import Mapping
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from bm25_index import BM25Index, HybridRetriever
+from mmr import vector_retriever
+from reduced_index import TRANSFORM_FILE, ReducedIndex
+
+# Published read-only snapshots of document indexes, one sub-directory per index name.
+# Every process that opens one maps the same files, so the page cache holds one copy.
+INDEX_ARTIFACT_DIR = os.getenv("INDEX_ARTIFACT_DIR", "index_artifacts")
+# Older versions are kept briefly for readers that have not switched yet
+KEEP_VERSIONS = 2
+# ...and for this many seconds after they were superseded, so a reader that has just
+# read CURRENT can still open the version it names
+PRUNE_GRACE = float(os.getenv("INDEX_ARTIFACT_PRUNE_GRACE", 30))
+# Tries to open the version named by CURRENT, should it be pruned in between anyway
+REFRESH_ATTEMPTS = 3
+WRITE_BATCH = 65536
+
+
+def _write_records(path, records):
+    # Variable-length records: one blob file plus an int64 offsets file
+    offsets = [0]
+    with open(f"{path}.bin", "wb") as f:
+        for record in records:
+            data = record.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.asarray(offsets, dtype=np.int64).tofile(f"{path}.offsets")
+
+
+def write_artifact(store, name, artifact_dir=INDEX_ARTIFACT_DIR):
+    root = os.path.join(artifact_dir, name)
+    version = f"v{time.time_ns()}"
+    tmp = os.path.join(root, f".{version}")
+    os.makedirs(tmp)
+
+    count = store.index.ntotal
+    d = store.index.d
+    source = store.index
+    reduced = getattr(source, "base", source)
+    if isinstance(reduced, ReducedIndex) and reduced.transform is not None:
+        # Kept at the reduced width; readers project queries the same way
+        faiss.write_VectorTransform(reduced.transform, os.path.join(tmp, TRANSFORM_FILE))
+        source = reduced.inner
+    with open(os.path.join(tmp, "vectors.f32"), "wb") as vectors, open(os.path.join(tmp, "norms.f32"), "wb") as norms:
+        for i in range(0, count, WRITE_BATCH):
+            batch = np.ascontiguousarray(source.reconstruct_n(i, min(WRITE_BATCH, count - i)), dtype=np.float32)
+            vectors.write(batch.tobytes())
+            norms.write((batch ** 2).sum(axis=1).astype(np.float32).tobytes())
+
+    def docs():
+        return (store.docstore.search(store.index_to_docstore_id[i]) for i in range(count))
+
+    _write_records(os.path.join(tmp, "texts"), (doc.page_content for doc in docs()))
+    _write_records(os.path.join(tmp, "metadata"), (json.dumps(doc.metadata) for doc in docs()))
+    # Keyword postings keyed by position, so readers get hybrid retrieval without re-tokenizing
+    bm25 = BM25Index()
+    # Document of each position, so a filtered search only scans that document's vectors
+    doc_codes = {}
+    codes = np.empty(count, dtype=np.int32)
+    for i, doc in enumerate(docs()):
+        doc_id = doc.metadata.get("doc_id")
+        bm25.add(str(i), doc.page_content, doc_id)
+        codes[i] = doc_codes.setdefault(doc_id, len(doc_codes))
+    with open(os.path.join(tmp, "bm25.pkl"), "wb") as f:
+        pickle.dump(bm25, f)
+    codes.tofile(os.path.join(tmp, "doc_ids.i32"))
+    with open(os.path.join(tmp, "doc_ids.json"), "w") as f:
+        json.dump(list(doc_codes), f)
+    with open(os.path.join(tmp, "header.json"), "w") as f:
+        json.dump({"count": count, "d": d}, f)
+
+    # Readers follow CURRENT, so the new version appears all at once
+    os.rename(tmp, os.path.join(root, version))
+    with open(os.path.join(root, "CURRENT.tmp"), "w") as f:
+        f.write(version)
+    os.replace(os.path.join(root, "CURRENT.tmp"), os.path.join(root, "CURRENT"))
+
+    versions = sorted(v for v in os.listdir(root) if v.startswith("v"))
+    for old, successor in zip(versions[:-KEEP_VERSIONS], versions[1:]):
+        # Version names are publish times, so the successor's is when this one was superseded
+        if time.time_ns() - int(successor[1:]) < PRUNE_GRACE * 1e9:
+            continue
+        # Processes still mapping an old version keep their pages until they switch
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    logging.info(f"Published index artifact {name}/{version} ({count} chunks)")
+    return version
+
+
+class _Records:
+    def __init__(self, path):
+        self.offsets = np.fromfile(f"{path}.offsets", dtype=np.int64)
+        size = os.path.getsize(f"{path}.bin")
+        self.data = np.memmap(f"{path}.bin", dtype=np.uint8, mode="r") if size else b""
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+
+class MmapIndex:
+    # Exact L2 search straight over the mapped vectors: ||v||^2 - 2 v.q + ||q||^2. A reduced
+    # corpus is mapped at its reduced width: queries are projected and reconstructed
+    # vectors projected back, as in ReducedIndex
+    def __init__(self, path, count, d, transform=None):
+        self.d = d
+        self.ntotal = count
+        self.transform = transform
+        width = transform.d_out if transform is not None else d
+        if count:
+            self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(count, width))
+            self.norms = np.memmap(os.path.join(path, "norms.f32"), dtype=np.float32, mode="r")
+        else:
+            self.vectors = np.empty((0, width), dtype=np.float32)
+            self.norms = np.empty(0, dtype=np.float32)
+
+    def search(self, x, k):
+        return self.search_subset(x, k, None)
+
+    def search_subset(self, x, k, positions):
+        # Only the given positions are scanned, e.g. one document's chunks; None scans all
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if self.transform is not None:
+            x = self.transform.apply(x)
+        vectors, norms = (self.vectors, self.norms) if positions is None else (self.vectors[positions], self.norms[positions])
+        count = len(norms)
+        distances = np.full((len(x), k), np.finfo(np.float32).max, dtype=np.float32)
+        labels = np.full((len(x), k), -1, dtype=np.int64)
+        for row, query in enumerate(x):
+            scores = norms - 2 * (vectors @ query) + query @ query
+            n = min(k, count)
+            if n == 0:
+                continue
+            top = np.argpartition(scores, n - 1)[:n] if n < count else np.arange(count)
+            top = top[np.argsort(scores[top])]
+            distances[row, :n] = scores[top]
+            labels[row, :n] = top if positions is None else positions[top]
+        return distances, labels
+
+    def _unapply(self, x):
+        return x if self.transform is None else self.transform.reverse_transform(x)
+
+    def reconstruct(self, i):
+        return self._unapply(np.array(self.vectors[i:i + 1]))[0]
+
+    def reconstruct_n(self, i0, n):
+        return self._unapply(np.array(self.vectors[i0:i0 + n]))
+
+    def add(self, x):
+        raise NotImplementedError("Index artifacts are read-only; publish a new version instead")
+
+    def remove_ids(self, ids):
+        raise NotImplementedError("Index artifacts are read-only; publish a new version instead")
+
+
+class MmapDocstore(Docstore):
+    # Chunk ids are positions, so documents are decoded from the mapped files on demand
+    def __init__(self, path):
+        self.texts = _Records(os.path.join(path, "texts"))
+        self.metadatas = _Records(os.path.join(path, "metadata"))
+        self.doc_codes = None
+        if os.path.exists(os.path.join(path, "doc_ids.json")):
+            with open(os.path.join(path, "doc_ids.json")) as f:
+                self.doc_codes = {doc_id: code for code, doc_id in enumerate(json.load(f))}
+            self.doc_ids = np.fromfile(os.path.join(path, "doc_ids.i32"), dtype=np.int32)
+
+    def search(self, search):
+        i = int(search)
+        return Document(page_content=self.texts[i], metadata=json.loads(self.metadatas[i]))
+
+    def positions(self, filter):
+        # Positions of one document's chunks; None (scan everything) for other filters
+        # and for artifacts published before the doc_id column existed
+        if self.doc_codes is None or set(filter) != {"doc_id"}:
+            return None
+        code = self.doc_codes.get(filter["doc_id"])
+        return np.flatnonzero(self.doc_ids == code) if code is not None else np.empty(0, dtype=np.int64)
+
+
+class _PositionIds(Mapping):
+    def __init__(self, count):
+        self.count = count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise KeyError(i)
+        return str(i)
+
+    def __iter__(self):
+        return iter(range(self.count))
+
+    def __len__(self):
+        return self.count
+
+
+def open_artifact(path, embeddings):
+    with open(os.path.join(path, "header.json")) as f:
+        header = json.load(f)
+    transform_path = os.path.join(path, TRANSFORM_FILE)
+    transform = faiss.read_VectorTransform(transform_path) if os.path.exists(transform_path) else None
+    index = MmapIndex(path, header["count"], header["d"], transform)
+    return FAISS(embeddings, index, MmapDocstore(path), _PositionIds(header["count"]))
+
+
+class SharedIndex:
+    # Read side of a published index: opening it is a few file opens, and a newer
+    # version published by the writing process is picked up on the next retrieval
+    def __init__(self, embeddings, name, artifact_dir=INDEX_ARTIFACT_DIR):
+        self.embeddings = embeddings
+        self.root = os.path.join(artifact_dir, name)
+        self.version = None
+        self.store = None
+        self.bm25 = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        for _ in range(REFRESH_ATTEMPTS):
+            try:
+                with open(os.path.join(self.root, "CURRENT")) as f:
+                    version = f.read().strip()
+            except FileNotFoundError:
+                return self.store
+            with self._lock:
+                if version == self.version:
+                    return self.store
+                path = os.path.join(self.root, version)
+                try:
+                    store = open_artifact(path, self.embeddings)
+                    with open(os.path.join(path, "bm25.pkl"), "rb") as f:
+                        bm25 = pickle.load(f)
+                except FileNotFoundError:
+                    # Pruned after two newer versions were published; CURRENT names a newer one
+                    logging.info(f"Index artifact {self.root}/{version} was pruned while opening, retrying")
+                    continue
+                self.store, self.bm25, self.version = store, bm25, version
+                logging.info(f"Opened index artifact {self.root}/{version} ({self.store.index.ntotal} chunks)")
+                return self.store
+        logging.warning(f"Could not open the current version of {self.root}, keeping {self.version}")
+        return self.store
+
+    def as_retriever(self, doc_id=None, k=4):
+        self.refresh()
+        with self._lock:
+            store, bm25 = self.store, self.bm25
+        return HybridRetriever(
+            vector_retriever=vector_retriever(store, k, {"doc_id": doc_id} if doc_id is not None else None),
+            bm25=bm25,
+            lookup=lambda keys: [store.docstore.search(key) for key in keys],
+            doc_id=doc_id,
+            k=k,
+        )
@@ -0,0 +1,115 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from langchain_community.vectorstores import FAISS
+
+# Where saved indexes live and how much disk they may use before eviction
+CACHE_DIR = os.getenv("FAISS_CACHE_DIR", "faiss_cache")
+CACHE_MAX_BYTES = int(os.getenv("FAISS_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+
+def file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cache_key(content_hash, chunk_size, chunk_overlap, embedding_model):
+    # Any change to the chunking or the embedding model must produce a new index
+    raw = f"{content_hash}|{chunk_size}|{chunk_overlap}|{embedding_model}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class FaissIndexCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, key, embeddings):
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            try:
+                start = time.perf_counter()
+                vectors = FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+                # Touch the entry so LRU eviction sees it as recently used
+                os.utime(path)
+                with self._lock:
+                    self.hits += 1
+                logging.info(f"Index cache hit for {key[:12]} ({time.perf_counter() - start:.3f}s)")
+                return vectors
+            except Exception as e:
+                logging.warning(f"Discarding unreadable cached index {key[:12]}: {str(e)}")
+                shutil.rmtree(path, ignore_errors=True)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get_or_build(self, key, embeddings, build):
+        vectors = self.get(key, embeddings)
+        if vectors is not None:
+            return vectors
+        vectors = build()
+        self.put(key, vectors)
+        return vectors
+
+    def put(self, key, vectors):
+        path = os.path.join(self.cache_dir, key)
+        # Save under a temporary name first so a crash never leaves a half-written index
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            vectors.save_local(tmp_path)
+            if os.path.isdir(path):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            else:
+                os.rename(tmp_path, path)
+        except Exception as e:
+            logging.warning(f"Could not save index {key[:12]} to cache: {str(e)}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                if os.path.isdir(path) and ".tmp-" not in name:
+                    entries.append((os.path.getmtime(path), _dir_size(path), path))
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            # Drop least recently used entries, always keeping the newest one
+            while total > self.max_bytes and len(entries) > 1:
+                _, size, path = entries.pop(0)
+                shutil.rmtree(path, ignore_errors=True)
+                total -= size
+                logging.info(f"Evicted cached index {os.path.basename(path)[:12]} ({size} bytes)")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+import hashlib
+import logging
+import threading
+from array import array
+
+# Embedded batches of unfinished ingestions, so a retry after an API failure or a
+# restart picks up at the first batch that was not embedded yet
+INGEST_CHECKPOINT_PATH = os.getenv("INGEST_CHECKPOINT_PATH", "ingest_checkpoints.sqlite3")
+# Checkpoints of ingestions nobody retried are dropped after this many seconds
+INGEST_CHECKPOINT_TTL = float(os.getenv("INGEST_CHECKPOINT_TTL", 7 * 86400))
+
+
+def checkpoint_key(*parts):
+    # Everything that decides where batch boundaries fall and what the vectors are:
+    # file contents, chunking, batch size, embedding model, page range
+    return hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+def batch_digest(texts):
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class IngestCheckpoint:
+    def __init__(self, key, db_path=INGEST_CHECKPOINT_PATH):
+        self.key = key
+        self.resumed = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "key TEXT NOT NULL, batch INTEGER NOT NULL, digest TEXT NOT NULL, "
+            "vectors BLOB NOT NULL, dim INTEGER NOT NULL, created REAL NOT NULL, "
+            "PRIMARY KEY (key, batch))"
+        )
+        self._conn.execute("DELETE FROM batches WHERE created < ?", (time.time() - INGEST_CHECKPOINT_TTL,))
+        self._conn.commit()
+        self.completed = self._conn.execute("SELECT COUNT(*) FROM batches WHERE key = ?", (key,)).fetchone()[0]
+        if self.completed:
+            logging.info(f"Resuming ingestion {key[:12]}: {self.completed} batches already embedded")
+
+    def load(self, batch, texts):
+        # Vectors saved for this batch, None when it was not embedded or its chunks differ
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest, vectors, dim FROM batches WHERE key = ? AND batch = ?", (self.key, batch)
+            ).fetchone()
+        if row is None or row[0] != batch_digest(texts):
+            return None
+        flat = array("f", row[1]).tolist()
+        dim = row[2]
+        self.resumed += 1
+        return [flat[i:i + dim] for i in range(0, len(flat), dim)]
+
+    def save(self, batch, texts, vectors):
+        flat = array("f")
+        for vector in vectors:
+            flat.extend(vector)
+        with self._lock:
+            # Committed per batch: whatever was embedded before a crash is on disk
+            self._conn.execute(
+                "INSERT OR REPLACE INTO batches (key, batch, digest, vectors, dim, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (self.key, batch, batch_digest(texts), flat.tobytes(), len(vectors[0]), time.time()),
+            )
+            self._conn.commit()
+            self.saved += 1
+
+    def clear(self):
+        # The ingestion finished: nothing left to resume
+        with self._lock:
+            self._conn.execute("DELETE FROM batches WHERE key = ?", (self.key,))
+            self._conn.commit()
+        if self.resumed:
+            logging.info(f"Ingestion {self.key[:12]} reused {self.resumed} checkpointed batches")
+
+    def close(self):
+        self._conn.close()
+
+
+if __name__ == "__main__":
+    # Failure injection: python ingest_checkpoint.py [trials]
+    # Each trial embeds the same batches, failing at random batch boundaries (in-process
+    # errors and hard process exits) until an attempt completes. The vectors must match
+    # a clean run, and only batches that were in flight when a process was killed may be
+    # embedded twice: an in-process failure still saves everything already embedded.
+    import json
+    import subprocess
+    import tempfile
+    from ingest_pipeline import _embed_batches
+    from batch_embed import RateLimiter
+
+    class InjectedFailure(BaseException):
+        # Not an Exception, so embed_batch does not retry it: the attempt stops here
+        pass
+
+    class FlakyEmbeddings:
+        def __init__(self, fail_at=None, crash_at=None, log_path=None):
+            self.fail_at = fail_at
+            self.crash_at = crash_at
+            self.log_path = log_path
+            self.calls = 0
+            self._lock = threading.Lock()
+
+        def embed_documents(self, texts):
+            with self._lock:
+                call = self.calls
+                self.calls += 1
+            if call == self.crash_at:
+                os._exit(3)
+            if call == self.fail_at:
+                raise InjectedFailure(f"injected failure at call {call}")
+            vectors = [[float(len(text)), float(sum(map(ord, text)) % 997), float(i)] for i, text in enumerate(texts)]
+            if self.log_path:
+                with open(self.log_path, "a") as log:
+                    log.write(json.dumps(texts[0]) + "\n")
+            return vectors
+
+    def make_batches(count, size=5):
+        return [[f"batch {b} chunk {c}" for c in range(size)] for b in range(count)]
+
+    WORKERS = 4
+
+    def attempt(db_path, batch_count, embeddings):
+        checkpoint = IngestCheckpoint("trial", db_path)
+        try:
+            vectors = [v for _, batch_vectors in _embed_batches(
+                make_batches(batch_count), embeddings, RateLimiter(10 ** 9), WORKERS, checkpoint, texts=lambda batch: batch
+            ) for v in batch_vectors]
+        except InjectedFailure:
+            checkpoint.close()
+            return None
+        checkpoint.clear()
+        checkpoint.close()
+        return vectors
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        # One attempt in a process of its own that may exit without any cleanup
+        db_path, batch_count, crash_at, log_path = sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5]
+        attempt(db_path, batch_count, FlakyEmbeddings(crash_at=crash_at, log_path=log_path))
+        sys.exit(0)
+
+    logging.basicConfig(level=logging.WARNING)
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    rng = random.Random(0)
+    failed = 0
+    for trial in range(trials):
+        batch_count = rng.randint(3, 30)
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "checkpoints.sqlite3")
+            log_path = os.path.join(tmp, "embedded.log")
+            expected = attempt(os.path.join(tmp, "clean.sqlite3"), batch_count, FlakyEmbeddings())
+
+            attempts, crashes, vectors = 0, 0, None
+            while vectors is None:
+                attempts += 1
+                checkpoint = IngestCheckpoint("trial", db_path)
+                remaining = batch_count - checkpoint.completed
+                checkpoint.close()
+                point = rng.randrange(remaining + 1)
+                if point == remaining:
+                    vectors = attempt(db_path, batch_count, FlakyEmbeddings(log_path=log_path))
+                elif rng.random() < 0.5:
+                    attempt(db_path, batch_count, FlakyEmbeddings(fail_at=point, log_path=log_path))
+                else:
+                    crashes += 1
+                    subprocess.run(
+                        [sys.executable, __file__, "--child", db_path, str(batch_count), str(point), log_path],
+                        check=False,
+                    )
+
+            with open(log_path) as log:
+                embedded = [json.loads(line) for line in log]
+            ok = (
+                vectors == expected
+                and len(set(embedded)) == batch_count
+                and len(embedded) <= batch_count + crashes * (WORKERS - 1)
+            )
+            failed += not ok
+            print(
+                f"trial {trial}: {batch_count} batches, {attempts} attempts ({crashes} killed), "
+                f"{len(embedded)} batches embedded -> {'ok' if ok else 'MISMATCH'}"
+            )
+    print(f"{trials - failed}/{trials} trials resumed correctly")
+    sys.exit(1 if failed else 0)
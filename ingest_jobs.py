@@ -0,0 +1,118 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from queue import Queue
+from collections import deque
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+# Minimum seconds between progress notifications for one job
+PROGRESS_INTERVAL = float(os.getenv("INGEST_PROGRESS_INTERVAL", 5))
+
+
+class IngestJob:
+    def __init__(self, name, fn, args):
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.state = "queued"
+        self.error = None
+        self.pages = 0
+        self.chunks = 0
+        # Set when an already embedded copy was used and nothing had to be parsed
+        self.reused = None
+        self.on_progress = None
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._last_notified = 0.0
+
+    def progress(self, pages, chunks):
+        self.pages = pages
+        self.chunks = chunks
+        now = time.monotonic()
+        if self.on_progress and now - self._last_notified >= PROGRESS_INTERVAL:
+            self._last_notified = now
+            try:
+                self.on_progress(pages, chunks)
+            except Exception as e:
+                # A failed notification must not stop the ingestion it reports on
+                logging.warning(f"Progress notification for ingestion job {self.id} failed: {str(e)}")
+
+    def reuse(self, source, chunks):
+        self.reused = source
+        self.chunks = chunks
+
+    def summary(self):
+        if self.reused:
+            return f"{self.chunks} chunks reused from the {self.reused}, nothing to parse"
+        return f"{self.pages} pages parsed, {self.chunks} chunks embedded"
+
+    def wait_time(self):
+        return (self.started_at or time.monotonic()) - self.enqueued_at
+
+    def duration(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+
+class IngestJobQueue:
+    def __init__(self, workers=INGEST_WORKERS, history=100):
+        self._queue = Queue()
+        self._running = set()
+        self._finished = deque(maxlen=history)
+        self._lock = threading.Lock()
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"ingest-worker-{i}", daemon=True).start()
+
+    def submit(self, name, fn, *args):
+        # fn is called on a worker thread as fn(job, *args)
+        job = IngestJob(name, fn, args)
+        self._queue.put(job)
+        logging.info(f"Queued ingestion job {job.id} for {name} (queue depth {self._queue.qsize()})")
+        return job
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.state = "running"
+            job.started_at = time.monotonic()
+            with self._lock:
+                self._running.add(job)
+            try:
+                job.fn(job, *job.args)
+                job.state = "done"
+            except Exception as e:
+                job.state = "failed"
+                job.error = e
+                logging.error(f"Ingestion job {job.id} for {job.name} failed: {str(e)}")
+            finally:
+                job.finished_at = time.monotonic()
+                with self._lock:
+                    self._running.discard(job)
+                    self._finished.append(job)
+                logging.info(
+                    f"Ingestion job {job.id} {job.state} in {job.duration():.1f}s "
+                    f"after {job.wait_time():.1f}s queued"
+                )
+
+    def stats(self):
+        with self._lock:
+            finished = list(self._finished)
+            running = len(self._running)
+        durations = [job.duration() for job in finished]
+        return {
+            "queued": self._queue.qsize(),
+            "running": running,
+            "done": sum(1 for job in finished if job.state == "done"),
+            "failed": sum(1 for job in finished if job.state == "failed"),
+            "avg_wait_s": sum(job.wait_time() for job in finished) / len(finished) if finished else 0.0,
+            "avg_duration_s": sum(durations) / len(durations) if durations else 0.0,
+            "max_duration_s": max(durations, default=0.0),
+        }
@@ -0,0 +1,207 @@
+import os
+import time
+import threading
+from queue import Queue, Full, Empty
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pypdf import PdfReader
+from langchain_core.documents import Document
+from langchain_community.vectorstores import FAISS
+from batch_embed import RateLimiter, add_to_chroma, embed_batch, log_throughput, new_chroma, provider_settings
+from chunk_dedup import NearDuplicateFilter
+from chroma_registry import registry
+from index_cache import file_hash
+from ingest_checkpoint import IngestCheckpoint, checkpoint_key
+
+# Bounded hand-off queues between stages; a full queue stalls the stage upstream of it
+PAGE_QUEUE_SIZE = 16
+BATCH_QUEUE_SIZE = 4
+
+_DONE = object()
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _run_stage(items, queue, stop, errors):
+    try:
+        for item in items:
+            if not _put(queue, item, stop):
+                return
+    except Exception as e:
+        errors.append(e)
+    finally:
+        _put(queue, _DONE, stop)
+
+
+def _start_stage(items, queue_size, stop, errors):
+    queue = Queue(maxsize=queue_size)
+    threading.Thread(target=_run_stage, args=(items, queue, stop, errors), daemon=True).start()
+    return queue
+
+
+def _drain(queue, stop):
+    while not stop.is_set():
+        try:
+            item = queue.get(timeout=0.1)
+        except Empty:
+            continue
+        if item is _DONE:
+            return
+        yield item
+
+
+def _split_pages(pages, text_splitter):
+    for page in pages:
+        yield from text_splitter.split_documents([page])
+
+
+def _batch(chunks, batch_size):
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _chunk_texts(batch):
+    return [doc.page_content for doc in batch]
+
+
+def _embed_and_save(embeddings, texts, limiter, checkpoint, batch_no):
+    vectors = embed_batch(embeddings, texts, limiter)
+    if checkpoint is not None:
+        checkpoint.save(batch_no, texts, vectors)
+    return vectors
+
+
+def _embed_batches(batches, embeddings, limiter, max_workers, checkpoint=None, texts=_chunk_texts):
+    # Embeds up to max_workers batches at once and yields (batch, vectors) in order.
+    # Batches found in the checkpoint skip the provider and the rate limiter; new ones
+    # are saved from the worker as soon as they are embedded, so a failure anywhere
+    # loses at most the batches still in flight.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for batch_no, batch in enumerate(batches):
+            batch_texts = texts(batch)
+            vectors = checkpoint.load(batch_no, batch_texts) if checkpoint is not None else None
+            if vectors is not None:
+                future = Future()
+                future.set_result(vectors)
+            else:
+                future = executor.submit(_embed_and_save, embeddings, batch_texts, limiter, checkpoint, batch_no)
+            pending.append((batch, future))
+            if len(pending) >= max_workers:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+        while pending:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+
+
+def _insert(store, store_type, embeddings, batch, vectors):
+    texts = [doc.page_content for doc in batch]
+    metadatas = [doc.metadata for doc in batch]
+    if store_type == "faiss":
+        if store is None:
+            return FAISS.from_embeddings(list(zip(texts, vectors)), embeddings, metadatas=metadatas)
+        store.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+        return store
+    if store is None:
+        store = new_chroma(embeddings)
+        try:
+            add_to_chroma(store, texts, vectors, metadatas)
+        except Exception:
+            registry.release(store)
+            raise
+        return store
+    add_to_chroma(store, texts, vectors, metadatas)
+    return store
+
+
+def stream_pdf_into_index(file_path, text_splitter, embeddings, provider, store_type, progress=None, limiter=None, first_page=0, last_page=None, checkpoint=True, content_hash=None, dedup=None):
+    settings = provider_settings(provider)
+    # Callers ingesting several files at once pass one shared limiter
+    limiter = limiter or RateLimiter(settings["requests_per_minute"])
+    max_workers = settings["max_workers"]
+    stop = threading.Event()
+    errors = []
+    counts = {"pages": 0, "chunks": 0, "batches": 0, "dim": 0}
+    # Callers indexing a document in steps pass one filter for all of them, so
+    # boilerplate repeated across steps is embedded once too
+    dedup = dedup or NearDuplicateFilter()
+
+    def parse_pages():
+        # first_page/last_page select a range, e.g. for indexing a document in steps.
+        # Only the pages in the range are extracted; the ones before it are skipped unread
+        reader = PdfReader(file_path)
+        total = len(reader.pages)
+        for number in range(first_page, min(last_page if last_page is not None else total, total)):
+            counts["pages"] += 1
+            text = reader.pages[number].extract_text() or ""
+            yield Document(page_content=text, metadata={"source": file_path, "page": number, "total_pages": total})
+
+    # Stage 1 parses pages lazily, stage 2 splits them, drops near-duplicate chunks
+    # and groups the rest into batches
+    pages = _start_stage(parse_pages(), PAGE_QUEUE_SIZE, stop, errors)
+    chunks = dedup.filter(_split_pages(_drain(pages, stop), text_splitter))
+    batches = _start_stage(_batch(chunks, settings["batch_size"]), BATCH_QUEUE_SIZE, stop, errors)
+
+    # Embedded batches are checkpointed until the whole file is in, so a retry after an
+    # API failure or a restart does not start again from the first chunk. Callers
+    # indexing a document in steps pass its content_hash so it is read only once.
+    resume = None
+    if checkpoint:
+        resume = IngestCheckpoint(checkpoint_key(
+            content_hash or file_hash(file_path), getattr(embeddings, "model_id", type(embeddings).__name__), provider,
+            text_splitter._chunk_size, text_splitter._chunk_overlap, settings["batch_size"], first_page, last_page,
+        ))
+
+    store = None
+    start = time.perf_counter()
+    try:
+        # Stage 3 embeds the batches and inserts them in order
+        for batch, vectors in _embed_batches(_drain(batches, stop), embeddings, limiter, max_workers, resume):
+            store = _insert(store, store_type, embeddings, batch, vectors)
+            counts["dim"] = len(vectors[0])
+            counts["chunks"] += len(batch)
+            counts["batches"] += 1
+            if progress:
+                progress(counts["pages"], counts["chunks"])
+        if errors:
+            raise errors[0]
+        if store is None:
+            raise ValueError("No text could be extracted from the PDF.")
+        if resume is not None:
+            resume.clear()
+    except Exception:
+        # A half-built collection would otherwise stay in the in-process client
+        if store is not None and store_type == "chroma":
+            registry.release(store)
+        raise
+    finally:
+        stop.set()
+        if resume is not None:
+            resume.close()
+
+    log_throughput(counts["chunks"], counts["batches"], time.perf_counter() - start)
+    dedup.report(os.path.basename(file_path), counts["dim"], settings["batch_size"])
+    return store
+
+
+def stream_pdf_to_faiss(file_path, text_splitter, embeddings, provider, progress=None, limiter=None, first_page=0, last_page=None, content_hash=None, dedup=None):
+    return stream_pdf_into_index(file_path, text_splitter, embeddings, provider, "faiss", progress, limiter, first_page, last_page, content_hash=content_hash, dedup=dedup)
+
+
+def stream_pdf_to_chroma(file_path, text_splitter, embeddings, provider, progress=None, limiter=None, first_page=0, last_page=None, content_hash=None, dedup=None):
+    return stream_pdf_into_index(file_path, text_splitter, embeddings, provider, "chroma", progress, limiter, first_page, last_page, content_hash=content_hash, dedup=dedup)
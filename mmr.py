@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+from typing import Any, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from ann_index import search_subset
+
+# Maximal marginal relevance is on by default; RETRIEVAL_MMR=0 returns plain nearest neighbours
+MMR_ENABLED = os.getenv("RETRIEVAL_MMR", "1") == "1"
+# Candidates re-ranked per query, and the relevance/diversity balance (1.0 = relevance only)
+MMR_FETCH_K = int(os.getenv("MMR_FETCH_K", 20))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))
+
+
+def mmr_select(query, candidates, k, lambda_mult=MMR_LAMBDA):
+    # Greedy MMR over a single candidate-by-candidate similarity matrix: each step is a
+    # few vector operations, with the best similarity to the picks so far kept up to date
+    candidates = np.asarray(candidates, dtype=np.float32)
+    if len(candidates) == 0 or k <= 0:
+        return []
+    query = np.asarray(query, dtype=np.float32)
+    vectors = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    relevance = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+    similarity = vectors @ vectors.T
+
+    first = int(np.argmax(relevance))
+    selected = [first]
+    redundancy = similarity[first].copy()
+    available = np.ones(len(vectors), dtype=bool)
+    available[first] = False
+    for _ in range(min(k, len(vectors)) - 1):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+
+def _matches(metadata, filter):
+    return all(metadata.get(key) == value for key, value in filter.items())
+
+
+def faiss_candidates(store, query, fetch_k, filter=None):
+    # Chunk ids and vectors of the fetch_k nearest chunks; Documents are only built
+    # for the ones MMR keeps
+    index = store.index
+    x = np.asarray([query], dtype=np.float32)
+    labels = None
+    if filter and hasattr(store.docstore, "positions"):
+        # Only the chunks matching the filter (e.g. one document's) are searched
+        subset = store.docstore.positions(filter)
+        if subset is not None:
+            if len(subset) == 0:
+                return [], np.empty((0, index.d), dtype=np.float32)
+            found = search_subset(index, x, min(fetch_k, len(subset)), subset)
+            labels = found[1] if found is not None else None
+    if labels is None:
+        # Otherwise FAISS filters after the search, so a filtered query looks at every chunk
+        n = index.ntotal if filter else min(fetch_k, index.ntotal)
+        if n == 0:
+            return [], np.empty((0, index.d), dtype=np.float32)
+        _, labels = index.search(x, n)
+    # A ChunkStore checks the filter on its metadata columns
+    matches = getattr(store.docstore, "matches", None)
+    chunk_ids, positions = [], []
+    for i in labels[0]:
+        if i < 0:
+            continue
+        chunk_id = store.index_to_docstore_id[int(i)]
+        if filter:
+            if matches is not None:
+                if not matches(chunk_id, filter):
+                    continue
+            elif not _matches(store.docstore.search(chunk_id).metadata, filter):
+                continue
+        chunk_ids.append(chunk_id)
+        positions.append(int(i))
+        if len(chunk_ids) == fetch_k:
+            break
+    vectors = np.array([index.reconstruct(i) for i in positions], dtype=np.float32).reshape(-1, index.d)
+    return chunk_ids, vectors
+
+
+def chroma_candidates(store, query, fetch_k, filter=None):
+    data = store._collection.query(
+        query_embeddings=[list(query)],
+        n_results=fetch_k,
+        where=filter or None,
+        include=["documents", "metadatas", "embeddings"],
+    )
+    docs = [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(data["documents"][0], data["metadatas"][0])
+    ]
+    return docs, np.asarray(data["embeddings"][0], dtype=np.float32)
+
+
+class MMRRetriever(BaseRetriever):
+    # Drop-in for store.as_retriever(): fetches fetch_k nearest chunks with their vectors
+    # and keeps the k that are relevant without repeating each other
+    store: Any
+    k: int = 4
+    fetch_k: int = MMR_FETCH_K
+    lambda_mult: float = MMR_LAMBDA
+    filter: Optional[dict] = None
+    # False keeps the k nearest in order, for searches with MMR off
+    diversify: bool = True
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        return self.search(self.embed(query))
+
+    def embed(self, query):
+        return self.store.embeddings.embed_query(query)
+
+    def search(self, vector):
+        if not self.diversify:
+            if not hasattr(self.store, "docstore"):
+                return self.store.similarity_search_by_vector(vector, k=self.k, filter=self.filter)
+            chunk_ids, _ = faiss_candidates(self.store, vector, self.k, self.filter)
+            return [self.store.docstore.search(chunk_id) for chunk_id in chunk_ids]
+        fetch_k = max(self.fetch_k, self.k)
+        if hasattr(self.store, "docstore"):
+            chunk_ids, vectors = faiss_candidates(self.store, vector, fetch_k, self.filter)
+            return [self.store.docstore.search(chunk_ids[i]) for i in mmr_select(vector, vectors, self.k, self.lambda_mult)]
+        docs, vectors = chroma_candidates(self.store, vector, fetch_k, self.filter)
+        return [docs[i] for i in mmr_select(vector, vectors, self.k, self.lambda_mult)]
+
+
+def vector_retriever(store, k=4, filter=None, fetch_k=MMR_FETCH_K, by_vector=False):
+    # The vector half of retrieval for every bot: MMR unless switched off.
+    # by_vector: the caller embeds the query itself and calls search(vector)
+    if MMR_ENABLED:
+        return MMRRetriever(store=store, k=k, fetch_k=fetch_k, filter=filter)
+    if by_vector or (filter and hasattr(store, "docstore")):
+        # LangChain would filter a search over the whole corpus; this searches only the matches
+        return MMRRetriever(store=store, k=k, filter=filter, diversify=False)
+    search_kwargs = {"k": k}
+    if filter:
+        search_kwargs["filter"] = filter
+    return store.as_retriever(search_kwargs=search_kwargs)
+
+
+if __name__ == "__main__":
+    # Selection and speed against LangChain's loop-based MMR: python mmr.py [candidates] [dim]
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    d = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+    k = 4
+    rng = np.random.RandomState(0)
+    queries = rng.randn(200, d).astype(np.float32)
+    # Candidate pools with near-duplicate chunks, like overlapping chunks from one page
+    pools = []
+    for query in queries:
+        base = query + 2.0 * rng.randn(n // 4, d).astype(np.float32)
+        pools.append(np.repeat(base, 4, axis=0)[:n] + 0.05 * rng.randn(n, d).astype(np.float32))
+
+    timings = {}
+    for name, select in [
+        ("langchain", lambda q, c: maximal_marginal_relevance(q, c, MMR_LAMBDA, k)),
+        ("numpy", lambda q, c: mmr_select(q, c, k, MMR_LAMBDA)),
+    ]:
+        start = time.perf_counter()
+        results = [select(query, pool) for query, pool in zip(queries, pools)]
+        timings[name] = ((time.perf_counter() - start) / len(queries) * 1000, results)
+    same = sum(a == b for a, b in zip(timings["langchain"][1], timings["numpy"][1]))
+    print(f"{n} candidates x {d} dims, k={k}, lambda={MMR_LAMBDA}: {same}/{len(queries)} identical selections")
+    for name, (ms, _) in timings.items():
+        print(f"  {name}: {ms:.3f} ms/query")
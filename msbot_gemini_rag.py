@@ -1,16 +1,19 @@
 import asyncio
 import time
+import logging
 from dotenv import load_dotenv
 from botbuilder.core import BotFrameworkAdapterSettings, TurnContext, BotFrameworkAdapter
 from botbuilder.schema import Activity, ActivityTypes
 from quart import Quart, request, Response
 from langchain_groq import ChatGroq
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from chunker import LinearTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
+from ingest_pipeline import stream_pdf_to_faiss
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, stuff_pipeline
+from doc_index import DocumentIndex
+from index_cache import FaissIndexCache, cache_key, file_hash
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 import os
 import aiohttp
@@ -46,40 +49,67 @@ prompt = ChatPromptTemplate.from_template(
     """
 )
 
-# Global variables to store vector store and other components
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-vectors = None
+# Chunking and embedding settings; together with the PDF contents they key the index cache
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "models/embedding-001"
 
-def setup_vector_store(file_path):
-    global vectors
-    
-    # Load and process the uploaded PDF
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    # Create FAISS vector store
-    vectors = FAISS.from_documents(final_documents, embeddings)
+# Global variables to store vector store and other components
+embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), model_id=EMBEDDING_MODEL)
+index_cache = FaissIndexCache()
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "faiss", "msbot_gemini_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
+current_pdf = None
+
+def build_vector_store(file_path):
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return stream_pdf_to_faiss(file_path, text_splitter, embeddings, provider="gemini")
+
+def publish_pipeline(doc_id):
+    # Built only after ingestion completes, so questions never see a partially indexed document
+    pipeline.publish(stuff_pipeline(llm, prompt, doc_index.as_retriever(doc_id), doc_id, doc_index.version(doc_id)))
+
+def setup_vector_store(file_path, doc_id):
+    global current_pdf
+
+    # A document already in the corpus with the same contents is not embedded again
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        publish_pipeline(doc_id)
+        current_pdf = doc_id
+        return
+
+    # Reuse a saved index when the same PDF was processed before
+    key = cache_key(content_hash, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_MODEL)
+    doc_index.add(doc_id, content_hash, index_cache.get_or_build(key, embeddings, lambda: build_vector_store(file_path)))
+    logging.info(f"Index cache: {index_cache.stats()}")
+    publish_pipeline(doc_id)
+    current_pdf = doc_id
 
 def get_answer(question):
-    if vectors is None:
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please upload a PDF file first."
-    
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
+
+    # Repeated questions about an unchanged document skip retrieval and generation
+    cached = answer_cache.get(current.scope, current.version, question)
+    if cached is not None:
+        return cached
+
     start = time.process_time()
-    response = retrieval_chain.invoke({'input': question})
+    answer = current.invoke(question)
     print("Response time:", time.process_time() - start)
     
-    return response['answer']
+    answer_cache.put(current.scope, current.version, question, answer)
+    return answer
 
 
 class TeamsBot:
@@ -102,7 +132,7 @@ class TeamsBot:
                             
                             # Process the PDF
                             try:
-                                setup_vector_store(file_path)
+                                setup_vector_store(file_path, file_name)
                                 await turn_context.send_activity(f"PDF {file_name} has been processed and is ready for queries.")
                             except Exception as e:
                                 await turn_context.send_activity(f"Error processing PDF: {str(e)}")
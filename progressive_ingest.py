@@ -0,0 +1,183 @@
+import os
+import time
+import logging
+import threading
+from pypdf import PdfReader
+from chunk_dedup import NearDuplicateFilter
+
+# Pages indexed before a document is announced as ready, and pages added per
+# background step after that
+PROGRESSIVE_FIRST_PAGES = int(os.getenv("PROGRESSIVE_FIRST_PAGES", 10))
+PROGRESSIVE_STEP_PAGES = int(os.getenv("PROGRESSIVE_STEP_PAGES", 50))
+
+_active = {}
+_active_lock = threading.Lock()
+# Start times of ingests whose document has not been asked about yet
+_awaiting_answer = {}
+
+
+def partial_hash(content_hash):
+    # Chunks of a document still being ingested carry this tag instead of the content hash,
+    # so has(doc_id, content_hash) stays False until every page is in
+    return f"{content_hash}:partial"
+
+
+def is_partial(version):
+    return bool(version) and ":partial" in version
+
+
+def page_count(file_path):
+    return len(PdfReader(file_path).pages)
+
+
+class ProgressiveIngest:
+    # Indexes the first pages of a PDF synchronously and streams the rest into the same
+    # corpus in the background. build(file_path, first_page, last_page, content_hash, dedup)
+    # returns a store of the chunks for that page range; every step gets the same
+    # near-duplicate filter, so boilerplate is dropped across the whole document.
+    # on_update(ingest) runs from the background thread whenever more pages became
+    # searchable, including once at the end.
+    def __init__(self, doc_index, doc_id, content_hash, file_path, build, on_update=None, delete_file=False):
+        self.doc_index = doc_index
+        self.doc_id = doc_id
+        self.content_hash = content_hash
+        self.file_path = file_path
+        self.build = build
+        self.on_update = on_update
+        self.delete_file = delete_file
+        self.page_count = page_count(file_path)
+        self.dedup = NearDuplicateFilter()
+        self.pages_indexed = 0
+        self.done = False
+        self.error = None
+        self._started = None
+        self._cancelled = threading.Event()
+        # Set once the ingest stops: every page indexed, failed or superseded
+        self.finished = threading.Event()
+
+    @property
+    def version(self):
+        # Changes with every step, so answers cached from fewer pages are not reused
+        if self.done:
+            return self.content_hash
+        return f"{partial_hash(self.content_hash)}@{self.pages_indexed}"
+
+    def _notify(self):
+        if self.on_update:
+            try:
+                self.on_update(self)
+            except Exception as e:
+                logging.warning(f"Progressive ingest update for '{self.doc_id}' failed: {str(e)}")
+
+    def start(self):
+        # Returns once the first pages are searchable. From then on the ingest owns the file.
+        self._started = time.perf_counter()
+        with _active_lock:
+            _awaiting_answer[self.doc_id] = self._started
+        first, last = 0, min(PROGRESSIVE_FIRST_PAGES, self.page_count)
+        while True:
+            try:
+                store = self.build(self.file_path, first, last, self.content_hash, self.dedup)
+                break
+            except ValueError:
+                # Nothing to extract from these pages, e.g. a scanned cover: go on to the
+                # next ones and fail only when no page has any text
+                if last >= self.page_count:
+                    raise
+                logging.info(f"No text on pages {first}-{last} of '{self.doc_id}'")
+                first, last = last, min(last + PROGRESSIVE_STEP_PAGES, self.page_count)
+        self.doc_index.add(self.doc_id, partial_hash(self.content_hash), store)
+        self.pages_indexed = last
+        logging.info(
+            f"First {last}/{self.page_count} pages of '{self.doc_id}' searchable after "
+            f"{time.perf_counter() - self._started:.2f}s"
+        )
+        if last >= self.page_count:
+            self._finish()
+            return self
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            while self.pages_indexed < self.page_count:
+                if self._cancelled.is_set():
+                    logging.info(f"Progressive ingest of '{self.doc_id}' superseded at page {self.pages_indexed}")
+                    self._release()
+                    return
+                first = self.pages_indexed
+                last = min(first + PROGRESSIVE_STEP_PAGES, self.page_count)
+                try:
+                    store = self.build(self.file_path, first, last, self.content_hash, self.dedup)
+                    self.doc_index.add(self.doc_id, partial_hash(self.content_hash), store, replace=False)
+                except ValueError:
+                    # Nothing to extract from these pages, e.g. scanned images
+                    logging.info(f"No text on pages {first}-{last} of '{self.doc_id}'")
+                self.pages_indexed = last
+                if last < self.page_count:
+                    self._notify()
+            self._finish()
+        except Exception as e:
+            # The pages indexed so far stay searchable, still marked as partial
+            self.error = e
+            logging.error(f"Progressive ingest of '{self.doc_id}' stopped at page {self.pages_indexed}: {str(e)}")
+            self._release()
+
+    def cancel(self):
+        # A newer copy of the document replaced this one; stop before the next step
+        self._cancelled.set()
+
+    def _finish(self):
+        self.doc_index.set_version(self.doc_id, self.content_hash)
+        self.done = True
+        logging.info(
+            f"Indexed all {self.page_count} pages of '{self.doc_id}' in "
+            f"{time.perf_counter() - self._started:.2f}s"
+        )
+        self._notify()
+        self._release()
+
+    def _release(self):
+        with _active_lock:
+            if _active.get(self.doc_id) is self:
+                del _active[self.doc_id]
+        self.finished.set()
+        if self.delete_file:
+            try:
+                os.unlink(self.file_path)
+            except OSError:
+                pass
+
+
+def record_answer(doc_id):
+    # Logs the time from selecting a document to its first answered question
+    with _active_lock:
+        started = _awaiting_answer.pop(doc_id, None)
+    if started is not None:
+        logging.info(f"Time to first answer for '{doc_id}': {time.perf_counter() - started:.2f}s")
+
+
+def start_progressive(doc_index, doc_id, content_hash, file_path, build, on_update=None, delete_file=False):
+    # Selecting a document that is already being ingested reuses the running ingest.
+    # The check and the registration happen under one lock, so concurrent uploads of
+    # the same document start a single ingest.
+    ingest = ProgressiveIngest(doc_index, doc_id, content_hash, file_path, build, on_update, delete_file)
+    with _active_lock:
+        running = _active.get(doc_id)
+        reuse = running is not None and running.content_hash == content_hash
+        if not reuse:
+            _active[doc_id] = ingest
+    if reuse:
+        if delete_file:
+            os.unlink(file_path)
+        return running
+    if running is not None:
+        running.cancel()
+    try:
+        ingest.start()
+    except Exception:
+        with _active_lock:
+            if _active.get(doc_id) is ingest:
+                del _active[doc_id]
+        raise
+    return ingest
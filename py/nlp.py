@@ -15,11 +15,8 @@ nlp = spacy.load('en_core_web_sm')
 def extract_text_from_pdf(pdf_path):
     pdf_file = open(pdf_path, 'rb')
     pdf_reader = PyPDF2.PdfReader(pdf_file)
-    num_pages = len(pdf_reader.pages)
-    text = ''
-    for page_num in range(num_pages):
-        page = pdf_reader.pages[page_num]
-        text += page.extract_text()
+    # Collect page texts and join once instead of growing one string per page
+    text = ''.join(page.extract_text() for page in pdf_reader.pages)
     pdf_file.close()
     return text
 
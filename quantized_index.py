@@ -0,0 +1,320 @@
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import logging
+import tempfile
+import numpy as np
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+# Opt-in compressed storage for saved FAISS indexes: "sq8" (int8 scalar, 4x smaller)
+# or "pq" (product quantization, ~32x smaller); empty keeps the float32 flat index
+FAISS_QUANTIZATION = os.getenv("FAISS_QUANTIZATION", "")
+# Candidates fetched per requested result and re-ranked on full-precision vectors
+FAISS_RERANK_FACTOR = int(os.getenv("FAISS_RERANK_FACTOR", 4))
+# Ceiling on the candidates re-ranked per query, unless more results are requested
+FAISS_RERANK_MAX = int(os.getenv("FAISS_RERANK_MAX", 1000))
+# PQ needs at least this many vectors to train its 256-centroid codebooks
+PQ_MIN_TRAIN = 256
+# Codebooks are retrained on a sample of the corpus each time it grows this many
+# times past the size they were trained at
+RETRAIN_GROWTH = 4
+RETRAIN_SAMPLE = 100_000
+RETRAIN_BATCH = 65536
+
+VECTORS_FILE = "vectors.f32"
+SAVE_BATCH = 65536
+
+
+def saved_files(folder_path, index_name="index"):
+    # Codes, docstore and vectors of the last save. The manifest names all three and is
+    # replaced in one rename, so a crash mid-save leaves the previous set in place.
+    # Corpora saved before the manifest existed use the fixed names.
+    manifest = os.path.join(folder_path, f"{index_name}.quantized")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            names = json.load(f)
+        return tuple(os.path.join(folder_path, names[key]) for key in ("codes", "docstore", "vectors"))
+    return (
+        os.path.join(folder_path, f"{index_name}.codes"),
+        os.path.join(folder_path, f"{index_name}.pkl"),
+        os.path.join(folder_path, VECTORS_FILE),
+    )
+
+
+def _pq_subquantizers(d):
+    # One byte per 8 dimensions, rounded down to a divisor of d
+    m = max(1, d // 8)
+    while d % m:
+        m -= 1
+    return m
+
+
+def _new_codes(d, mode):
+    if mode == "pq":
+        return faiss.IndexPQ(d, _pq_subquantizers(d), 8)
+    if mode == "sq8":
+        return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit)
+    raise ValueError(f"Unknown FAISS quantization mode: {mode}")
+
+
+class QuantizedIndex:
+    # Stands in for the faiss index inside LangChain's FAISS store: compact codes are
+    # searched in memory and the best candidates re-ranked against full-precision
+    # vectors memory-mapped from disk, so only those pages are ever read.
+    # Saved rows of the vectors file are never rewritten: adds are appended (a crash
+    # leaves only a tail that loading skips), and removals are kept as a map from
+    # positions to file rows until the next save writes a new file without them.
+    def __init__(self, d, mode, vectors_path, rerank=FAISS_RERANK_FACTOR, codes=None, target_mode=None):
+        self.d = d
+        self.mode = mode
+        # Mode to train with once there are enough vectors, e.g. pq after an sq8 start
+        self.target_mode = target_mode or mode
+        self.rerank = rerank
+        self.vectors_path = vectors_path
+        if codes is None:
+            codes = _new_codes(d, mode)
+            open(vectors_path, "wb").close()
+        self.codes = codes
+        self.trained_at = max(codes.ntotal, 1)
+        # File row of each position, None while they are the same. Vectors appended
+        # after the codes were last saved are left in the file but never mapped to.
+        self._rows = None
+        if os.path.getsize(vectors_path) > codes.ntotal * d * 4:
+            self._rows = np.arange(codes.ntotal)
+        self._map()
+
+    @property
+    def ntotal(self):
+        return self.codes.ntotal
+
+    def _map(self):
+        if os.path.getsize(self.vectors_path):
+            self._full = np.memmap(self.vectors_path, dtype=np.float32, mode="r").reshape(-1, self.d)
+        else:
+            self._full = np.empty((0, self.d), dtype=np.float32)
+
+    def _vectors(self, positions):
+        return np.array(self._full[positions if self._rows is None else self._rows[positions]])
+
+    def _train(self, x):
+        mode = self.target_mode
+        if mode == "pq" and len(x) < PQ_MIN_TRAIN:
+            logging.info(f"Only {len(x)} vectors to train PQ on, using sq8 instead")
+            mode = "sq8"
+        codes = _new_codes(self.d, mode)
+        codes.train(x)
+        return mode, codes
+
+    def _retrain(self):
+        # The first batch is normally a single document, so codebooks trained on it
+        # fit the rest of a growing corpus less and less well
+        start = time.perf_counter()
+        mode, codes = self._train(self._vectors(np.arange(0, self.ntotal, max(1, self.ntotal // RETRAIN_SAMPLE))))
+        for i in range(0, self.ntotal, RETRAIN_BATCH):
+            codes.add(self.reconstruct_n(i, min(RETRAIN_BATCH, self.ntotal - i)))
+        self.mode, self.codes, self.trained_at = mode, codes, self.ntotal
+        logging.info(f"Retrained {mode} codes on {self.ntotal} vectors in {time.perf_counter() - start:.1f}s")
+
+    def add(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if not self.codes.is_trained:
+            self.mode, self.codes = self._train(x)
+            self.trained_at = len(x)
+        self.codes.add(x)
+        with open(self.vectors_path, "ab") as f:
+            rows = f.tell() // (self.d * 4)
+            f.write(x.tobytes())
+        if self._rows is not None:
+            self._rows = np.concatenate([self._rows, np.arange(rows, rows + len(x))])
+        self._map()
+        if self.ntotal >= RETRAIN_GROWTH * self.trained_at:
+            self._retrain()
+
+    def _candidates(self, k, count):
+        return min(k * self.rerank, max(k, FAISS_RERANK_MAX), count)
+
+    def search(self, x, k):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if self.rerank <= 1 or self.ntotal == 0:
+            return self.codes.search(x, k)
+        _, candidates = self.codes.search(x, self._candidates(k, self.ntotal))
+        return self.rerank_candidates(x, candidates, k)
+
+    def search_subset(self, x, k, positions):
+        # Only the given positions are searched, e.g. one document's chunks, and no
+        # more candidates are re-ranked than for an unfiltered search
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        positions = np.asarray(positions, dtype=np.int64)
+        n = self._candidates(k, len(positions)) if self.rerank > 1 else min(k, len(positions))
+        if isinstance(self.codes, faiss.IndexPQ):
+            distances, candidates = self._pq_search_subset(x, n, positions)
+        else:
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(positions))
+            distances, candidates = self.codes.search(x, n, params=params)
+        if self.rerank <= 1:
+            return distances, candidates
+        return self.rerank_candidates(x, candidates, k)
+
+    def _pq_search_subset(self, x, n, positions):
+        # IndexPQ takes no selector, so the subset's codes are scored here against
+        # per-query distance tables, the same asymmetric distance IndexPQ computes
+        pq = self.codes.pq
+        centroids = faiss.vector_to_array(pq.centroids).reshape(pq.M, pq.ksub, pq.dsub)
+        codes = faiss.rev_swig_ptr(self.codes.codes.data(), self.ntotal * pq.code_size).reshape(self.ntotal, pq.code_size)[positions]
+        distances = np.full((len(x), n), np.finfo(np.float32).max, dtype=np.float32)
+        labels = np.full((len(x), n), -1, dtype=np.int64)
+        for row, query in enumerate(x):
+            tables = ((centroids - query.reshape(pq.M, 1, pq.dsub)) ** 2).sum(axis=2)
+            scores = tables[np.arange(pq.M), codes].sum(axis=1)
+            top = np.argpartition(scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+            top = top[np.argsort(scores[top])]
+            distances[row, :len(top)] = scores[top]
+            labels[row, :len(top)] = positions[top]
+        return distances, labels
+
+    def rerank_candidates(self, x, candidates, k):
+        distances = np.full((len(x), k), np.finfo(np.float32).max, dtype=np.float32)
+        labels = np.full((len(x), k), -1, dtype=np.int64)
+        for row, (query, ids) in enumerate(zip(x, candidates)):
+            ids = np.sort(ids[ids >= 0])
+            exact = ((self._vectors(ids) - query) ** 2).sum(axis=1)
+            order = np.argsort(exact)[:k]
+            distances[row, :len(order)] = exact[order]
+            labels[row, :len(order)] = ids[order]
+        return distances, labels
+
+    def reconstruct(self, i):
+        return self._vectors(i)
+
+    def reconstruct_n(self, i0, n):
+        if self._rows is None:
+            return np.array(self._full[i0:i0 + n])
+        return self._vectors(np.arange(i0, i0 + n))
+
+    def remove_ids(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        # The codes keep their order when compacted, so the positions do the same
+        rows = self._rows if self._rows is not None else np.arange(self.ntotal)
+        removed = self.codes.remove_ids(ids)
+        self._rows = np.delete(rows, ids[(ids >= 0) & (ids < len(rows))])
+        return removed
+
+    def compacted(self):
+        # Writes the vectors left after removals to a new file, without touching the
+        # current one; None when nothing was removed. Readers may keep searching.
+        if self._rows is None:
+            return None
+        path = os.path.join(os.path.dirname(self.vectors_path), f"vectors-{time.time_ns()}.f32")
+        with open(path, "wb") as f:
+            for i in range(0, self.ntotal, SAVE_BATCH):
+                f.write(self.reconstruct_n(i, min(SAVE_BATCH, self.ntotal - i)).tobytes())
+        return path
+
+    def switch(self, path):
+        # Positions and file rows are the same again; no search may run meanwhile
+        self.vectors_path = path
+        self._rows = None
+        self._map()
+
+    def bytes_per_vector(self):
+        return self.codes.sa_code_size()
+
+
+class QuantizedFAISS(FAISS):
+    @classmethod
+    def empty(cls, embeddings, d, mode, folder_path, rerank=FAISS_RERANK_FACTOR):
+        os.makedirs(folder_path, exist_ok=True)
+        # A new file, so a corpus saved in this directory keeps its vectors until replaced
+        index = QuantizedIndex(d, mode, os.path.join(folder_path, f"vectors-{time.time_ns()}.f32"), rerank)
+        return cls(embeddings, index, InMemoryDocstore(), {})
+
+    @classmethod
+    def from_faiss(cls, store, mode, folder_path, rerank=FAISS_RERANK_FACTOR):
+        # Convert a flat store, e.g. a corpus saved before quantization was switched on
+        quantized = cls.empty(store.embeddings, store.index.d, mode, folder_path, rerank)
+        if store.index.ntotal:
+            quantized.index.add(store.index.reconstruct_n(0, store.index.ntotal))
+        quantized.docstore = store.docstore
+        quantized.index_to_docstore_id = dict(store.index_to_docstore_id)
+        return quantized
+
+    def save_local(self, folder_path, index_name="index"):
+        # The full-precision vectors are already on disk next to the codes; only rows
+        # appended since are past the saved count, and loading skips those
+        os.makedirs(folder_path, exist_ok=True)
+        path = self.index.compacted()
+        if path is not None:
+            self.index.switch(path)
+        generation = time.time_ns()
+        names = {
+            "codes": f"{index_name}-{generation}.codes",
+            "docstore": f"{index_name}-{generation}.pkl",
+            "vectors": os.path.basename(self.index.vectors_path),
+        }
+        faiss.write_index(self.index.codes, os.path.join(folder_path, names["codes"]))
+        with open(os.path.join(folder_path, names["docstore"]), "wb") as f:
+            pickle.dump((self.docstore, self.index_to_docstore_id), f)
+        manifest = os.path.join(folder_path, f"{index_name}.quantized")
+        with open(f"{manifest}.tmp", "w") as f:
+            json.dump(names, f)
+        os.replace(f"{manifest}.tmp", manifest)
+        keep = {os.path.join(folder_path, name) for name in names.values()}
+        stale = [os.path.join(folder_path, f"{index_name}{suffix}") for suffix in (".codes", ".pkl", ".faiss")]
+        stale += glob.glob(os.path.join(folder_path, f"{index_name}-*.codes"))
+        stale += glob.glob(os.path.join(folder_path, f"{index_name}-*.pkl"))
+        stale += glob.glob(os.path.join(folder_path, "vectors*.f32"))
+        for stale_path in stale:
+            if stale_path not in keep and os.path.exists(stale_path):
+                os.remove(stale_path)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", rerank=FAISS_RERANK_FACTOR, mode=None, **kwargs):
+        codes_path, docstore_path, vectors_path = saved_files(folder_path, index_name)
+        codes = faiss.read_index(codes_path)
+        saved_mode = "pq" if isinstance(codes, faiss.IndexPQ) else "sq8"
+        index = QuantizedIndex(codes.d, saved_mode, vectors_path, rerank, codes, mode)
+        with open(docstore_path, "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return cls(embeddings, index, docstore, index_to_docstore_id)
+
+    @staticmethod
+    def exists(folder_path, index_name="index"):
+        return os.path.exists(saved_files(folder_path, index_name)[0])
+
+
+def _recall(index, queries, k, flat_labels):
+    start = time.perf_counter()
+    _, labels = index.search(queries, k)
+    elapsed = time.perf_counter() - start
+    hits = sum(len(set(found) & set(expected)) for found, expected in zip(labels, flat_labels))
+    return hits / flat_labels.size, elapsed / len(queries) * 1000
+
+
+if __name__ == "__main__":
+    # Recall and memory against the flat index: python quantized_index.py [count] [dim]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    d = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+    k = 4
+    rng = np.random.RandomState(0)
+    centers = rng.randn(200, d).astype(np.float32)
+    vectors = centers[rng.randint(0, 200, count)] + 0.5 * rng.randn(count, d).astype(np.float32)
+    queries = vectors[rng.choice(count, 200, replace=False)] + 0.1 * rng.randn(200, d).astype(np.float32)
+
+    flat = faiss.IndexFlatL2(d)
+    flat.add(vectors)
+    _, flat_labels = flat.search(queries, k)
+    print(f"flat: {d * 4} bytes/vector")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ["sq8", "pq"]:
+            for rerank in [1, 4, 10]:
+                index = QuantizedIndex(d, mode, os.path.join(tmp, f"{mode}-{rerank}.f32"), rerank)
+                index.add(vectors)
+                recall, latency = _recall(index, queries, k, flat_labels)
+                print(f"{mode} rerank={rerank}: {index.bytes_per_vector()} bytes/vector in memory "
+                      f"({d * 4 / index.bytes_per_vector():.0f}x smaller), recall@{k} {recall:.3f}, {latency:.2f} ms/query")
@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import pickle
+import logging
+import numpy as np
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from quantized_index import saved_files
+
+# Opt-in dimensionality reduction for saved FAISS indexes: "pca" is fitted on the
+# corpus, "random" is a data-independent random projection; empty keeps full width
+FAISS_REDUCTION = os.getenv("FAISS_REDUCTION", "")
+# Width vectors are stored and searched at; run this module on a corpus to pick it
+FAISS_REDUCED_DIM = int(os.getenv("FAISS_REDUCED_DIM", 256))
+# PCA fitted on fewer vectors than this (or twice the target width) is unreliable
+PCA_MIN_TRAIN = 1000
+
+TRANSFORM_FILE = "index.transform"
+
+
+def _new_transform(d, dim, method):
+    if method == "pca":
+        return faiss.PCAMatrix(d, dim)
+    if method == "random":
+        return faiss.RandomRotationMatrix(d, dim)
+    raise ValueError(f"Unknown FAISS reduction method: {method}")
+
+
+class ReducedIndex:
+    # Stands in for the faiss index inside LangChain's FAISS store: vectors are added
+    # and queries searched at full embedding width and both pass through the same
+    # fitted projection, so only the reduced vectors are kept. Reconstructed vectors
+    # are projected back to full width, e.g. for MMR or copying chunks between stores.
+    def __init__(self, d, dim, method, transform=None, inner=None):
+        self.d = d
+        self.dim = min(dim, d)
+        self.method = method
+        self.transform = transform
+        # Until the projection is fitted the vectors are kept at full width
+        self.inner = inner if inner is not None else faiss.IndexFlatL2(d)
+
+    @property
+    def ntotal(self):
+        return self.inner.ntotal
+
+    def _fit(self, x):
+        # PCA waits until the corpus has enough vectors to fit on, then projects all of
+        # them at once; a random projection needs no data and is fitted straight away
+        if self.method == "pca" and len(x) < max(PCA_MIN_TRAIN, 2 * self.dim):
+            return False
+        start = time.perf_counter()
+        transform = _new_transform(self.d, self.dim, self.method)
+        transform.train(x)
+        inner = faiss.IndexFlatL2(self.dim)
+        inner.add(transform.apply(x))
+        self.transform, self.inner = transform, inner
+        logging.info(f"Fitted {self.method} {self.d} -> {self.dim} on {len(x)} vectors in {time.perf_counter() - start:.2f}s")
+        return True
+
+    def apply(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        return x if self.transform is None else self.transform.apply(x)
+
+    def add(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if self.transform is None:
+            if self._fit(np.concatenate([self.inner.reconstruct_n(0, self.inner.ntotal), x])):
+                return
+        self.inner.add(self.apply(x))
+
+    def search(self, x, k):
+        return self.inner.search(self.apply(x), k)
+
+    def search_subset(self, x, k, positions):
+        params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(np.asarray(positions, dtype=np.int64)))
+        return self.inner.search(self.apply(x), k, params=params)
+
+    def _unapply(self, x):
+        return x if self.transform is None else self.transform.reverse_transform(x)
+
+    def reconstruct(self, i):
+        return self._unapply(self.inner.reconstruct(i)[None, :])[0]
+
+    def reconstruct_n(self, i0, n):
+        return self._unapply(self.inner.reconstruct_n(i0, n))
+
+    def remove_ids(self, ids):
+        return self.inner.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def bytes_per_vector(self):
+        return self.inner.d * 4
+
+
+class ReducedFAISS(FAISS):
+    @classmethod
+    def empty(cls, embeddings, d, method, dim=FAISS_REDUCED_DIM):
+        return cls(embeddings, ReducedIndex(d, dim, method), InMemoryDocstore(), {})
+
+    @classmethod
+    def from_faiss(cls, store, method, dim=FAISS_REDUCED_DIM):
+        # Convert a full-width store, fitting the projection on the whole corpus
+        reduced = cls.empty(store.embeddings, store.index.d, method, dim)
+        if store.index.ntotal:
+            reduced.index.add(store.index.reconstruct_n(0, store.index.ntotal))
+        reduced.docstore = store.docstore
+        reduced.index_to_docstore_id = dict(store.index_to_docstore_id)
+        return reduced
+
+    def save_local(self, folder_path, index_name="index"):
+        os.makedirs(folder_path, exist_ok=True)
+        if self.index.transform is not None:
+            faiss.write_VectorTransform(self.index.transform, os.path.join(folder_path, TRANSFORM_FILE))
+        faiss.write_index(self.index.inner, os.path.join(folder_path, f"{index_name}.reduced"))
+        with open(os.path.join(folder_path, f"{index_name}.pkl"), "wb") as f:
+            pickle.dump((self.docstore, self.index_to_docstore_id), f)
+        flat_path = os.path.join(folder_path, f"{index_name}.faiss")
+        if os.path.exists(flat_path):
+            os.remove(flat_path)
+
+    @classmethod
+    def load_local(cls, folder_path, embeddings, index_name="index", method=FAISS_REDUCTION, dim=FAISS_REDUCED_DIM, **kwargs):
+        inner = faiss.read_index(os.path.join(folder_path, f"{index_name}.reduced"))
+        transform_path = os.path.join(folder_path, TRANSFORM_FILE)
+        if os.path.exists(transform_path):
+            transform = faiss.read_VectorTransform(transform_path)
+            method = "pca" if isinstance(transform, faiss.PCAMatrix) else "random"
+            index = ReducedIndex(transform.d_in, transform.d_out, method, transform, inner)
+        else:
+            # Saved before there were enough vectors to fit on
+            index = ReducedIndex(inner.d, dim, method or "pca", None, inner)
+        with open(os.path.join(folder_path, f"{index_name}.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        return cls(embeddings, index, docstore, index_to_docstore_id)
+
+    @staticmethod
+    def exists(folder_path, index_name="index"):
+        return os.path.exists(os.path.join(folder_path, f"{index_name}.reduced"))
+
+
+def load_vectors(folder_path, index_name="index"):
+    # Full-width vectors of a saved corpus, flat or quantized
+    flat_path = os.path.join(folder_path, f"{index_name}.faiss")
+    if os.path.exists(flat_path):
+        index = faiss.read_index(flat_path)
+        return index.reconstruct_n(0, index.ntotal)
+    codes_path, _, vectors_path = saved_files(folder_path, index_name)
+    codes = faiss.read_index(codes_path)
+    # Rows appended after the last save are past the saved count
+    return np.fromfile(vectors_path, dtype=np.float32, count=codes.ntotal * codes.d).reshape(-1, codes.d)
+
+
+def _measure(index, queries, k, flat_labels):
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, flat_labels):
+        start = time.perf_counter()
+        _, labels = index.search(query[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += len(set(labels[0]) & set(expected))
+    return hits / flat_labels.size, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+
+if __name__ == "__main__":
+    # Recall, latency and memory per width: python reduced_index.py [corpus dir | count] [dim]
+    # A corpus directory (e.g. doc_index/<bot>) is measured on its own vectors, with
+    # held-out chunks as queries; otherwise on synthetic vectors whose variance decays
+    # across dimensions the way text embeddings do.
+    k = 4
+    rng = np.random.RandomState(0)
+    if len(sys.argv) > 1 and os.path.isdir(sys.argv[1]):
+        vectors = load_vectors(sys.argv[1])
+        held_out = rng.choice(len(vectors), min(500, len(vectors) // 10), replace=False)
+        queries = vectors[held_out]
+        vectors = np.delete(vectors, held_out, axis=0)
+        source = sys.argv[1]
+    else:
+        count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+        d = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+        scale = (np.arange(1, d + 1) ** -0.7).astype(np.float32)
+        centers = rng.randn(1000, d).astype(np.float32) * scale
+        vectors = centers[rng.randint(0, 1000, count)] + 0.5 * rng.randn(count, d).astype(np.float32) * scale
+        queries = vectors[rng.choice(count, 500, replace=False)] + 0.1 * rng.randn(500, d).astype(np.float32) * scale
+        source = "synthetic"
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    d = vectors.shape[1]
+
+    flat = faiss.IndexFlatL2(d)
+    flat.add(vectors)
+    _, flat_labels = flat.search(queries, k)
+    recall, p50, p99 = _measure(flat, queries, k, flat_labels)
+    print(f"{source}: {len(vectors)} x {d}, {len(queries)} queries")
+    print(f"full width: {d * 4} bytes/vector, {len(vectors) * d * 4 / 2 ** 20:.1f} MB, "
+          f"recall@{k} {recall:.3f}, p50 {p50:.2f} ms, p99 {p99:.2f} ms")
+
+    for dim in [w for w in [32, 64, 128, 192, 256, 384, 512] if w < d]:
+        for method in ["pca", "random"]:
+            index = ReducedIndex(d, dim, method)
+            start = time.perf_counter()
+            index.add(vectors)
+            fit = time.perf_counter() - start
+            recall, p50, p99 = _measure(index, queries, k, flat_labels)
+            print(f"{index.method} {dim}: {index.bytes_per_vector()} bytes/vector, "
+                  f"{len(vectors) * index.bytes_per_vector() / 2 ** 20:.1f} MB, recall@{k} {recall:.3f}, "
+                  f"p50 {p50:.2f} ms, p99 {p99:.2f} ms, fit+add {fit:.1f}s")
@@ -0,0 +1,101 @@
+import logging
+import threading
+from langchain.chains import RetrievalQA, create_retrieval_chain
+from langchain.chains.combine_documents import create_stuff_documents_chain
+from context_packer import PackedRetriever, context_budget
+
+
+class RetrievalPipeline:
+    # A retriever and the chain around it, built once and never modified afterwards.
+    # scope and version identify what it answers from. The retriever may own its store
+    # (the Confluence bots) or search a shared DocumentIndex corpus, which is updated
+    # in place and only promises that each retrieval sees a complete document.
+    def __init__(self, chain, scope=None, version=None, input_key="input", output_key="answer"):
+        self.chain = chain
+        self.scope = scope
+        self.version = version
+        self.input_key = input_key
+        self.output_key = output_key
+        # Called once nothing uses the pipeline any more, e.g. to drop a collection it owns
+        self.on_close = None
+        self._refs = 0
+
+    def run(self, question):
+        # The full chain output, e.g. with the source documents
+        return self.chain.invoke({self.input_key: question})
+
+    async def arun(self, question):
+        return await self.chain.ainvoke({self.input_key: question})
+
+    def invoke(self, question):
+        return self.run(question)[self.output_key]
+
+    async def ainvoke(self, question):
+        return (await self.arun(question))[self.output_key]
+
+
+def packed(llm, retriever):
+    # Overlapping chunks are stitched together and the context trimmed to the model's budget
+    return PackedRetriever(retriever=retriever, budget=context_budget(llm))
+
+
+def stuff_pipeline(llm, prompt, retriever, scope=None, version=None):
+    chain = create_retrieval_chain(packed(llm, retriever), create_stuff_documents_chain(llm, prompt))
+    return RetrievalPipeline(chain, scope, version)
+
+
+def qa_pipeline(llm, retriever, scope=None, version=None, prompt=None, return_source_documents=False):
+    chain = RetrievalQA.from_chain_type(
+        llm=llm,
+        retriever=packed(llm, retriever),
+        chain_type="stuff",
+        return_source_documents=return_source_documents,
+        chain_type_kwargs={"prompt": prompt} if prompt is not None else {},
+    )
+    return RetrievalPipeline(chain, scope, version, input_key="query", output_key="result")
+
+
+class PipelineSlot:
+    # Read-copy-update holder for the pipeline questions are answered with. Readers take
+    # `current` once per question without locking and keep using that pipeline until
+    # they finish. Writers build a complete pipeline first and publish it with one
+    # reference swap; the old one is freed when its last reader drops it.
+    # When each pipeline owns its store, an in-flight question completes against the
+    # index it started on. Pipelines over a DocumentIndex share the corpus: the swap
+    # only changes which document and version is asked about, and a question that has
+    # not retrieved yet can see a newer copy of the document than its pipeline's version.
+    # Pipelines that own resources (on_close) are read with acquire()/release() instead,
+    # so on_close runs only after the last question on the old pipeline has finished.
+    def __init__(self):
+        self.current = None
+        self.swaps = 0
+        self._lock = threading.Lock()
+
+    def publish(self, pipeline):
+        with self._lock:
+            previous, self.current = self.current, pipeline
+            self.swaps += 1
+            # The slot itself holds a reference to the current pipeline
+            pipeline._refs += 1
+            closing = previous is not None and self._unref(previous)
+        logging.info(f"Published retrieval pipeline for {pipeline.scope} (version {pipeline.version})")
+        if closing:
+            previous.on_close()
+        return previous
+
+    def acquire(self):
+        with self._lock:
+            current = self.current
+            if current is not None:
+                current._refs += 1
+            return current
+
+    def release(self, pipeline):
+        with self._lock:
+            closing = self._unref(pipeline)
+        if closing:
+            pipeline.on_close()
+
+    def _unref(self, pipeline):
+        pipeline._refs -= 1
+        return pipeline._refs == 0 and pipeline.on_close is not None
@@ -5,16 +5,17 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from chunker import LinearTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import FAISS
+from retrieval_pipeline import PipelineSlot, stuff_pipeline
+from batch_embed import build_faiss
+from bm25_index import HybridRetriever, bm25_from_faiss, faiss_lookup
+from mmr import vector_retriever
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from embedding_cache import CachedEmbeddings
 from atlassian import Confluence
 import json
-import io
-import PyPDF2
+from pdf_extract import extract_pdf_pages
 
 load_dotenv()
 
@@ -45,8 +46,9 @@ prompt = ChatPromptTemplate.from_template(
 )
 
 # Global variables to store vector store and other components
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-vectors = None
+embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model="models/embedding-001"), model_id="models/embedding-001")
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
 current_page = None
 global current_document
 current_document = None
@@ -58,31 +60,32 @@ confluence = Confluence(
     cloud=True
 )
 
-def setup_vector_store(content):
-    global vectors
-    
+def setup_vector_store(texts, metadatas=None):
     # Process the content
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    docs = text_splitter.create_documents([content])
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    docs = text_splitter.create_documents(texts, metadatas)
     if not docs:
         raise ValueError("No content could be extracted from the Confluence page.")
     
     # Create FAISS vector store
-    vectors = FAISS.from_documents(docs, embeddings)
+    vectors = build_faiss(docs, embeddings, provider="gemini")
+    # Identifier lookups (error codes, ticket keys) can be answered from BM25 without an embedding call
+    retriever = HybridRetriever(vector_retriever=vector_retriever(vectors), bm25=bm25_from_faiss(vectors), lookup=faiss_lookup(vectors))
+    # Swapped in only once the new document is fully indexed; questions already
+    # running finish against the previous one
+    pipeline.publish(stuff_pipeline(llm, prompt, retriever))
 
 def get_answer(question):
-    if vectors is None:
+    # Read the slot once: the whole question is answered from the same index version
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please select a Confluence page first."
     
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
     start = time.process_time()
-    response = retrieval_chain.invoke({'input': question})
+    answer = current.invoke(question)
     print("Response time:", time.process_time() - start)
     
-    return response['answer']
+    return answer
 
 def get_confluence_pdfs():
     try:
@@ -153,7 +156,7 @@ def get_and_process_confluence_page(page_id):
         content = page['body']['storage']['value']
         
         # Process the content
-        setup_vector_store(content)
+        setup_vector_store([content])
         current_page = page['title']
         return True, f"Page '{page['title']}' is now ready for questions. Use /askdoc to ask questions."
     except Exception as e:
@@ -214,7 +217,7 @@ def get_confluence_page_content():
         return None, f"Error during Confluence page content retrieval: {str(e)}"
 
 def get_and_process_document(doc_name):
-    global current_document, vectors
+    global current_document
     try:
         # Check if it's a page or an attachment
         pages = confluence.get_all_pages_from_space(CONFLUENCE_SPACE_KEY, start=0, limit=50)
@@ -222,7 +225,7 @@ def get_and_process_document(doc_name):
             if page['title'].lower() == doc_name.lower():
                 # It's a page
                 page_content = confluence.get_page_by_id(page['id'], expand='body.storage')['body']['storage']['value']
-                setup_vector_store(page_content)
+                setup_vector_store([page_content])
                 current_document = doc_name
                 return True, f"Page '{doc_name}' is now ready for questions. Use /askdoc to ask questions."
         
@@ -233,12 +236,12 @@ def get_and_process_document(doc_name):
                 # It's an attachment
                 attachment_content = get_attachment_content(att['downloadUrl'])
                 if att['type'] == 'application/pdf':
-                    # Process PDF content
-                    pdf_content = extract_pdf_content(attachment_content)
-                    setup_vector_store(pdf_content)
+                    # Extract pages in parallel and keep page numbers on each chunk
+                    texts, metadatas = extract_pdf_pages(attachment_content)
+                    setup_vector_store(texts, metadatas)
                 else:
                     # For other types, assume it's text
-                    setup_vector_store(attachment_content.decode('utf-8'))
+                    setup_vector_store([attachment_content.decode('utf-8')])
                 current_document = doc_name
                 return True, f"Attachment '{doc_name}' is now ready for questions. Use /askdoc to ask questions."
         
@@ -246,14 +249,6 @@ def get_and_process_document(doc_name):
     except Exception as e:
         return False, f"Error processing document: {str(e)}"
 
-def extract_pdf_content(pdf_bytes):
-    pdf_file = io.BytesIO(pdf_bytes)
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
-
 @app.command("/listpagecontent")
 def handle_listpagecontent_command(ack, respond):
     ack()
@@ -1,16 +1,24 @@
 import os
 import time
+import logging
+import shutil
+import tempfile
+import threading
 import requests
+from itertools import count
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from chunker import LinearTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
+from ingest_pipeline import stream_pdf_to_faiss
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, stuff_pipeline
+from doc_index import DocumentIndex
+from ingest_jobs import IngestJobQueue
+from index_cache import FaissIndexCache, cache_key, file_hash
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 
 load_dotenv()
@@ -37,40 +45,77 @@ prompt = ChatPromptTemplate.from_template(
     """
 )
 
+# Chunking and embedding settings; together with the PDF contents they key the index cache
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "models/embedding-001"
+
 # Global variables to store vector store and other components
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-vectors = None
+embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), model_id=EMBEDDING_MODEL)
+index_cache = FaissIndexCache()
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "faiss", "slack_gemini_rag1")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
+current_pdf = None
+# Uploads are parsed and embedded off the Slack listener threads
+ingest_jobs = IngestJobQueue()
+# Newest upload per channel: with several workers an older upload can finish last, and
+# must not switch questions back to its document
+latest_upload = {}
+upload_ids = count()
+publish_lock = threading.Lock()
 
-def setup_vector_store(file_path):
-    global vectors
+def build_vector_store(file_path, progress=None):
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return stream_pdf_to_faiss(file_path, text_splitter, embeddings, provider="gemini", progress=progress)
 
-    # Load and process the uploaded PDF
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    # Create FAISS vector store
-    vectors = FAISS.from_documents(final_documents, embeddings)
+def publish_pipeline(doc_id):
+    # Built only after ingestion completes, so questions never see a partially indexed document
+    pipeline.publish(stuff_pipeline(llm, prompt, doc_index.as_retriever(doc_id), doc_id, doc_index.version(doc_id)))
 
-def get_answer(question):
+def setup_vector_store(file_path, doc_id, progress=None):
+    # Returns where the chunks came from and how many there are when nothing was parsed.
+    # The caller publishes the document once it is indexed.
+
+    # A document already in the corpus with the same contents is not embedded again
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        return "document index", doc_index.chunks(doc_id)
+
+    # Reuse a saved index when the same PDF was processed before
+    key = cache_key(content_hash, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_MODEL)
+    vectors = index_cache.get(key, embeddings)
+    reused = ("index cache", vectors.index.ntotal) if vectors is not None else None
     if vectors is None:
+        vectors = build_vector_store(file_path, progress)
+        index_cache.put(key, vectors)
+    doc_index.add(doc_id, content_hash, vectors)
+    logging.info(f"Index cache: {index_cache.stats()}")
+    return reused
+
+def get_answer(question):
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please upload a PDF file first."
 
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
+    # Repeated questions about an unchanged document skip retrieval and generation
+    cached = answer_cache.get(current.scope, current.version, question)
+    if cached is not None:
+        return cached
+
     start = time.process_time()
-    response = retrieval_chain.invoke({'input': question})
+    answer = current.invoke(question)
     print("Response time:", time.process_time() - start)
     
-    return response['answer']
+    answer_cache.put(current.scope, current.version, question, answer)
+    return answer
 
 @app.command("/askdoc")
 def handle_command(ack, respond, command):
@@ -79,28 +124,76 @@ def handle_command(ack, respond, command):
     answer = get_answer(question)
     respond(answer)
 
+def process_uploaded_pdf(job, file_info, channel, thread_ts, status_ts, upload_id):
+    global current_pdf
+    name = file_info['name']
+
+    def post_progress(pages, chunks):
+        app.client.chat_update(channel=channel, ts=status_ts, text=f"Processing PDF {name}: {pages} pages parsed, {chunks} chunks embedded...")
+
+    job.on_progress = post_progress
+    app.client.chat_update(channel=channel, ts=status_ts, text=f"Processing PDF {name}...")
+    try:
+        headers = {
+            'Authorization': f"Bearer {os.environ['SLACK_BOT_TOKEN']}"
+        }
+        response = requests.get(file_info['url_private'], headers=headers)
+        if response.status_code != 200:
+            app.client.chat_update(channel=channel, ts=status_ts, text="Failed to download the file.")
+            return
+        # A directory of its own, so two uploads with the same name don't overwrite each
+        # other while the file keeps its name for the chunks' source
+        upload_dir = tempfile.mkdtemp(dir="pdfs")
+        file_path = os.path.join(upload_dir, name)
+        with open(file_path, "wb") as f:
+            f.write(response.content)
+        try:
+            reused = setup_vector_store(file_path, name, progress=job.progress)
+        finally:
+            # The chunks are in the document index now
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        if reused:
+            job.reuse(*reused)
+    except Exception as e:
+        app.client.chat_update(channel=channel, ts=status_ts, text=f"Error processing PDF {name}: {str(e)}")
+        raise
+    app.client.chat_update(channel=channel, ts=status_ts, text=f"Processed PDF {name}: {job.summary()} in {job.duration():.0f}s.")
+    with publish_lock:
+        newest = latest_upload.get(channel) == upload_id
+        if newest:
+            publish_pipeline(name)
+            current_pdf = name
+    if newest:
+        app.client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=f"PDF {name} has been processed and is ready for queries.")
+    else:
+        app.client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=f"PDF {name} has been processed; questions go to the PDF uploaded after it.")
+
 @app.event("message")
 def handle_file_share_events(event, say):
     if event.get("subtype") == "file_share":
         file_id = event['files'][0]['id']
         file_info = app.client.files_info(file=file_id)['file']
         if file_info['filetype'] == 'pdf':
-            file_url = file_info['url_private']
-            headers = {
-                'Authorization': f"Bearer {os.environ['SLACK_BOT_TOKEN']}"
-            }
-            response = requests.get(file_url, headers=headers)
-            if response.status_code == 200:
-                file_path = os.path.join("pdfs", file_info['name'])
-                with open(file_path, "wb") as f:
-                    f.write(response.content)
-                setup_vector_store(file_path)
-                say(f"PDF {file_info['name']} has been processed and is ready for queries.")
-            else:
-                say("Failed to download the file.")
+            # Download, parsing and embedding run on the ingestion workers so the listener returns at once
+            status = say(text=f"PDF {file_info['name']} is queued for processing ({ingest_jobs.depth()} ahead of it).", thread_ts=event['ts'])
+            upload_id = next(upload_ids)
+            with publish_lock:
+                latest_upload[event['channel']] = upload_id
+            ingest_jobs.submit(file_info['name'], process_uploaded_pdf, file_info, event['channel'], event['ts'], status['ts'], upload_id)
         else:
             say("Please upload a valid PDF file.")
 
+@app.command("/ingeststatus")
+def handle_ingeststatus_command(ack, respond):
+    ack()
+    stats = ingest_jobs.stats()
+    respond(
+        f"Ingestion queue: {stats['queued']} queued, {stats['running']} running, "
+        f"{stats['done']} done, {stats['failed']} failed. "
+        f"Average wait {stats['avg_wait_s']:.1f}s, average duration {stats['avg_duration_s']:.1f}s, "
+        f"longest {stats['max_duration_s']:.1f}s."
+    )
+
 if __name__ == "__main__":
     handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
     handler.start()
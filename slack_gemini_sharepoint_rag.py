@@ -1,16 +1,20 @@
 import os
 import time
+import logging
 import requests
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from chunker import LinearTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
+from ingest_pipeline import stream_pdf_to_faiss
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, stuff_pipeline
+from doc_index import DocumentIndex
+from progressive_ingest import is_partial, record_answer, start_progressive
+from index_cache import FaissIndexCache, cache_key, file_hash
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from msal import ConfidentialClientApplication
 import tempfile
@@ -40,9 +44,20 @@ prompt = ChatPromptTemplate.from_template(
     """
 )
 
+# Chunking and embedding settings; together with the PDF contents they key the index cache
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "models/embedding-001"
+
 # Global variables to store vector store and other components
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-vectors = None
+embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), model_id=EMBEDDING_MODEL)
+index_cache = FaissIndexCache()
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "faiss", "slack_gemini_sharepoint_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline, swapped in whenever more of a document is indexed
+pipeline = PipelineSlot()
 
 # SharePoint configuration
 SHAREPOINT_SITE_URL = os.getenv("SHAREPOINT_SITE_URL")
@@ -53,36 +68,67 @@ SHAREPOINT_TENANT_ID = os.getenv("SHAREPOINT_TENANT_ID")
 
 current_pdf = None
 
-def setup_vector_store(file_path):
-    global vectors
-    
-    # Load and process the uploaded PDF
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    # Create FAISS vector store
-    vectors = FAISS.from_documents(final_documents, embeddings)
+def build_vector_store(file_path, first_page=0, last_page=None, content_hash=None, dedup=None):
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return stream_pdf_to_faiss(file_path, text_splitter, embeddings, provider="gemini", first_page=first_page, last_page=last_page, content_hash=content_hash, dedup=dedup)
+
+def publish_pipeline(doc_id, version=None):
+    # version overrides the index's own while a document is only partly indexed
+    pipeline.publish(stuff_pipeline(llm, prompt, doc_index.as_retriever(doc_id), doc_id, version or doc_index.version(doc_id)))
+
+def setup_vector_store(file_path, doc_id, delete_file=False):
+    # Returns the progressive ingest when the document had to be embedded, None when it
+    # was indexed already. The ingest owns the file and deletes it if delete_file is set.
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        publish_pipeline(doc_id)
+        return None
+
+    # Reuse a saved index when the same PDF was processed before
+    key = cache_key(content_hash, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_MODEL)
+    vectors = index_cache.get(key, embeddings)
+    if vectors is not None:
+        doc_index.add(doc_id, content_hash, vectors)
+        publish_pipeline(doc_id)
+        return None
+
+    def on_update(ingest):
+        if ingest.done:
+            # A reduced corpus only holds lossy copies of the vectors; the cache keeps exact ones
+            if not doc_index.reduced:
+                index_cache.put(key, doc_index.load_document(doc_id))
+            logging.info(f"Index cache: {index_cache.stats()}")
+        # Another document may have been selected in the meantime
+        current = pipeline.current
+        if current is not None and current.scope == doc_id:
+            publish_pipeline(doc_id, ingest.version)
+
+    # The first pages are searchable within seconds, the rest follow in the background
+    ingest = start_progressive(doc_index, doc_id, content_hash, file_path, build_vector_store, on_update, delete_file)
+    publish_pipeline(doc_id, ingest.version)
+    return ingest
 
 def get_answer(question):
-    if vectors is None:
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please upload a PDF file first."
-    
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
-    start = time.process_time()
-    response = retrieval_chain.invoke({'input': question})
-    print("Response time:", time.process_time() - start)
-    
-    return response['answer']
+
+    # Repeated questions about an unchanged document skip retrieval and generation
+    answer = answer_cache.get(current.scope, current.version, question)
+    if answer is None:
+        start = time.process_time()
+        answer = current.invoke(question)
+        print("Response time:", time.process_time() - start)
+        record_answer(current.scope)
+        answer_cache.put(current.scope, current.version, question, answer)
+
+    if is_partial(current.version):
+        answer += "\n\n(Indexing of this document is still in progress; this answer is based on the pages processed so far.)"
+    return answer
 
 def get_sharepoint_access_token():
     app = ConfidentialClientApplication(
@@ -178,14 +224,22 @@ def download_and_process_sharepoint_pdf(filename):
             temp_file.write(response.content)
             temp_file_path = temp_file.name
 
+        ingest = None
         try:
-            setup_vector_store(temp_file_path)
+            ingest = setup_vector_store(temp_file_path, filename, delete_file=True)
             current_pdf = filename
+            if ingest is not None and not ingest.done:
+                return True, (
+                    f"Document '{filename}' is ready for questions about its first {ingest.pages_indexed} of {ingest.page_count} pages. "
+                    "The rest is being indexed in the background. Use /askdoc to ask questions."
+                )
             return True, f"Document '{filename}' is now ready for questions. Use /askdoc to ask questions."
         except Exception as e:
             return False, f"Error processing PDF: {str(e)}"
         finally:
-            os.unlink(temp_file_path)
+            # A progressive ingest deletes the file once it has read every page
+            if ingest is None:
+                os.unlink(temp_file_path)
 
     except Exception as e:
         return False, f"An unexpected error occurred: {str(e)}"
@@ -232,7 +286,7 @@ def handle_file_share_events(event, say):
                 file_path = os.path.join("pdfs", file_info['name'])
                 with open(file_path, "wb") as f:
                     f.write(response.content)
-                setup_vector_store(file_path)
+                setup_vector_store(file_path, file_info['name'])
                 global current_pdf
                 current_pdf = file_info['name']
                 say(f"PDF {file_info['name']} has been processed and is ready for queries.")
@@ -3,13 +3,17 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from chunker import LinearTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFDirectoryLoader
+from batch_embed import RateLimiter, provider_settings
+from ingest_pipeline import stream_pdf_to_faiss
+from doc_index import DocumentIndex
+from dir_ingest import sync_directory
+from index_artifact import SharedIndex
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, stuff_pipeline
 import time
 
 load_dotenv()
@@ -38,37 +42,72 @@ prompt = ChatPromptTemplate.from_template(
 
 # Global variables to store vector store and other components
 embeddings = None
-vectors = None
+knowledge_base = None
+answer_cache = None
+# Questions run through a prebuilt pipeline, rebuilt once per published artifact version
+pipeline = PipelineSlot()
+# Extra processes serving the same knowledge base set this and only open the published index
+INDEX_READ_ONLY = os.getenv("INDEX_READ_ONLY") == "1"
 
 def setup_vector_store():
-    global embeddings, vectors
-    embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
-    loader = PyPDFDirectoryLoader("pdfs")  # Data Ingestion
-    docs = loader.load()  # Document Loading
-    if not docs:
-        print("No documents found in the ./us_census directory. Please check if the directory exists and contains PDF files.")
+    global embeddings, knowledge_base, answer_cache
+    embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model="models/embedding-001"), model_id="models/embedding-001")
+    answer_cache = AnswerCache(embeddings)
+    if INDEX_READ_ONLY:
+        knowledge_base = SharedIndex(embeddings, "slack_rag")
+        if knowledge_base.store is None:
+            print("No published index found. Start one instance without INDEX_READ_ONLY to build it.")
         return
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)  # Chunk Creation
-    final_documents = text_splitter.split_documents(docs[:20])  # splitting
-    if not final_documents:
-        print("No text could be extracted from the documents. Please check the content of your PDF files.")
+
+    doc_index = DocumentIndex(embeddings, "faiss", "slack_rag", publish=True)
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)  # Chunk Creation
+    # Files ingested in parallel share one limiter so together they respect the Gemini quota
+    limiter = RateLimiter(provider_settings("gemini")["requests_per_minute"])
+
+    # Only new or changed PDFs are parsed and embedded; removed ones are dropped from the index
+    summary = sync_directory(
+        "pdfs",
+        doc_index,
+        lambda file_path: stream_pdf_to_faiss(file_path, text_splitter, embeddings, provider="gemini", limiter=limiter),
+    )
+    if doc_index.store is None or doc_index.store.index.ntotal == 0:
+        print("No documents found in the ./pdfs directory. Please check if the directory exists and contains PDF files.")
         return
-    vectors = FAISS.from_documents(final_documents, embeddings)  # vector OpenAI embeddings
-    print(f"Vector store created with {len(final_documents)} documents.")
+    print(f"Vector store ready with {doc_index.store.index.ntotal} chunks: {summary}")
+    # Answer from the memory-mapped artifact that every instance shares
+    knowledge_base = SharedIndex(embeddings, "slack_rag")
 
 # Set up vector store on startup
 setup_vector_store()
 
+def current_pipeline():
+    # A newly published artifact gets a pipeline of its own; questions already running keep the old one.
+    # None until an artifact has been published (empty ./pdfs, or a reader started before the writer)
+    if knowledge_base is None or knowledge_base.refresh() is None:
+        return None
+    current = pipeline.current
+    if current is None or current.version != knowledge_base.version:
+        # Version is read before the retriever so a concurrent refresh only causes another rebuild
+        version = knowledge_base.version
+        current = stuff_pipeline(llm, prompt, knowledge_base.as_retriever(), "knowledge_base", version)
+        pipeline.publish(current)
+    return current
+
 def get_answer(question):
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
+    current = current_pipeline()
+    if current is None:
+        return "No index is available yet. Please add PDF files to the ./pdfs directory and restart the indexing instance."
+    # Cached answers are tied to the published artifact version, so a re-sync invalidates them
+    cached = answer_cache.get(current.scope, current.version, question)
+    if cached is not None:
+        return cached
+
     start = time.process_time()
-    response = retrieval_chain.invoke({'input': question})
+    answer = current.invoke(question)
     print("Response time:", time.process_time() - start)
     
-    return response['answer']
+    answer_cache.put(current.scope, current.version, question, answer)
+    return answer
 
 @app.event("app_mention")
 def handle_mention(event, say):
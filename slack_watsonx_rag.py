@@ -1,15 +1,24 @@
 import os
 import time
+import shutil
+import tempfile
+import threading
 import requests
+from itertools import count
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain, RetrievalQA
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.document_loaders import PyPDFLoader
+from langchain.chains import LLMChain
+from chunker import LinearTextSplitter
+from ingest_pipeline import stream_pdf_to_chroma
+from doc_index import DocumentIndex
+from ingest_jobs import IngestJobQueue
+from index_cache import file_hash
 from langchain_ibm import WatsonxLLM, WatsonxEmbeddings
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, qa_pipeline
 from ibm_watsonx_ai.foundation_models.utils.enums import EmbeddingTypes, ModelTypes
 from ibm_watsonx_ai.metanames import GenTextParamsMetaNames as GenParams
 from ibm_watsonx_ai.foundation_models.utils.enums import DecodingMethods
@@ -38,50 +47,69 @@ llm = WatsonxLLM(
     }
 )
 
-embeddings = WatsonxEmbeddings(
-    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
-    url=watsonx_url,
-    apikey=watsonx_api_key,
-    project_id=project_id
+# Chunk vectors are cached on disk so re-selected documents only embed changed chunks
+embeddings = CachedEmbeddings(
+    WatsonxEmbeddings(
+        model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
+        url=watsonx_url,
+        apikey=watsonx_api_key,
+        project_id=project_id
+    ),
+    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value
 )
 
-# Global variable to store vector store
-docsearch = None
-
-def setup_vector_store(file_path):
-    global docsearch
-
-    # Load and process the uploaded PDF
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    # Create Chroma vector store
-    docsearch = Chroma.from_documents(final_documents, embeddings)
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "chroma", "slack_watsonx_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
+current_pdf = None
+# Uploads are parsed and embedded off the Slack listener threads
+ingest_jobs = IngestJobQueue()
+# Newest upload per channel: with several workers an older upload can finish last, and
+# must not switch questions back to its document
+latest_upload = {}
+upload_ids = count()
+publish_lock = threading.Lock()
+
+def publish_pipeline(doc_id):
+    # Built only after ingestion completes, so questions never see a partially indexed document
+    pipeline.publish(qa_pipeline(llm, doc_index.as_retriever(doc_id), doc_id, doc_index.version(doc_id)))
+
+def setup_vector_store(file_path, doc_id, progress=None):
+    # Returns where the chunks came from and how many there are when nothing was parsed.
+    # The caller publishes the document once it is indexed.
+
+    # A document already in the corpus with the same contents is not embedded again
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        return "document index", doc_index.chunks(doc_id)
+
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    doc_index.add(doc_id, content_hash, stream_pdf_to_chroma(file_path, text_splitter, embeddings, provider="watsonx", progress=progress))
 
 def get_answer(question):
-    if docsearch is None:
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please upload a PDF file first."
 
-    # Set up a RetrievalQA chain
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=docsearch.as_retriever(),
-        chain_type="stuff",  # Use "map_reduce" or "refine" for larger documents
-    )
+    # Repeated questions about an unchanged document skip retrieval and generation
+    cached = answer_cache.get(current.scope, current.version, question)
+    if cached is not None:
+        return cached
 
     start = time.process_time()
     try:
         # Run the chain with the question
-        response = qa_chain({"query": question})
+        answer = current.invoke(question)
         print("Response time:", time.process_time() - start)
-        return response.get('result', 'No output found')
+        answer_cache.put(current.scope, current.version, question, answer)
+        return answer
     except Exception as e:
         print(f"Error during retrieval: {e}")
         return "An error occurred while retrieving the answer."
@@ -93,28 +121,76 @@ def handle_command(ack, respond, command):
     answer = get_answer(question)
     respond(answer)
 
+def process_uploaded_pdf(job, file_info, channel, thread_ts, status_ts, upload_id):
+    global current_pdf
+    name = file_info['name']
+
+    def post_progress(pages, chunks):
+        app.client.chat_update(channel=channel, ts=status_ts, text=f"Processing PDF {name}: {pages} pages parsed, {chunks} chunks embedded...")
+
+    job.on_progress = post_progress
+    app.client.chat_update(channel=channel, ts=status_ts, text=f"Processing PDF {name}...")
+    try:
+        headers = {
+            'Authorization': f"Bearer {os.environ['SLACK_BOT_TOKEN']}"
+        }
+        response = requests.get(file_info['url_private'], headers=headers)
+        if response.status_code != 200:
+            app.client.chat_update(channel=channel, ts=status_ts, text="Failed to download the file.")
+            return
+        # A directory of its own, so two uploads with the same name don't overwrite each
+        # other while the file keeps its name for the chunks' source
+        upload_dir = tempfile.mkdtemp(dir="pdfs")
+        file_path = os.path.join(upload_dir, name)
+        with open(file_path, "wb") as f:
+            f.write(response.content)
+        try:
+            reused = setup_vector_store(file_path, name, progress=job.progress)
+        finally:
+            # The chunks are in the document index now
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        if reused:
+            job.reuse(*reused)
+    except Exception as e:
+        app.client.chat_update(channel=channel, ts=status_ts, text=f"Error processing PDF {name}: {str(e)}")
+        raise
+    app.client.chat_update(channel=channel, ts=status_ts, text=f"Processed PDF {name}: {job.summary()} in {job.duration():.0f}s.")
+    with publish_lock:
+        newest = latest_upload.get(channel) == upload_id
+        if newest:
+            publish_pipeline(name)
+            current_pdf = name
+    if newest:
+        app.client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=f"PDF {name} has been processed and is ready for queries.")
+    else:
+        app.client.chat_postMessage(channel=channel, thread_ts=thread_ts, text=f"PDF {name} has been processed; questions go to the PDF uploaded after it.")
+
 @app.event("message")
 def handle_file_share_events(event, say):
     if event.get("subtype") == "file_share":
         file_id = event['files'][0]['id']
         file_info = app.client.files_info(file=file_id)['file']
         if file_info['filetype'] == 'pdf':
-            file_url = file_info['url_private']
-            headers = {
-                'Authorization': f"Bearer {os.environ['SLACK_BOT_TOKEN']}"
-            }
-            response = requests.get(file_url, headers=headers)
-            if response.status_code == 200:
-                file_path = os.path.join("pdfs", file_info['name'])
-                with open(file_path, "wb") as f:
-                    f.write(response.content)
-                setup_vector_store(file_path)
-                say(f"PDF {file_info['name']} has been processed and is ready for queries.")
-            else:
-                say("Failed to download the file.")
+            # Download, parsing and embedding run on the ingestion workers so the listener returns at once
+            status = say(text=f"PDF {file_info['name']} is queued for processing ({ingest_jobs.depth()} ahead of it).", thread_ts=event['ts'])
+            upload_id = next(upload_ids)
+            with publish_lock:
+                latest_upload[event['channel']] = upload_id
+            ingest_jobs.submit(file_info['name'], process_uploaded_pdf, file_info, event['channel'], event['ts'], status['ts'], upload_id)
         else:
             say("Please upload a valid PDF file.")
 
+@app.command("/ingeststatus")
+def handle_ingeststatus_command(ack, respond):
+    ack()
+    stats = ingest_jobs.stats()
+    respond(
+        f"Ingestion queue: {stats['queued']} queued, {stats['running']} running, "
+        f"{stats['done']} done, {stats['failed']} failed. "
+        f"Average wait {stats['avg_wait_s']:.1f}s, average duration {stats['avg_duration_s']:.1f}s, "
+        f"longest {stats['max_duration_s']:.1f}s."
+    )
+
 if __name__ == "__main__":
     handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
     handler.start()
@@ -5,11 +5,16 @@ from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain, RetrievalQA
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.document_loaders import PyPDFLoader
+from langchain.chains import LLMChain
+from chunker import LinearTextSplitter
+from ingest_pipeline import stream_pdf_to_chroma
+from doc_index import DocumentIndex
+from progressive_ingest import is_partial, record_answer, start_progressive
+from index_cache import file_hash
 from langchain_ibm import WatsonxLLM, WatsonxEmbeddings
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, qa_pipeline
 from ibm_watsonx_ai.foundation_models.utils.enums import EmbeddingTypes, ModelTypes
 from ibm_watsonx_ai.metanames import GenTextParamsMetaNames as GenParams
 from ibm_watsonx_ai.foundation_models.utils.enums import DecodingMethods
@@ -41,15 +46,24 @@ llm = WatsonxLLM(
     }
 )
 
-embeddings = WatsonxEmbeddings(
-    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
-    url=watsonx_url,
-    apikey=watsonx_api_key,
-    project_id=project_id
+# Chunk vectors are cached on disk so re-selected documents only embed changed chunks
+embeddings = CachedEmbeddings(
+    WatsonxEmbeddings(
+        model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
+        url=watsonx_url,
+        apikey=watsonx_api_key,
+        project_id=project_id
+    ),
+    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value
 )
 
 # Global variables
-docsearch = None
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "chroma", "slack_watsonx_sharepoint_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline, swapped in whenever more of a document is indexed
+pipeline = PipelineSlot()
 current_pdf = None
 
 # SharePoint configuration
@@ -59,27 +73,8 @@ SHAREPOINT_CLIENT_ID = os.getenv("SHAREPOINT_CLIENT_ID")
 SHAREPOINT_CLIENT_SECRET = os.getenv("SHAREPOINT_CLIENT_SECRET")
 SHAREPOINT_TENANT_ID = os.getenv("SHAREPOINT_TENANT_ID")
 
-def setup_vector_store(file_path):
-    global docsearch
-
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    docsearch = Chroma.from_documents(final_documents, embeddings)
-
-def get_answer(question):
-    if docsearch is None:
-        return "No document has been processed yet. Please use /usedoc to select a document first."
-
-    qa_prompt = PromptTemplate(
-        template="""You are an AI assistant that answers questions based on the given context. 
+qa_prompt = PromptTemplate(
+    template="""You are an AI assistant that answers questions based on the given context. 
         If the answer cannot be found in the context, say "I'm sorry, but I don't have enough information to answer that question based on the document I've been given."
         Do not use any external knowledge.
 
@@ -87,30 +82,67 @@ def get_answer(question):
 
         Human: {question}
         AI Assistant: Provide a clear and concise answer to the question based on the given context. If the information is not in the context, state that you don't have enough information to answer.""",
-        input_variables=["context", "question"]
-    )
+    input_variables=["context", "question"]
+)
 
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=docsearch.as_retriever(),
-        chain_type="stuff",
-        chain_type_kwargs={"prompt": qa_prompt}
-    )
+def publish_pipeline(doc_id, version=None):
+    # version overrides the index's own while a document is only partly indexed
+    pipeline.publish(qa_pipeline(llm, doc_index.as_retriever(doc_id), doc_id, version or doc_index.version(doc_id), prompt=qa_prompt))
 
-    start = time.process_time()
-    try:
-        response = qa_chain({"query": question})
-        print("Response time:", time.process_time() - start)
-        answer = response.get('result', 'No output found')
-        
-        # Remove any mention of sources or file paths
-        answer = answer.split("\n\nSources:")[0]
-        answer = answer.replace("C:\\Users\\PC\\AppData\\Local\\Temp\\", "")
-        
-        return answer.strip()
-    except Exception as e:
-        print(f"Error during retrieval: {e}")
-        return "An error occurred while retrieving the answer."
+def build_vector_store(file_path, first_page=0, last_page=None, content_hash=None):
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    return stream_pdf_to_chroma(file_path, text_splitter, embeddings, provider="watsonx", first_page=first_page, last_page=last_page, content_hash=content_hash)
+
+def setup_vector_store(file_path, doc_id, delete_file=False):
+    # Returns the progressive ingest when the document had to be embedded, None when it
+    # was indexed already. The ingest owns the file and deletes it if delete_file is set.
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        publish_pipeline(doc_id)
+        return None
+
+    def on_update(ingest):
+        # Another document may have been selected in the meantime
+        current = pipeline.current
+        if current is not None and current.scope == doc_id:
+            publish_pipeline(doc_id, ingest.version)
+
+    # The first pages are searchable within seconds, the rest follow in the background
+    ingest = start_progressive(doc_index, doc_id, content_hash, file_path, build_vector_store, on_update, delete_file)
+    publish_pipeline(doc_id, ingest.version)
+    return ingest
+
+def get_answer(question):
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
+        return "No document has been processed yet. Please use /usedoc to select a document first."
+
+    # Repeated questions about an unchanged document skip retrieval and generation
+    answer = answer_cache.get(current.scope, current.version, question)
+    if answer is None:
+        start = time.process_time()
+        try:
+            answer = current.invoke(question)
+            print("Response time:", time.process_time() - start)
+            record_answer(current.scope)
+            
+            # Remove any mention of sources or file paths
+            answer = answer.split("\n\nSources:")[0]
+            answer = answer.replace("C:\\Users\\PC\\AppData\\Local\\Temp\\", "")
+            
+            answer = answer.strip()
+            answer_cache.put(current.scope, current.version, question, answer)
+        except Exception as e:
+            print(f"Error during retrieval: {e}")
+            return "An error occurred while retrieving the answer."
+
+    if is_partial(current.version):
+        answer += "\n\n(Indexing of this document is still in progress; this answer is based on the pages processed so far.)"
+    return answer
 
 def get_sharepoint_access_token():
     app = ConfidentialClientApplication(
@@ -199,14 +231,22 @@ def download_and_process_sharepoint_pdf(filename):
             temp_file.write(response.content)
             temp_file_path = temp_file.name
 
+        ingest = None
         try:
-            setup_vector_store(temp_file_path)
+            ingest = setup_vector_store(temp_file_path, filename, delete_file=True)
             current_pdf = filename
+            if ingest is not None and not ingest.done:
+                return True, (
+                    f"Document '{filename}' is ready for questions about its first {ingest.pages_indexed} of {ingest.page_count} pages. "
+                    "The rest is being indexed in the background. Use /askdoc to ask questions."
+                )
             return True, f"Document '{filename}' is now ready for questions. Use /askdoc to ask questions."
         except Exception as e:
             return False, f"Error processing PDF: {str(e)}"
         finally:
-            os.unlink(temp_file_path)
+            # A progressive ingest deletes the file once it has read every page
+            if ingest is None:
+                os.unlink(temp_file_path)
 
     except Exception as e:
         return False, f"An unexpected error occurred: {str(e)}"
@@ -253,7 +293,7 @@ def handle_file_share_events(event, say):
                 file_path = os.path.join("pdfs", file_info['name'])
                 with open(file_path, "wb") as f:
                     f.write(response.content)
-                setup_vector_store(file_path)
+                setup_vector_store(file_path, file_info['name'])
                 global current_pdf
                 current_pdf = file_info['name']
                 say(f"PDF {file_info['name']} has been processed and is ready for queries.")
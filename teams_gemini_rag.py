@@ -7,13 +7,16 @@ from botbuilder.schema import Activity
 from quart import Quart, request, Response
 from botbuilder.core.integration import aiohttp_error_middleware
 
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import PipelineSlot, stuff_pipeline
+from doc_index import DocumentIndex
+from progressive_ingest import is_partial, record_answer, start_progressive
+from index_cache import FaissIndexCache, cache_key, file_hash
 from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains.combine_documents import create_stuff_documents_chain
+from chunker import LinearTextSplitter
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import FAISS
-from langchain_community.document_loaders import PyPDFLoader
+from ingest_pipeline import stream_pdf_to_faiss
 
 import aiohttp
 import time
@@ -44,7 +47,14 @@ prompt = ChatPromptTemplate.from_template("""
     Human: {input}
     AI: """)
 
-embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+# Chunking and embedding settings; together with the PDF contents they key the index cache
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBEDDING_MODEL = "models/embedding-001"
+# Seconds between checks whether a background ingest has finished
+INGEST_POLL_INTERVAL = 5
+
+embeddings = CachedEmbeddings(GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL), model_id=EMBEDDING_MODEL)
 
 # SharePoint configuration
 SHAREPOINT_SITE_URL = os.getenv("SHAREPOINT_SITE_URL")
@@ -53,8 +63,14 @@ SHAREPOINT_CLIENT_ID = os.getenv("SHAREPOINT_CLIENT_ID")
 SHAREPOINT_CLIENT_SECRET = os.getenv("SHAREPOINT_CLIENT_SECRET")
 SHAREPOINT_TENANT_ID = os.getenv("SHAREPOINT_TENANT_ID")
 
-# Global variable to store vector store
-vectors = None
+# Saved per-document indexes
+index_cache = FaissIndexCache()
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "faiss", "teams_gemini_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
 
 # Create Quart app
 app = Quart(__name__)
@@ -66,38 +82,72 @@ SETTINGS = BotFrameworkAdapterSettings(
 )
 ADAPTER = BotFrameworkAdapter(SETTINGS)
 
-def setup_vector_store(file_path):
-    global vectors
-    
-    logging.info(f"Setting up vector store for file: {file_path}")
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    vectors = FAISS.from_documents(final_documents, embeddings)
-    logging.info("Vector store setup completed successfully.")
+def build_vector_store(file_path, first_page=0, last_page=None, content_hash=None, dedup=None):
+    logging.info(f"Setting up vector store for file: {file_path} (pages {first_page}-{last_page})")
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    return stream_pdf_to_faiss(file_path, text_splitter, embeddings, provider="gemini", first_page=first_page, last_page=last_page, content_hash=content_hash, dedup=dedup)
+
+def publish_pipeline(doc_id, version=None):
+    # version overrides the index's own while a document is only partly indexed
+    pipeline.publish(stuff_pipeline(llm, prompt, doc_index.as_retriever(doc_id), doc_id, version or doc_index.version(doc_id)))
+
+def setup_vector_store(file_path, doc_id, delete_file=False):
+    # Returns the progressive ingest when the document had to be embedded, None when it
+    # was indexed already. The ingest owns the file and deletes it if delete_file is set.
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        publish_pipeline(doc_id)
+        return None
+
+    # Reuse a saved index when the same PDF was processed before
+    key = cache_key(content_hash, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_MODEL)
+    vectors = index_cache.get(key, embeddings)
+    if vectors is not None:
+        doc_index.add(doc_id, content_hash, vectors)
+        publish_pipeline(doc_id)
+        return None
+
+    def on_update(ingest):
+        if ingest.done:
+            # A reduced corpus only holds lossy copies of the vectors; the cache keeps exact ones
+            if not doc_index.reduced:
+                index_cache.put(key, doc_index.load_document(doc_id))
+            logging.info(f"Vector store setup completed successfully. Index cache: {index_cache.stats()}")
+        # Another document may have been selected in the meantime
+        current = pipeline.current
+        if current is not None and current.scope == doc_id:
+            publish_pipeline(doc_id, ingest.version)
+
+    # The first pages are searchable within seconds, the rest follow in the background
+    ingest = start_progressive(doc_index, doc_id, content_hash, file_path, build_vector_store, on_update, delete_file)
+    publish_pipeline(doc_id, ingest.version)
+    return ingest
 
 async def get_answer(question):
-    if vectors is None:
+    # Read the slot once for the document and version to answer from. The corpus is
+    # shared and re-indexed in place, so retrieval sees it either before or after a
+    # concurrent update of the document, never half-way (see DocumentIndex)
+    current = pipeline.current
+    if current is None:
         return "No document has been processed yet. Please upload a PDF file first."
     
-    document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever()
-    retrieval_chain = create_retrieval_chain(retriever, document_chain)
-    
-    response = await retrieval_chain.ainvoke({'input': question})
-    
-    return response['answer']
+    # Repeated questions about an unchanged document skip retrieval and generation
+    answer = await asyncio.to_thread(answer_cache.get, current.scope, current.version, question)
+    if answer is None:
+        answer = await current.ainvoke(question)
+        record_answer(current.scope)
+        await asyncio.to_thread(answer_cache.put, current.scope, current.version, question, answer)
+
+    if is_partial(current.version):
+        answer += "\n\n(Indexing of this document is still in progress; this answer is based on the pages processed so far.)"
+    return answer
 
 class TeamsBot:
     def __init__(self):
         self.current_pdf = None
+        # Follow-up messages waiting for background ingests; referenced so they are not collected
+        self.followups = set()
 
     async def on_turn(self, turn_context: TurnContext):
         if turn_context.activity.type == "message":
@@ -186,14 +236,22 @@ class TeamsBot:
                 temp_file.write(response.content)
                 temp_file_path = temp_file.name
 
+            ingest = None
             try:
-                setup_vector_store(temp_file_path)
+                ingest = setup_vector_store(temp_file_path, filename, delete_file=True)
                 self.current_pdf = filename
+                if ingest is not None and not ingest.done:
+                    return True, (
+                        f"Document '{filename}' is ready for questions about its first {ingest.pages_indexed} of {ingest.page_count} pages. "
+                        "The rest is being indexed in the background. Use /askdoc to ask questions."
+                    )
                 return True, f"Document '{filename}' is now ready for questions. Use /askdoc to ask questions."
             except Exception as e:
                 return False, f"Error processing PDF: {str(e)}"
             finally:
-                os.unlink(temp_file_path)
+                # A progressive ingest deletes the file once it has read every page
+                if ingest is None:
+                    os.unlink(temp_file_path)
 
         except Exception as e:
             return False, f"An unexpected error occurred: {str(e)}"
@@ -273,9 +331,20 @@ class TeamsBot:
                             pdf_file.write(file_content)
                         
                         try:
-                            setup_vector_store(file_path)
+                            ingest = setup_vector_store(file_path, attachment.name)
                             self.current_pdf = attachment.name
-                            await turn_context.send_activity(f"PDF {attachment.name} has been processed and is ready for queries.")
+                            if ingest is not None and not ingest.done:
+                                await turn_context.send_activity(
+                                    f"PDF {attachment.name} is ready for questions, but answers only cover its first "
+                                    f"{ingest.pages_indexed} of {ingest.page_count} pages for now. The rest is being "
+                                    "indexed in the background; I'll post here when it's done."
+                                )
+                                reference = TurnContext.get_conversation_reference(turn_context.activity)
+                                followup = asyncio.create_task(self.notify_when_indexed(reference, attachment.name, ingest))
+                                self.followups.add(followup)
+                                followup.add_done_callback(self.followups.discard)
+                            else:
+                                await turn_context.send_activity(f"PDF {attachment.name} has been processed and is ready for queries.")
                         except Exception as e:
                             logging.error(f"Error processing PDF: {str(e)}")
                             await turn_context.send_activity(f"Error processing PDF: {str(e)}")
@@ -289,6 +358,25 @@ class TeamsBot:
         if not any(att.content_type == "application/vnd.microsoft.teams.file.download.info" for att in turn_context.activity.attachments):
             await turn_context.send_activity("Please upload a valid PDF file.")
 
+    async def notify_when_indexed(self, reference, name, ingest):
+        while not ingest.finished.is_set():
+            await asyncio.sleep(INGEST_POLL_INTERVAL)
+        if ingest.done:
+            text = f"PDF {name} is now fully indexed; answers cover all {ingest.page_count} pages."
+        elif ingest.error is not None:
+            text = f"Indexing of PDF {name} stopped after {ingest.pages_indexed} of {ingest.page_count} pages: {str(ingest.error)}"
+        else:
+            # A newer upload of the same document took over, and reports on itself
+            return
+
+        async def send(turn_context):
+            await turn_context.send_activity(text)
+
+        try:
+            await ADAPTER.continue_conversation(reference, send, SETTINGS.app_id)
+        except Exception as e:
+            logging.error(f"Could not send the indexing follow-up for {name}: {str(e)}")
+
     async def download_file(self, file_url: str) -> bytes:
         async with aiohttp.ClientSession() as session:
             async with session.get(file_url) as response:
@@ -8,9 +8,13 @@ from quart import Quart, request, Response
 from botbuilder.core.integration import aiohttp_error_middleware
 
 from langchain_ibm import WatsonxLLM, WatsonxEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.chains import RetrievalQA
-from langchain_community.vectorstores import Chroma
+from embedding_cache import CachedEmbeddings
+from chunker import LinearTextSplitter
+from retrieval_pipeline import PipelineSlot, qa_pipeline
+from batch_embed import build_chroma
+from chroma_registry import registry
+from bm25_index import HybridRetriever, bm25_from_chroma, chroma_lookup
+from mmr import vector_retriever
 from ibm_watsonx_ai.foundation_models.utils.enums import ModelTypes, EmbeddingTypes
 from ibm_watsonx_ai.metanames import GenTextParamsMetaNames as GenParams
 from ibm_watsonx_ai.foundation_models.utils.enums import DecodingMethods
@@ -20,8 +24,7 @@ from langchain.prompts import PromptTemplate
 import aiohttp
 import time
 import requests
-import io
-import PyPDF2
+from pdf_extract import extract_pdf_pages
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -53,11 +56,15 @@ llm = WatsonxLLM(
     }
 )
 
-embeddings = WatsonxEmbeddings(
-    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
-    url=watsonx_url,
-    apikey=watsonx_api_key,
-    project_id=project_id
+# Chunk vectors are cached on disk so re-selected documents only embed changed chunks
+embeddings = CachedEmbeddings(
+    WatsonxEmbeddings(
+        model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
+        url=watsonx_url,
+        apikey=watsonx_api_key,
+        project_id=project_id
+    ),
+    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value
 )
 
 # Initialize Confluence client
@@ -79,24 +86,11 @@ SETTINGS = BotFrameworkAdapterSettings(
 ADAPTER = BotFrameworkAdapter(SETTINGS)
 
 # Global variables
-docsearch = None
+# Questions run through a prebuilt pipeline that is swapped in once a document is fully ingested
+pipeline = PipelineSlot()
 current_document = None
 
-def setup_vector_store(content):
-    global docsearch
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    docs = text_splitter.create_documents([content])
-    if not docs:
-        raise ValueError("No content could be extracted from the document.")
-    
-    docsearch = Chroma.from_documents(docs, embeddings)
-
-async def get_answer(question):
-    if docsearch is None:
-        return "No document has been processed yet. Please select a Confluence page or attachment first."
-    
-    custom_prompt_template = """You are an AI assistant that only answers questions based on the given context. 
+custom_prompt_template = """You are an AI assistant that only answers questions based on the given context. 
     Do not use any external knowledge or information not present in the context.
     If the answer cannot be found in the context, or if the context is not relevant to the question, say "I don't have enough information to answer that question based on the current document."
     Be very strict about only using information from the given context.
@@ -107,21 +101,46 @@ async def get_answer(question):
 
     Answer:"""
 
-    CUSTOM_PROMPT = PromptTemplate(
-        template=custom_prompt_template, input_variables=["context", "question"]
-    )
+CUSTOM_PROMPT = PromptTemplate(
+    template=custom_prompt_template, input_variables=["context", "question"]
+)
 
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        retriever=docsearch.as_retriever(search_kwargs={"k": 3}),
-        chain_type="stuff",
-        return_source_documents=True,
-        chain_type_kwargs={"prompt": CUSTOM_PROMPT}
-    )
+def setup_vector_store(texts, metadatas=None):
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    docs = text_splitter.create_documents(texts, metadatas)
+    if not docs:
+        raise ValueError("No content could be extracted from the document.")
+    
+    docsearch = build_chroma(docs, embeddings, provider="watsonx")
+    try:
+        # Identifier lookups (error codes, ticket keys) can be answered from BM25 without an embedding call
+        retriever = HybridRetriever(
+            vector_retriever=vector_retriever(docsearch, k=3),
+            bm25=bm25_from_chroma(docsearch),
+            lookup=chroma_lookup(docsearch),
+            k=3,
+        )
+        new_pipeline = qa_pipeline(llm, retriever, prompt=CUSTOM_PROMPT, return_source_documents=True)
+    except Exception:
+        registry.release(docsearch)
+        raise
+    # The pipeline owns the collection: it is dropped once the pipeline is replaced
+    # and the last question running on it has finished
+    new_pipeline.on_close = lambda: registry.release(docsearch)
+    # Swapped in only once the new document is fully indexed; questions already
+    # running finish against the previous one
+    pipeline.publish(new_pipeline)
+    logging.info(f"Chroma collections: {registry.stats()}")
+
+async def get_answer(question):
+    # Hold the pipeline for the whole question so its collection is not dropped mid-answer
+    current = pipeline.acquire()
+    if current is None:
+        return "No document has been processed yet. Please select a Confluence page or attachment first."
     
     start = time.process_time()
     try:
-        response = await qa_chain.acall({"query": question})
+        response = await current.arun(question)
         print("Response time:", time.process_time() - start)
         
         # Check if the retrieved documents are relevant
@@ -136,6 +155,8 @@ async def get_answer(question):
     except Exception as e:
         logging.error(f"Error during retrieval: {e}")
         return "An error occurred while retrieving the answer from the current document."
+    finally:
+        pipeline.release(current)
 
 
 async def get_confluence_pages():
@@ -172,16 +193,8 @@ async def get_attachment_content(download_url):
             else:
                 raise Exception(f"Failed to download attachment. Status code: {response.status}")
 
-def extract_pdf_content(pdf_bytes):
-    pdf_file = io.BytesIO(pdf_bytes)
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
-
 async def get_and_process_document(doc_name):
-    global current_document, docsearch
+    global current_document
     try:
         # Check if it's a page or an attachment
         pages, error = await get_confluence_pages()
@@ -192,7 +205,7 @@ async def get_and_process_document(doc_name):
             if page['title'].lower() == doc_name.lower():
                 # It's a page
                 page_content = confluence.get_page_by_id(page['id'], expand='body.storage')['body']['storage']['value']
-                setup_vector_store(page_content)
+                setup_vector_store([page_content])
                 current_document = doc_name
                 return True, f"Page '{doc_name}' is now ready for questions. Use /askdoc to ask questions."
         
@@ -206,12 +219,12 @@ async def get_and_process_document(doc_name):
                 # It's an attachment
                 attachment_content = await get_attachment_content(att['downloadUrl'])
                 if att['type'] == 'application/pdf':
-                    # Process PDF content
-                    pdf_content = extract_pdf_content(attachment_content)
-                    setup_vector_store(pdf_content)
+                    # Extract pages in parallel and keep page numbers on each chunk
+                    texts, metadatas = extract_pdf_pages(attachment_content)
+                    setup_vector_store(texts, metadatas)
                 else:
                     # For other types, assume it's text
-                    setup_vector_store(attachment_content.decode('utf-8'))
+                    setup_vector_store([attachment_content.decode('utf-8')])
                 current_document = doc_name
                 return True, f"Attachment '{doc_name}' is now ready for questions. Use /askdoc to ask questions."
         
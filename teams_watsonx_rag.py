@@ -8,12 +8,18 @@ from quart import Quart, request, Response
 from botbuilder.core.integration import aiohttp_error_middleware
 
 from langchain_ibm import WatsonxLLM, WatsonxEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from embedding_cache import CachedEmbeddings
+from answer_cache import AnswerCache
+from retrieval_pipeline import packed
+from mmr import vector_retriever
+from chunker import LinearTextSplitter
 from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.chains import create_retrieval_chain
-from langchain_community.vectorstores import Chroma
-from langchain_community.document_loaders import PyPDFLoader
+from ingest_pipeline import stream_pdf_to_chroma
+from doc_index import DocumentIndex
+from conversation_index import ConversationIndexes
+from index_cache import file_hash
 from ibm_watsonx_ai.foundation_models.utils.enums import EmbeddingTypes, ModelTypes
 from ibm_watsonx_ai.metanames import GenTextParamsMetaNames as GenParams
 from ibm_watsonx_ai.foundation_models.utils.enums import DecodingMethods
@@ -93,15 +99,23 @@ llm = WatsonxLLM(
     }
 )
 
-embeddings = WatsonxEmbeddings(
-    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
-    url=watsonx_url,
-    apikey=watsonx_api_key,
-    project_id=project_id
+# Chunk vectors are cached on disk so re-selected documents only embed changed chunks
+embeddings = CachedEmbeddings(
+    WatsonxEmbeddings(
+        model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value,
+        url=watsonx_url,
+        apikey=watsonx_api_key,
+        project_id=project_id
+    ),
+    model_id=EmbeddingTypes.IBM_SLATE_30M_ENG.value
 )
 
-# Global variable to store vector store
-vectors = None
+# Every processed PDF stays in one corpus; questions are filtered to the selected one
+doc_index = DocumentIndex(embeddings, "chroma", "teams_watsonx_rag")
+# Answers to repeated /askdoc questions, dropped when the document is re-ingested with new content
+answer_cache = AnswerCache(embeddings)
+# Each conversation queries its own in-memory index of the document it selected
+conversations = ConversationIndexes(embeddings, "teams_watsonx_rag")
 
 # Create Quart app
 app = Quart(__name__)
@@ -113,27 +127,32 @@ SETTINGS = BotFrameworkAdapterSettings(
 )
 ADAPTER = BotFrameworkAdapter(SETTINGS)
 
-def setup_vector_store(file_path):
-    global vectors
-    
+def setup_vector_store(file_path, doc_id):
     logging.info(f"Setting up vector store for file: {file_path}")
-    loader = PyPDFLoader(file_path)
-    docs = loader.load()
-    if not docs:
-        raise ValueError("No documents found in the PDF.")
-    
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    final_documents = text_splitter.split_documents(docs)
-    if not final_documents:
-        raise ValueError("No text could be extracted from the PDF.")
-    
-    vectors = Chroma.from_documents(final_documents, embeddings)
+    # A document already in the corpus with the same contents is not embedded again
+    content_hash = file_hash(file_path)
+    if doc_index.has(doc_id, content_hash):
+        return
+
+    # Parse, split and embed the PDF page by page so memory stays flat on large files
+    text_splitter = LinearTextSplitter(chunk_size=1000, chunk_overlap=200)
+    doc_index.add(doc_id, content_hash, stream_pdf_to_chroma(file_path, text_splitter, embeddings, provider="watsonx"))
     logging.info("Vector store setup completed successfully.")
 
-async def get_answer(question):
-    if vectors is None:
+def use_document(conversation_id, doc_id):
+    conversations.select(conversation_id, doc_id, doc_index.load_document(doc_id))
+    logging.info(f"Conversation indexes: {conversations.stats()}")
+
+async def get_answer(question, doc_id, store):
+    if store is None:
         return "No document has been processed yet. Please upload a PDF file first."
     
+    # Repeated questions about an unchanged document skip retrieval and generation
+    version = doc_index.version(doc_id)
+    cached = await asyncio.to_thread(answer_cache.get, doc_id, version, question)
+    if cached is not None:
+        return cached
+
     prompt = ChatPromptTemplate.from_template("""
     You are an AI assistant that only answers questions based on the provided context.
     If the question cannot be answered using the information in the context, respond with "I'm sorry, but I don't have information about that in the document I've been provided."
@@ -146,19 +165,21 @@ async def get_answer(question):
     AI: """)
     
     document_chain = create_stuff_documents_chain(llm, prompt)
-    retriever = vectors.as_retriever(search_kwargs={"k": 3})
+    # Near-identical chunks from one page are diversified away before packing
+    retriever = packed(llm, vector_retriever(store, k=3))
     retrieval_chain = create_retrieval_chain(retriever, document_chain)
     
     try:
         response = await retrieval_chain.ainvoke({'input': question})
-        return response['answer'].strip()
+        answer = response['answer'].strip()
+        await asyncio.to_thread(answer_cache.put, doc_id, version, question, answer)
+        return answer
     except Exception as e:
         logging.error(f"Error retrieving answer: {str(e)}")
         return f"An error occurred while retrieving the answer: {str(e)}"
     
 class TeamsBot:
     def __init__(self):
-        self.current_pdf = None
         self.current_model = DEFAULT_MODEL
 
     async def on_turn(self, turn_context: TurnContext):
@@ -166,9 +187,10 @@ class TeamsBot:
             if turn_context.activity.text:
                 text = turn_context.activity.text.lower()
                 if text.startswith("/askdoc"):
-                    if self.current_pdf:
+                    doc_id, store = conversations.get(turn_context.activity.conversation.id)
+                    if store:
                         question = text[len("/askdoc"):].strip()
-                        answer = await get_answer(question)
+                        answer = await get_answer(question, doc_id, store)
                         await turn_context.send_activity(answer)
                     else:
                         await turn_context.send_activity("Please use /usedoc to select a document first.")
@@ -191,7 +213,7 @@ class TeamsBot:
                             await turn_context.send_activity("No files found in the SharePoint Documents library.")
                 elif text.startswith("/usedoc"):
                     doc_name = text[len("/usedoc"):].strip()
-                    success, message = await self.download_and_process_sharepoint_pdf(doc_name)
+                    success, message = await self.download_and_process_sharepoint_pdf(doc_name, turn_context.activity.conversation.id)
                     await turn_context.send_activity(message)
                 elif text.startswith("/select_model"):
                     await self.send_model_selection_card(turn_context)
@@ -277,10 +299,10 @@ class TeamsBot:
 
         elif turn_context.activity.value.get("action") == "selectFile":
             selected_file = turn_context.activity.value.get("path")
-            success, message = await self.download_and_process_sharepoint_pdf(selected_file)
+            success, message = await self.download_and_process_sharepoint_pdf(selected_file, turn_context.activity.conversation.id)
             await turn_context.send_activity(message)
 
-    async def download_and_process_sharepoint_pdf(self, filename):
+    async def download_and_process_sharepoint_pdf(self, filename, conversation_id):
         try:
             # Get SharePoint access token
             app = ConfidentialClientApplication(
@@ -339,8 +361,8 @@ class TeamsBot:
                 temp_file_path = temp_file.name
 
             try:
-                setup_vector_store(temp_file_path)
-                self.current_pdf = filename
+                setup_vector_store(temp_file_path, filename)
+                use_document(conversation_id, filename)
                 return True, f"Document '{filename}' is now ready for questions. Use /askdoc to ask questions."
             except Exception as e:
                 return False, f"Error processing PDF: {str(e)}"
@@ -467,8 +489,8 @@ class TeamsBot:
                             pdf_file.write(file_content)
                         
                         try:
-                            setup_vector_store(file_path)
-                            self.current_pdf = attachment.name
+                            setup_vector_store(file_path, attachment.name)
+                            use_document(turn_context.activity.conversation.id, attachment.name)
                             await turn_context.send_activity(f"PDF {attachment.name} has been processed and is ready for queries.")
                         except Exception as e:
                             logging.error(f"Error processing PDF: {str(e)}")